@@ -1,12 +1,21 @@
 """Utilities for interacting with BigQuery."""
 
+import array
 import cPickle
 import datetime
+import errno
 import json
+import logging
+import mmap
 import os
 import random
+import shutil
 import sys
+import struct
 import subprocess
+import tempfile
+import threading
+import time
 
 
 _DATA_DIRECTORY = os.path.join(os.getenv('HOME'), 'bq_data/')
@@ -42,13 +51,439 @@ def call_bq(subcommand_list, project='khanacademy.org:deductive-jet-827',
         raise
 
 
-def _get_data_filename(report, yyyymmdd):
+# We can talk to bigquery either by running the 'bq' command-line
+# tool, or in-process via the bigquery API.  Each backend provides:
+#    query(sql_query, project, job_name, max_rows): run the query and
+#        return a (schema, rows) pair.  rows is an iterator over the
+#        first max_rows (or, if max_rows is None, all) result rows,
+#        each a dict from fieldname to the value as bigquery returns
+#        it (a string or None).  schema is a list of (fieldname,
+#        bigquery type) pairs, or None if the backend doesn't know the
+#        types.
+#    cancel(job_name, project): cancel a running query.
+#    make_table(table_name, expiration_seconds, project): create an
+#        empty table that is deleted after the given time.
+#    query_to_table(sql_query, table_name, project): run the query,
+#        writing the results to the given (existing, empty) table.
+#    query_errors: a tuple of the exceptions that mean a query failed.
+# The default is the command-line backend; use set_backend() to change it.
+
+
+class _CliBackend(object):
+    """Talk to bigquery via the 'bq' command-line tool.
+
+    This requires 'pip install bigquery' be run on this machine.
+    """
+    query_errors = (subprocess.CalledProcessError,)
+    # The command-line tool needs *some* limit on the number of rows.
+    _MAX_ROWS = 10000000
+
+    def query(self, sql_query, project, job_name, max_rows):
+        # To avoid having to deal with paging (which I think the
+        # command-line bq is not very good at anyway), we just get a
+        # bunch of rows.
+        if max_rows is None:
+            max_rows = self._MAX_ROWS
+        # call_bq can return None when there are no results for
+        # the query.  We map that to [].  The json output doesn't
+        # include the schema.
+        return (None, iter(call_bq(['--job_id', job_name,
+                                    'query', '--max_rows=%d' % max_rows,
+                                    sql_query],
+                                   project=project) or []))
+
+    def cancel(self, job_name, project):
+        try:
+            call_bq(['--nosync', 'cancel', job_name],
+                    project=project, return_output=False)
+        except subprocess.CalledProcessError:
+            print "That's ok, it just means the job canceled itself."
+            pass    # probably means the job finished already
+
+    def make_table(self, table_name, expiration_seconds, project):
+        with open(os.devnull, 'w') as devnull:
+            call_bq(['mk', '--expiration', str(expiration_seconds),
+                     table_name],
+                    project=project, return_output=False, stdout=devnull)
+
+    def query_to_table(self, sql_query, table_name, project):
+        # Apparently the commandline doesn't like newlines in the script.
+        call_bq(['query', '--destination_table', table_name,
+                 '--allow_large_results', sql_query.replace('\n', ' ')],
+                project=project, return_output=False)
+
+
+class _ApiBackend(object):
+    """Talk to bigquery in-process, via the bigquery v2 API.
+
+    This reuses one authenticated service per thread (httplib2, which
+    the service uses, isn't thread-safe), and pages through results
+    as we iterate over them rather than loading them all at once.
+    It requires $HOME/cloudmonitoring_secret.json, like the other
+    Google APIs we use.
+    """
+    # How long each getQueryResults call waits for the query to finish.
+    _TIMEOUT_MS = 10000
+    _PAGE_SIZE = 10000
+
+    def __init__(self):
+        # Imported here so using the command-line backend doesn't
+        # require the google api client libraries.
+        import apiclient.errors
+        import cloudmonitoring_util
+
+        self._cloudmonitoring_util = cloudmonitoring_util
+        self._http_error = apiclient.errors.HttpError
+        self.query_errors = (apiclient.errors.HttpError, BQException)
+        self._thread_local = threading.local()
+
+    def _service(self):
+        if not hasattr(self._thread_local, 'service'):
+            self._thread_local.service = (
+                self._cloudmonitoring_util.get_cloud_service('bigquery', 'v2'))
+        return self._thread_local.service
+
+    def _execute(self, request):
+        return self._cloudmonitoring_util.execute_with_retries(request)
+
+    def _table_reference(self, table_name, project):
+        """Convert 'project:dataset.table' to a TableReference."""
+        if ':' in table_name:
+            (project, table_name) = table_name.rsplit(':', 1)
+        (dataset, table) = table_name.split('.', 1)
+        return {'projectId': project, 'datasetId': dataset, 'tableId': table}
+
+    def _insert_job(self, query_config, project, job_name):
+        query_config['useLegacySql'] = True
+        body = {'jobReference': {'projectId': project, 'jobId': job_name},
+                'configuration': {'query': query_config}}
+        self._execute(self._service().jobs().insert(projectId=project,
+                                                    body=body))
+
+    def _log_bytes_processed(self, job_name, total_bytes_processed):
+        # So callers can see what each job costs.
+        logging.info('Bigquery job %s processed %s bytes',
+                     job_name, total_bytes_processed)
+
+    def query(self, sql_query, project, job_name, max_rows):
+        self._insert_job({'query': sql_query}, project, job_name)
+        # We wait for the first page so we can return the schema.
+        response = self._get_page(project, job_name, None, max_rows)
+        self._log_bytes_processed(job_name,
+                                  response.get('totalBytesProcessed'))
+        schema = [(f['name'], f['type'])
+                  for f in response['schema']['fields']]
+        return (schema, self._iter_results(project, job_name, max_rows,
+                                           response))
+
+    def _get_page(self, project, job_name, page_token, max_rows):
+        while True:
+            response = self._execute(self._service().jobs().getQueryResults(
+                projectId=project, jobId=job_name, pageToken=page_token,
+                maxResults=(self._PAGE_SIZE if max_rows is None
+                            else min(self._PAGE_SIZE, max_rows)),
+                timeoutMs=self._TIMEOUT_MS))
+            if response.get('jobComplete'):
+                return response
+
+    def _iter_results(self, project, job_name, max_rows, response):
+        fields = [f['name'] for f in response['schema']['fields']]
+        num_rows = 0
+        while True:
+            for row in response.get('rows', []):
+                yield dict(zip(fields, [cell['v'] for cell in row['f']]))
+                num_rows += 1
+
+            page_token = response.get('pageToken')
+            if not page_token:
+                return
+            if max_rows is None:
+                rows_left = None
+            elif num_rows >= max_rows:
+                return
+            else:
+                rows_left = max_rows - num_rows
+            response = self._get_page(project, job_name, page_token,
+                                      rows_left)
+
+    def cancel(self, job_name, project):
+        try:
+            self._execute(self._service().jobs().cancel(projectId=project,
+                                                        jobId=job_name))
+        except self._http_error:
+            pass    # probably means the job finished already
+
+    def make_table(self, table_name, expiration_seconds, project):
+        table_reference = self._table_reference(table_name, project)
+        body = {'tableReference': table_reference,
+                'expirationTime': str(int(
+                    (time.time() + expiration_seconds) * 1000))}
+        self._execute(self._service().tables().insert(
+            projectId=table_reference['projectId'],
+            datasetId=table_reference['datasetId'],
+            body=body))
+
+    def query_to_table(self, sql_query, table_name, project):
+        job_name = 'bq_util_%s' % random.randint(0, sys.maxint)
+        self._insert_job({'query': sql_query,
+                          'destinationTable': self._table_reference(
+                              table_name, project),
+                          'allowLargeResults': True},
+                         project, job_name)
+        while True:
+            job = self._execute(self._service().jobs().get(projectId=project,
+                                                           jobId=job_name))
+            if job['status']['state'] == 'DONE':
+                break
+            time.sleep(1)
+        if job['status'].get('errorResult'):
+            raise BQException('Query to %s failed: %s'
+                              % (table_name, job['status']['errorResult']))
+        self._log_bytes_processed(
+            job_name, job.get('statistics', {}).get('totalBytesProcessed'))
+
+
+class FakeBackend(object):
+    """A backend for tests, that never talks to bigquery.
+
+    results maps a query (stripped of leading and trailing whitespace)
+    to the rows it should return, as a list of dicts.  Queries that
+    aren't in results return default_rows, which is no rows by default.
+    schemas likewise maps a query to the schema to return for it; by
+    default there is none, like with the command-line tool.  We record
+    all the calls made in self.calls.
+    """
+    query_errors = (BQException,)
+
+    def __init__(self, results=None, schemas=None, default_rows=None):
+        self.results = results or {}
+        self.schemas = schemas or {}
+        self.default_rows = default_rows or []
+        self.calls = []
+
+    def query(self, sql_query, project, job_name, max_rows):
+        self.calls.append(('query', sql_query.strip()))
+        rows = self.results.get(sql_query.strip(), self.default_rows)
+        return (self.schemas.get(sql_query.strip()),
+                iter([row.copy() for row in rows[:max_rows]]))
+
+    def cancel(self, job_name, project):
+        self.calls.append(('cancel', job_name))
+
+    def make_table(self, table_name, expiration_seconds, project):
+        self.calls.append(('make_table', table_name))
+
+    def query_to_table(self, sql_query, table_name, project):
+        self.calls.append(('query_to_table', sql_query.strip(), table_name))
+
+
+def use_temp_data_directory(test_case):
+    """For tests: save daily data to a temp dir until test_case is done."""
+    global _DATA_DIRECTORY
+    orig_data_directory = _DATA_DIRECTORY
+    _DATA_DIRECTORY = tempfile.mkdtemp()
+    test_case.addCleanup(shutil.rmtree, _DATA_DIRECTORY)
+    test_case.addCleanup(setattr, sys.modules[__name__], '_DATA_DIRECTORY',
+                         orig_data_directory)
+
+
+_BACKENDS = {'cli': _CliBackend, 'api': _ApiBackend}
+_BACKEND = _CliBackend()
+
+
+def set_backend(backend):
+    """Set how we talk to bigquery: 'cli', 'api', or a backend object."""
+    global _BACKEND
+    if backend in _BACKENDS:
+        backend = _BACKENDS[backend]()
+    _BACKEND = backend
+
+
+def make_table(table_name, expiration_seconds,
+               project='khanacademy.org:deductive-jet-827'):
+    """Create an empty table that expires after expiration_seconds."""
+    _BACKEND.make_table(table_name, expiration_seconds, project)
+
+
+def query_to_table(sql_query, table_name,
+                   project='khanacademy.org:deductive-jet-827'):
+    """Run a query, storing the (possibly large) results in table_name."""
+    _BACKEND.query_to_table(sql_query, table_name, project)
+
+
+def _get_data_filename(report, yyyymmdd, extension='.pickle'):
     """Gets the filename in which old data might be stored.
 
     Takes a report name and a date stamp.  The file returned is not guaranteed
-    to exist.
+    to exist.  We store tables (lists of dicts with the same keys) in a
+    columnar format, in a '.cols' file, and anything else in a '.pickle'.
     """
-    return os.path.join(_DATA_DIRECTORY, report + '_' + yyyymmdd + '.pickle')
+    return os.path.join(_DATA_DIRECTORY, report + '_' + yyyymmdd + extension)
+
+
+# The columnar format is:
+#    _COLUMNAR_MAGIC
+#    4-byte length of the pickled header, followed by the header
+#    the data blocks for each column
+# The header is a dict with 'num_rows', and 'columns', a list of
+# (name, kind, blocks) triples.  blocks maps a block-name to the
+# (offset, length) of that block, relative to the end of the header.
+# The kinds are:
+#    'l': integers.  'data' is an array('l'), with 0 for nulls.
+#    'd': floats.  'data' is an array('d'), with 0.0 for nulls.
+#    's': strings.  'dictionary' is a pickled list of the distinct
+#         strings, and 'data' an array('i') of indices into it, with -1
+#         for nulls.
+#    'o': anything else.  'data' is a pickled list of the values.
+# For 'l' and 'd', the optional 'nulls' block is a bitmap of which
+# rows are null.  A null is '(None)', which is how query_bigquery
+# represents NULL; we give back exactly the values we saved.
+# Reading a column only touches that column's blocks.
+_COLUMNAR_MAGIC = 'BQCOLS1\n'
+_NULL = '(None)'
+_MIN_INT = -(2 ** (array.array('l').itemsize * 8 - 1))
+_MAX_INT = 2 ** (array.array('l').itemsize * 8 - 1) - 1
+
+
+def _is_table(data):
+    """True if data is a non-empty list of dicts, all with the same keys."""
+    if not isinstance(data, list) or not data:
+        return False
+    if not all(isinstance(row, dict) for row in data):
+        return False
+    keys = set(data[0])
+    return all(len(row) == len(keys) and keys.issuperset(row)
+               for row in data)
+
+
+def _column_kind(values):
+    types = set(type(v) for v in values if v != _NULL)
+    if types <= set([int, long]):
+        if all(_MIN_INT <= v <= _MAX_INT for v in values if v != _NULL):
+            return 'l'
+    elif types == set([float]):
+        return 'd'
+    elif types <= set([str, unicode]):
+        return 's'
+    return 'o'
+
+
+def _encode_column(values):
+    """Return a (kind, {block-name: block-contents}) pair for a column."""
+    kind = _column_kind(values)
+    if kind == 's':
+        dictionary = []
+        codes = {_NULL: -1}
+        data = array.array('i')
+        for value in values:
+            code = codes.get(value)
+            if code is None:
+                code = codes[value] = len(dictionary)
+                dictionary.append(value)
+            data.append(code)
+        return (kind, {'dictionary': cPickle.dumps(dictionary,
+                                                   cPickle.HIGHEST_PROTOCOL),
+                       'data': data.tostring()})
+
+    if kind == 'o':
+        return (kind, {'data': cPickle.dumps(values,
+                                             cPickle.HIGHEST_PROTOCOL)})
+
+    blocks = {}
+    null_rows = [i for (i, v) in enumerate(values) if v == _NULL]
+    if null_rows:
+        nulls = bytearray((len(values) + 7) // 8)
+        for i in null_rows:
+            nulls[i // 8] |= 1 << (i % 8)
+        blocks['nulls'] = str(nulls)
+        values = [0 if v == _NULL else v for v in values]
+    blocks['data'] = array.array(kind, values).tostring()
+    return (kind, blocks)
+
+
+def _decode_column(kind, read_block):
+    """Return a column's values; read_block(name) returns a block."""
+    if kind == 's':
+        dictionary = cPickle.loads(read_block('dictionary'))
+        dictionary.append(_NULL)        # so code -1 maps to null
+        codes = array.array('i')
+        codes.fromstring(read_block('data'))
+        return map(dictionary.__getitem__, codes)
+
+    if kind == 'o':
+        return cPickle.loads(read_block('data'))
+
+    data = array.array(kind)
+    data.fromstring(read_block('data'))
+    values = data.tolist()
+    nulls = read_block('nulls')
+    if nulls is not None:
+        nulls = bytearray(nulls)
+        for i in xrange(len(values)):
+            if nulls[i // 8] & (1 << (i % 8)):
+                values[i] = _NULL
+    return values
+
+
+def _write_columnar(filename, rows):
+    header_columns = []
+    blocks = []
+    offset = 0
+    for name in sorted(rows[0]):
+        (kind, column_blocks) = _encode_column([row[name] for row in rows])
+        block_positions = {}
+        for (block_name, block) in column_blocks.iteritems():
+            block_positions[block_name] = (offset, len(block))
+            blocks.append(block)
+            offset += len(block)
+        header_columns.append((name, kind, block_positions))
+    header = cPickle.dumps({'num_rows': len(rows), 'columns': header_columns},
+                           cPickle.HIGHEST_PROTOCOL)
+
+    # Write to a temp-file so readers never see a partial file.
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(_COLUMNAR_MAGIC)
+        f.write(struct.pack('!L', len(header)))
+        f.write(header)
+        for block in blocks:
+            f.write(block)
+    os.rename(filename + '.tmp', filename)
+
+
+def _read_columnar(filename, columns=None):
+    """Return a map from column-name to values, for the given columns.
+
+    If columns is None, return all columns.  Columns that aren't in the
+    file are omitted.
+    """
+    with open(filename, 'rb') as f:
+        contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if contents[:len(_COLUMNAR_MAGIC)] != _COLUMNAR_MAGIC:
+            raise ValueError('%s is not a columnar data file' % filename)
+        header_start = len(_COLUMNAR_MAGIC) + 4
+        (header_length,) = struct.unpack(
+            '!L', contents[len(_COLUMNAR_MAGIC):header_start])
+        header = cPickle.loads(
+            contents[header_start:header_start + header_length])
+        data_start = header_start + header_length
+
+        retval = {}
+        for (name, kind, block_positions) in header['columns']:
+            if columns is not None and name not in columns:
+                continue
+
+            def read_block(block_name):
+                if block_name not in block_positions:
+                    return None
+                (offset, length) = block_positions[block_name]
+                return contents[data_start + offset:
+                                data_start + offset + length]
+
+            retval[name] = _decode_column(kind, read_block)
+        return retval
+    finally:
+        contents.close()
 
 
 def get_daily_data(report, yyyymmdd):
@@ -57,6 +492,13 @@ def get_daily_data(report, yyyymmdd):
     Returns the data in the format saved (see save_daily_data or the caller),
     or None if there is no old data for that report on that day.
     """
+    filename = _get_data_filename(report, yyyymmdd, '.cols')
+    if os.path.exists(filename):
+        columns = _read_columnar(filename)
+        names = columns.keys()
+        return [dict(zip(names, values))
+                for values in zip(*[columns[name] for name in names])]
+
     filename = _get_data_filename(report, yyyymmdd)
     if not os.path.exists(filename):
         return None
@@ -65,19 +507,90 @@ def get_daily_data(report, yyyymmdd):
             return cPickle.load(f)
 
 
+def get_daily_columns(report, yyyymmdd, columns=None):
+    """Gets some columns of old table data for a particular report.
+
+    Returns a map from column-name to the list of values for that
+    column, or None if there is no old data for that report on that
+    day.  If columns is None, we return all the columns.  Columns that
+    aren't in the data are omitted.  For data saved in the columnar
+    format, we only read the columns asked for.
+    """
+    filename = _get_data_filename(report, yyyymmdd, '.cols')
+    if os.path.exists(filename):
+        return _read_columnar(filename, columns)
+
+    data = get_daily_data(report, yyyymmdd)
+    if data is None:
+        return None
+    if not data:
+        return {}
+    if columns is None:
+        columns = data[0].keys()
+    return {name: [row[name] for row in data]
+            for name in columns if name in data[0]}
+
+
 def save_daily_data(data, report, yyyymmdd):
     """Saves the data for a report to be used in the future.
 
     This will create the relevant directories if they don't exist, and clobber
     any existing data with the same timestamp.  "data" can be anything
     pickleable, but in general will likely be of the format returned from
-    _query_bigquery, namely a list of dicts fieldname -> value.
+    query_bigquery, namely a list of dicts fieldname -> value.  We save
+    such data in a columnar format, so get_daily_columns can read just
+    the columns it needs.
     """
     filename = _get_data_filename(report, yyyymmdd)
-    if not os.path.isdir(os.path.dirname(filename)):
+    columnar_filename = _get_data_filename(report, yyyymmdd, '.cols')
+    try:
         os.makedirs(os.path.dirname(filename))
-    with open(filename, 'w') as f:
-        cPickle.dump(data, f)
+    except OSError as e:
+        # Another thread may have just made it, which is fine.
+        if e.errno != errno.EEXIST:
+            raise
+
+    if _is_table(data):
+        _write_columnar(columnar_filename, data)
+        stale_filename = filename
+    else:
+        with open(filename, 'w') as f:
+            cPickle.dump(data, f)
+        stale_filename = columnar_filename
+
+    # Get rid of any data we saved for this day in the other format.
+    try:
+        os.unlink(stale_filename)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def has_daily_data(report, yyyymmdd):
+    """True if we've saved data for the report on that day, even if empty.
+
+    We just check for the file, rather than reading it.
+    """
+    return (os.path.exists(_get_data_filename(report, yyyymmdd, '.cols')) or
+            os.path.exists(_get_data_filename(report, yyyymmdd)))
+
+
+def daily_tables_union(subquery_pattern, yyyymmdds):
+    """Return a FROM clause that unions a subquery over several days.
+
+    subquery_pattern is a query with %(yyyymmdd)s where the date
+    goes (or %(yyyy_mm_dd)s, for the same date with dashes); it will
+    typically select from [logs.requestlogs_%(yyyymmdd)s] and include
+    '%(yyyymmdd)s' AS yyyymmdd, so the outer query can GROUP BY day.
+    (In bigquery's legacy SQL, a comma in a FROM is a UNION ALL.)
+    """
+    return ',\n'.join(
+        '(%s)' % (subquery_pattern % {
+            'yyyymmdd': yyyymmdd,
+            'yyyy_mm_dd': '%s-%s-%s' % (yyyymmdd[:4], yyyymmdd[4:6],
+                                        yyyymmdd[6:]),
+        })
+        for yyyymmdd in yyyymmdds)
 
 
 def get_daily_data_from_disk_or_bq(query, report, yyyymmdd):
@@ -98,7 +611,8 @@ def get_daily_data_from_disk_or_bq(query, report, yyyymmdd):
     return daily_data
 
 
-def process_past_data(report, end_date, history_length, keyfn):
+def process_past_data(report, end_date, history_length, keyfn,
+                      columns=None):
     """Get and process the past data for a particular report.
 
     Returns a list of dicts, one for each day, in most-recent-first order, with
@@ -106,42 +620,112 @@ def process_past_data(report, end_date, history_length, keyfn):
     returned by `bq`.  If there is no data, the dict will be empty.
     'history_length' is the number of days of data to include, not counting the
     current one.
+
+    keyfn can also be a column name, or a tuple of column names, in
+    which case the key is that column's value (or a tuple of the
+    columns' values).  In that case, if you only need some columns
+    from the old rows, pass them in 'columns': each row will then have
+    only the key columns and those, and we only read those columns
+    from disk.
     """
+    if callable(keyfn):
+        key_columns = None
+    elif isinstance(keyfn, basestring):
+        key_columns = (keyfn,)
+    else:
+        key_columns = tuple(keyfn)
+
+    if key_columns is not None and columns is not None:
+        columns = key_columns + tuple(c for c in columns
+                                      if c not in key_columns)
+
     historical_data = []
     for i in xrange(history_length + 1):
         old_yyyymmdd = (end_date - datetime.timedelta(i)).strftime("%Y%m%d")
-        old_data = get_daily_data(report, old_yyyymmdd)
-        # Save it by url_route for easy lookup.
-        if old_data:
-            historical_data.append({keyfn(row): row for row in old_data})
+        if key_columns is None:
+            old_data = get_daily_data(report, old_yyyymmdd)
+            # Save it by url_route for easy lookup.
+            if old_data:
+                historical_data.append({keyfn(row): row for row in old_data})
+            else:
+                # If we're missing data, put in a placeholder.  This will get
+                # carried through and eventually become a space in the graph.
+                historical_data.append({})
+            continue
+
+        old_columns = get_daily_columns(report, old_yyyymmdd, columns)
+        if not old_columns or not all(k in old_columns for k in key_columns):
+            historical_data.append({})      # a placeholder, as above
+            continue
+        if len(key_columns) == 1:
+            keys = old_columns[key_columns[0]]
         else:
-            # If we're missing data, put in a placeholder.  This will get
-            # carried through and eventually become a space in the graph.
-            historical_data.append({})
+            keys = zip(*[old_columns[k] for k in key_columns])
+        names = old_columns.keys()
+        rows = [dict(zip(names, values))
+                for values in zip(*[old_columns[name] for name in names])]
+        historical_data.append(dict(zip(keys, rows)))
+
     # We construct historical_data with the most recent data first, but display
     # the sparklines with the most recent data last.
     historical_data.reverse()
     return historical_data
 
 
-def query_bigquery(sql_query, retries=2):
-    """Use the 'bq' tool to run a query, and return the results as
-    a json list (each row is a dict).
+# How to convert the (string) values bigquery returns, by column type.
+# Types not listed here (STRING, etc) we leave alone.
+_CONVERTERS = {
+    'INTEGER': int,
+    'FLOAT': float,
+    'TIMESTAMP': float,     # seconds since the epoch
+    'BOOLEAN': lambda value: value == 'true',
+}
 
-    We do naive type conversion to int and float, when possible.
 
-    The bq tool fails every once in a while for flaky reasons, so by default we
-    retry the query a few times.
+def _guess_type(value):
+    """Convert a value to int or float if it looks like one."""
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
 
-    This requires 'pip install bigquery' be run on this machine.
-    """
-    # We could probably do 'import bq' and call out directly, but
-    # I couldn't figure out an easy way to do this.  Ah well.
-    # To avoid having to deal with paging (which I think the command-line bq is
-    # not very good at anyway), we just get a bunch of rows.  We probably only
-    # want to display the first 100 or so, but the rest may be useful to save.
 
-    table = None
+def _first_rows(rows, max_rows):
+    """Yield the first max_rows rows, logging if there were more."""
+    for (i, row) in enumerate(rows):
+        if i == max_rows:
+            logging.warning('Query returned more than %d rows; '
+                            'dropping the rest' % max_rows)
+            return
+        yield row
+
+
+def query_bigquery_iter(sql_query, retries=2,
+                        project='khanacademy.org:deductive-jet-827',
+                        max_rows=None):
+    """Run a query, and yield the results one row (a dict) at a time.
+
+    If max_rows is given, we only yield that many rows, and log a
+    warning if the query returned more.  By default we yield them all.
+
+    Values are converted to int, float, etc. based on the types in the
+    query's schema.  If the backend doesn't give us a schema, as with
+    the 'bq' command-line tool, we convert to int and float whenever
+    possible instead.  NULL values are None.
+
+    The query isn't run until you start iterating.  bigquery fails
+    every once in a while for flaky reasons, so by default we retry
+    the query a few times.  (We don't retry once rows are coming in.)
+
+    We use the backend set via set_backend(); by default, the 'bq'
+    command-line tool.  With the 'api' backend, rows are fetched a
+    page at a time as you iterate.
+    """
+    schema = None
+    rows = None
     job_name = None
     error_msg = None
 
@@ -149,39 +733,64 @@ def query_bigquery(sql_query, retries=2):
         try:
             # We specify the job-name (randomly) so we can cancel it.
             job_name = 'bq_util_%s' % random.randint(0, sys.maxint)
-            # call_bq can return None when there are no results for
-            # the query.  We map that to [].
-            table = call_bq(['--job_id', job_name,
-                             'query', '--max_rows=10000', sql_query]) or []
+            # We ask for one more row than we want, to see if there
+            # are rows we're dropping.
+            (schema, rows) = _BACKEND.query(
+                sql_query, project, job_name,
+                None if max_rows is None else max_rows + 1)
             job_name = None     # to indicate the job has finished
             break
-        except subprocess.CalledProcessError as why:
-            print "-- Running query failed with retcode %d --" % why.returncode
-            error_msg = why.output
+        except _BACKEND.query_errors as why:
+            if isinstance(why, subprocess.CalledProcessError):
+                print ("-- Running query failed with retcode %d --"
+                       % why.returncode)
+                error_msg = why.output
+            else:
+                print "-- Running query failed: %s --" % why
+                error_msg = str(why)
         finally:
-            if job_name:
-                try:        # Cancel the job if it's still running
-                    call_bq(['--nosync', 'cancel', job_name],
-                            return_output=False)
-                except subprocess.CalledProcessError:
-                    print "That's ok, it just means the job canceled itself."
-                    pass    # probably means the job finished already
-
-    if table is None:
+            if job_name:        # Cancel the job if it's still running
+                _BACKEND.cancel(job_name, project)
+
+    if rows is None:
         raise BQException("-- Query failed after %d retries: %s --"
                           % (retries, error_msg))
 
+    if max_rows is not None:
+        rows = _first_rows(rows, max_rows)
+
+    if schema is None:
+        for row in rows:
+            for (key, value) in row.iteritems():
+                if value is not None:
+                    row[key] = _guess_type(value)
+            yield row
+    else:
+        converters = [(name, _CONVERTERS[field_type])
+                      for (name, field_type) in schema
+                      if field_type in _CONVERTERS]
+        for row in rows:
+            for (name, converter) in converters:
+                value = row[name]
+                if value is not None:
+                    row[name] = converter(value)
+            yield row
+
+
+def query_bigquery(sql_query, retries=2,
+                   project='khanacademy.org:deductive-jet-827',
+                   max_rows=10000):
+    """Run a query, and return the results as a json list (each row is
+    a dict).
+
+    This is like query_bigquery_iter, but NULL values are the string
+    '(None)'.  We only return the first max_rows rows (logging a
+    warning if there were more).  We probably only want to display the
+    first 100 or so, but the rest may be useful to save.
+    """
+    table = list(query_bigquery_iter(sql_query, retries, project, max_rows))
     for row in table:
-        for key in row:
-            if row[key] is None:
+        for (key, value) in row.iteritems():
+            if value is None:
                 row[key] = '(None)'
-            else:
-                try:
-                    row[key] = int(row[key])
-                except ValueError:
-                    try:
-                        row[key] = float(row[key])
-                    except ValueError:
-                        pass
-
     return table
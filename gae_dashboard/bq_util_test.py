@@ -0,0 +1,324 @@
+import cPickle
+import datetime
+import os
+import subprocess
+import time
+import unittest
+
+import bq_util
+
+
+class _FakeRequest(object):
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self):
+        return self.response
+
+
+class _FakeJobs(object):
+    """Just enough of the bigquery v2 jobs() collection for _ApiBackend."""
+    def __init__(self, pages):
+        # pages maps a page-token to the responses to return for it,
+        # in order.  We keep returning the last one.
+        self.pages = pages
+        self.calls = []
+
+    def insert(self, projectId, body):
+        self.calls.append(('insert', body['jobReference']['jobId']))
+        return _FakeRequest({})
+
+    def getQueryResults(self, projectId, jobId, pageToken, maxResults,
+                        timeoutMs):
+        self.calls.append(('getQueryResults', pageToken, maxResults))
+        responses = self.pages[pageToken]
+        if len(responses) > 1:
+            return _FakeRequest(responses.pop(0))
+        return _FakeRequest(responses[0])
+
+
+class _FakeService(object):
+    def __init__(self, jobs):
+        self._jobs = jobs
+
+    def jobs(self):
+        return self._jobs
+
+
+class TestQueryBigquery(unittest.TestCase):
+    def setUp(self):
+        self.orig_backend = bq_util._BACKEND
+
+    def tearDown(self):
+        bq_util.set_backend(self.orig_backend)
+
+    def test_converts_values(self):
+        backend = bq_util.FakeBackend({'SELECT 1': [
+            {'route': '/a', 'count': '12', 'ratio': '0.5', 'error': None}]})
+        bq_util.set_backend(backend)
+        self.assertEqual([{'route': '/a', 'count': 12, 'ratio': 0.5,
+                           'error': '(None)'}],
+                         bq_util.query_bigquery('SELECT 1'))
+
+    def test_iter_converts_values_using_the_schema(self):
+        backend = bq_util.FakeBackend(
+            {'SELECT 1': [{'route': '8', 'count': '12', 'ratio': '3',
+                           'ok': 'true', 'error': None}]},
+            {'SELECT 1': [('route', 'STRING'), ('count', 'INTEGER'),
+                          ('ratio', 'FLOAT'), ('ok', 'BOOLEAN'),
+                          ('error', 'INTEGER')]})
+        bq_util.set_backend(backend)
+        [row] = list(bq_util.query_bigquery_iter('SELECT 1'))
+        self.assertEqual({'route': '8', 'count': 12, 'ratio': 3.0,
+                          'ok': True, 'error': None},
+                         row)
+        self.assertIsInstance(row['ratio'], float)
+
+    def test_iter_is_lazy(self):
+        backend = bq_util.FakeBackend()
+        bq_util.set_backend(backend)
+        rows = bq_util.query_bigquery_iter('SELECT 1')
+        self.assertEqual([], backend.calls)
+        self.assertEqual([], list(rows))
+        self.assertEqual([('query', 'SELECT 1')], backend.calls)
+
+    def test_iter_returns_all_rows_by_default(self):
+        backend = bq_util.FakeBackend(
+            {'SELECT 1': [{'n': str(i)} for i in xrange(20001)]})
+        bq_util.set_backend(backend)
+        self.assertEqual(20001,
+                         len(list(bq_util.query_bigquery_iter('SELECT 1'))))
+
+    def test_max_rows_logs_dropped_rows(self):
+        backend = bq_util.FakeBackend(
+            {'SELECT 1': [{'n': str(i)} for i in xrange(3)]})
+        bq_util.set_backend(backend)
+        warnings = []
+        orig_warning = bq_util.logging.warning
+        self.addCleanup(setattr, bq_util.logging, 'warning', orig_warning)
+        bq_util.logging.warning = warnings.append
+
+        self.assertEqual([0, 1, 2], [row['n'] for row in
+                                     bq_util.query_bigquery_iter(
+                                         'SELECT 1', max_rows=3)])
+        self.assertEqual([], warnings)
+        self.assertEqual([0, 1], [row['n'] for row in
+                                  bq_util.query_bigquery('SELECT 1',
+                                                         max_rows=2)])
+        self.assertEqual(1, len(warnings))
+        self.assertIn('more than 2 rows', warnings[0])
+
+    def test_retries_then_raises(self):
+        class FailingBackend(bq_util.FakeBackend):
+            def query(self, sql_query, project, job_name, max_rows):
+                self.calls.append(('query', sql_query))
+                raise bq_util.BQException('Not found: Table foo')
+
+        backend = FailingBackend()
+        bq_util.set_backend(backend)
+        with self.assertRaises(bq_util.BQException) as e:
+            bq_util.query_bigquery('SELECT 1', retries=1)
+        self.assertIn('Not found', str(e.exception))
+        self.assertEqual(['query', 'cancel', 'query', 'cancel'],
+                         [call[0] for call in backend.calls])
+
+    def test_set_backend_by_name(self):
+        bq_util.set_backend('cli')
+        self.assertEqual((subprocess.CalledProcessError,),
+                         bq_util._BACKEND.query_errors)
+
+    def test_make_table_and_query_to_table(self):
+        backend = bq_util.FakeBackend()
+        bq_util.set_backend(backend)
+        bq_util.make_table('proj:dataset.table', 60)
+        bq_util.query_to_table('SELECT 1', 'proj:dataset.table')
+        self.assertEqual([('make_table', 'proj:dataset.table'),
+                          ('query_to_table', 'SELECT 1',
+                           'proj:dataset.table')],
+                         backend.calls)
+
+
+class TestApiBackend(unittest.TestCase):
+    def setUp(self):
+        schema = {'fields': [{'name': 'route', 'type': 'STRING'},
+                             {'name': 'count', 'type': 'INTEGER'}]}
+        self.jobs = _FakeJobs({
+            None: [{'jobComplete': False},
+                   {'jobComplete': True, 'schema': schema,
+                    'rows': [{'f': [{'v': '/a'}, {'v': '1'}]},
+                             {'f': [{'v': '/b'}, {'v': None}]}],
+                    'pageToken': 'page2'}],
+            'page2': [{'jobComplete': True, 'schema': schema,
+                       'rows': [{'f': [{'v': '/c'}, {'v': '3'}]}]}],
+        })
+        self.backend = bq_util._ApiBackend()
+        self.backend._thread_local.service = _FakeService(self.jobs)
+
+    def test_pages_through_results(self):
+        (schema, rows) = self.backend.query('SELECT 1', 'proj', 'job1', 10000)
+        self.assertEqual([('route', 'STRING'), ('count', 'INTEGER')], schema)
+        self.assertEqual([{'route': '/a', 'count': '1'},
+                          {'route': '/b', 'count': None},
+                          {'route': '/c', 'count': '3'}],
+                         list(rows))
+        # The first getQueryResults says the job isn't done yet.
+        self.assertEqual([('insert', 'job1'),
+                          ('getQueryResults', None, 10000),
+                          ('getQueryResults', None, 10000),
+                          ('getQueryResults', 'page2', 9998)],
+                         self.jobs.calls)
+
+    def test_no_max_rows(self):
+        (_, rows) = self.backend.query('SELECT 1', 'proj', 'job1', None)
+        self.assertEqual(['/a', '/b', '/c'], [row['route'] for row in rows])
+        self.assertEqual([10000, 10000, 10000],
+                         [c[2] for c in self.jobs.calls
+                          if c[0] == 'getQueryResults'])
+
+    def test_logs_bytes_processed(self):
+        self.jobs.pages[None][1]['totalBytesProcessed'] = '12345'
+        messages = []
+        orig_info = bq_util.logging.info
+        self.addCleanup(setattr, bq_util.logging, 'info', orig_info)
+        bq_util.logging.info = lambda msg, *args: messages.append(msg % args)
+        self.backend.query('SELECT 1', 'proj', 'job1', 10000)
+        self.assertEqual(['Bigquery job job1 processed 12345 bytes'],
+                         messages)
+
+    def test_max_rows(self):
+        (_, rows) = self.backend.query('SELECT 1', 'proj', 'job1', 2)
+        self.assertEqual(['/a', '/b'], [row['route'] for row in rows])
+        self.assertEqual(2, len([c for c in self.jobs.calls
+                                 if c[0] == 'getQueryResults']))
+
+    def test_table_reference(self):
+        self.assertEqual({'projectId': 'khan-academy',
+                          'datasetId': 'logs_tmp', 'tableId': 'foo_1'},
+                         self.backend._table_reference(
+                             'khan-academy:logs_tmp.foo_1', 'other'))
+        self.assertEqual({'projectId': 'other',
+                          'datasetId': 'logs_tmp', 'tableId': 'foo_1'},
+                         self.backend._table_reference('logs_tmp.foo_1',
+                                                       'other'))
+
+
+def _make_rows(num_rows):
+    """Return rows like the ones email_rpcs saves."""
+    rows = []
+    for i in xrange(num_rows):
+        rows.append({'url_route': u'main:/api/internal/route_%d' % i,
+                     'requests': 1000 + i,
+                     'rpc_cost': 12.5 * i if i % 7 else '(None)',
+                     'rpc_Get': i * 3, 'rpc_Put': i, 'rpc_Next': 0,
+                     'rpc_RunQuery': i * 2, 'rpc_Delete': 0,
+                     'rpc_Commit': i})
+    return rows
+
+
+class TestDailyData(unittest.TestCase):
+    def setUp(self):
+        bq_util.use_temp_data_directory(self)
+
+    def _save_as_pickle(self, data, report, yyyymmdd):
+        """Save data the way save_daily_data used to."""
+        with open(bq_util._get_data_filename(report, yyyymmdd), 'w') as f:
+            cPickle.dump(data, f)
+
+    def test_round_trips_tables(self):
+        data = [{'route': u'/a', 'count': 1, 'ratio': 0.5, 'big': 2 ** 70,
+                 'flag': True, 'mixed': 1, 'missing': '(None)'},
+                {'route': '(None)', 'count': '(None)', 'ratio': '(None)',
+                 'big': 3, 'flag': False, 'mixed': 1.5, 'missing': '(None)'},
+                {'route': u'/a', 'count': -5, 'ratio': 1.0, 'big': 4,
+                 'flag': None, 'mixed': u'x', 'missing': '(None)'}]
+        bq_util.save_daily_data(data, 'report', '20160301')
+        self.assertTrue(os.path.exists(bq_util._get_data_filename(
+            'report', '20160301', '.cols')))
+        self.assertEqual(data, bq_util.get_daily_data('report', '20160301'))
+        self.assertEqual(
+            [type(v) for v in data[0].values()],
+            [type(v) for v in
+             bq_util.get_daily_data('report', '20160301')[0].values()])
+
+    def test_non_tables_are_pickled(self):
+        for data in ([], {'a': 1}, [{'a': 1}, {'b': 2}]):
+            bq_util.save_daily_data(data, 'report', '20160301')
+            self.assertEqual(data,
+                             bq_util.get_daily_data('report', '20160301'))
+            self.assertFalse(os.path.exists(bq_util._get_data_filename(
+                'report', '20160301', '.cols')))
+
+    def test_has_daily_data(self):
+        self.assertFalse(bq_util.has_daily_data('report', '20160301'))
+        bq_util.save_daily_data([{'a': 1}], 'report', '20160301')
+        self.assertTrue(bq_util.has_daily_data('report', '20160301'))
+        # A day with no rows still counts as saved.
+        bq_util.save_daily_data([], 'report', '20160302')
+        self.assertTrue(bq_util.has_daily_data('report', '20160302'))
+        self.assertFalse(bq_util.has_daily_data('report', '20160303'))
+
+    def test_get_daily_columns(self):
+        bq_util.save_daily_data(_make_rows(3), 'rpcs', '20160301')
+        self._save_as_pickle(_make_rows(2), 'rpcs', '20160302')
+        for yyyymmdd in ('20160301', '20160302'):
+            columns = bq_util.get_daily_columns(
+                'rpcs', yyyymmdd, ('requests', 'rpc_cost', 'no_such_column'))
+            self.assertEqual(['requests', 'rpc_cost'], sorted(columns))
+            self.assertEqual(['(None)', 12.5],
+                             columns['rpc_cost'][:2])
+        self.assertIsNone(bq_util.get_daily_columns('rpcs', '20160303'))
+
+    def test_process_past_data(self):
+        end_date = datetime.date(2016, 3, 3)
+        bq_util.save_daily_data(_make_rows(3), 'rpcs', '20160303')
+        self._save_as_pickle(_make_rows(2), 'rpcs', '20160301')
+
+        by_callable = bq_util.process_past_data(
+            'rpcs', end_date, 2, lambda row: row['url_route'])
+        by_column = bq_util.process_past_data(
+            'rpcs', end_date, 2, 'url_route')
+        self.assertEqual(by_callable, by_column)
+        self.assertEqual([2, 0, 3], [len(d) for d in by_column])
+
+        some_columns = bq_util.process_past_data(
+            'rpcs', end_date, 2, ('url_route', 'rpc_Get'),
+            columns=('requests',))
+        self.assertEqual({'url_route': u'main:/api/internal/route_1',
+                          'rpc_Get': 3, 'requests': 1001},
+                         some_columns[2][(u'main:/api/internal/route_1', 3)])
+
+
+@unittest.skipUnless(os.environ.get('BENCHMARK'),
+                     'set BENCHMARK=1 to run benchmarks')
+class BenchmarkProcessPastData(unittest.TestCase):
+    def setUp(self):
+        bq_util.use_temp_data_directory(self)
+
+    def test_columnar_is_faster_than_pickle(self):
+        # Two weeks of history for a report with 5000 routes.
+        end_date = datetime.date(2016, 3, 15)
+        rows = _make_rows(5000)
+        for i in xrange(15):
+            yyyymmdd = (end_date - datetime.timedelta(i)).strftime('%Y%m%d')
+            with open(bq_util._get_data_filename('pickled', yyyymmdd),
+                      'w') as f:
+                cPickle.dump(rows, f)
+            bq_util.save_daily_data(rows, 'columnar', yyyymmdd)
+
+        start = time.time()
+        bq_util.process_past_data('pickled', end_date, 14,
+                                  lambda row: row['url_route'])
+        pickle_time = time.time() - start
+
+        start = time.time()
+        bq_util.process_past_data('columnar', end_date, 14, 'url_route',
+                                  columns=('rpc_cost', 'requests'))
+        columnar_time = time.time() - start
+
+        print ('\npickle: %.3fs, columnar: %.3fs'
+               % (pickle_time, columnar_time))
+        self.assertLess(columnar_time, pickle_time)
+
+
+if __name__ == '__main__':
+    unittest.main()
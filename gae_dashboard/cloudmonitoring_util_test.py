@@ -0,0 +1,93 @@
+import os
+import time
+import unittest
+
+import cloudmonitoring_util
+
+
+class TestFromRfc3339(unittest.TestCase):
+    def setUp(self):
+        cloudmonitoring_util._RFC3339_CACHE.clear()
+
+    def test_matches_strptime(self):
+        for time_t in (0, 951782400, 1456704000, 1456790399, 1480000000,
+                       4102444799):
+            iso_string = time.strftime('%Y-%m-%dT%H:%M:%S.123Z',
+                                       time.gmtime(time_t))
+            self.assertEqual(
+                cloudmonitoring_util._slow_from_rfc3339(iso_string),
+                cloudmonitoring_util._fast_from_rfc3339(iso_string))
+            self.assertEqual(
+                time_t, cloudmonitoring_util.from_rfc3339(iso_string))
+
+    def test_no_milliseconds(self):
+        self.assertEqual(
+            1456790399,
+            cloudmonitoring_util.from_rfc3339('2016-02-29T23:59:59Z'))
+
+    def test_round_trips_with_to_rfc3339(self):
+        self.assertEqual(1456704000,
+                         cloudmonitoring_util.from_rfc3339(
+                             cloudmonitoring_util.to_rfc3339(1456704000)))
+
+    def test_unusual_layouts_use_the_fallback(self):
+        for iso_string in ('2016-02-29T00:00:00.1Z',
+                           '2016-02-29 00:00:00.000Z',
+                           '2016-02-29T00:00:00+00:00',
+                           '2016-02-30T00:00:00.000Z',
+                           '2016-13-01T00:00:00.000Z',
+                           '2016-0a-01T00:00:00.000Z'):
+            self.assertIsNone(
+                cloudmonitoring_util._fast_from_rfc3339(iso_string))
+
+    def test_invalid_dates_still_raise(self):
+        with self.assertRaises(ValueError):
+            cloudmonitoring_util.from_rfc3339('2016-02-30T00:00:00.000Z')
+
+    def test_cache_is_bounded(self):
+        orig_size = cloudmonitoring_util._RFC3339_CACHE_SIZE
+        cloudmonitoring_util._RFC3339_CACHE_SIZE = 3
+        try:
+            for time_t in xrange(10):
+                self.assertEqual(time_t, cloudmonitoring_util.from_rfc3339(
+                    cloudmonitoring_util.to_rfc3339(time_t)))
+                self.assertLessEqual(
+                    len(cloudmonitoring_util._RFC3339_CACHE), 3)
+        finally:
+            cloudmonitoring_util._RFC3339_CACHE_SIZE = orig_size
+
+
+@unittest.skipUnless(os.environ.get('BENCHMARK'),
+                     'set BENCHMARK=1 to run benchmarks')
+class BenchmarkFromRfc3339(unittest.TestCase):
+    def test_fast_parser_is_faster_than_strptime(self):
+        # A million point start- and end-times: a day of minutely
+        # windows, each shared by ~350 timeseries.
+        iso_strings = [time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                                     time.gmtime(1456704000 + 60 * (i % 1440)))
+                       for i in xrange(1000000)]
+
+        start = time.time()
+        for iso_string in iso_strings:
+            cloudmonitoring_util._slow_from_rfc3339(iso_string)
+        strptime_time = time.time() - start
+
+        start = time.time()
+        for iso_string in iso_strings:
+            cloudmonitoring_util._fast_from_rfc3339(iso_string)
+        fast_time = time.time() - start
+
+        cloudmonitoring_util._RFC3339_CACHE.clear()
+        start = time.time()
+        for iso_string in iso_strings:
+            cloudmonitoring_util.from_rfc3339(iso_string)
+        cached_time = time.time() - start
+
+        print ('\nstrptime: %.3fs, fast: %.3fs, fast+cache: %.3fs'
+               % (strptime_time, fast_time, cached_time))
+        self.assertLess(fast_time, strptime_time)
+        self.assertLess(cached_time, fast_time)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,17 +13,22 @@ Here's an example of an analysis we could do here:
 import argparse
 import cgi
 import collections
+import cStringIO
 import datetime
 import email
+import email.mime.image
+import email.mime.multipart
 import email.mime.text
 import email.utils
-import hashlib
+import itertools
+import multiprocessing.pool
 import smtplib
-import subprocess
 import time
+import traceback
 
 import bq_util
 import cloudmonitoring_util
+import sparkline_util
 
 
 # Report on the previous day by default
@@ -65,54 +70,88 @@ def _convert_table_rows_to_lists(table, order):
     return retval
 
 
-def _render_sparkline(data, width=100, height=20):
-    """Given a list of values, render a sparkline to a PNG.
+# The most rows we'll put in any one table in an email.  Past this we
+# just say how many rows we left out, to keep emails a reasonable size.
+_MAX_TABLE_ROWS = 500
 
-    This takes in a list of numbers, and returns the contents of a PNG as a
-    string.  A datapoint may be None if it should be omitted.  It will return
-    None if there are not enough datapoints to make a plot.  It requires that
-    gnuplot be installed.
+_TABLE_START = ('<table cellspacing="1" cellpadding="3" border="1"'
+                '       style="table-layout:fixed;font-size:13px;'
+                '              font-family:arial,sans,sans-serif;'
+                '              border-collapse:collapse;border:1px '
+                '              solid rgb(204,204,204)">')
+
+
+class _InlineImages(object):
+    """The images to attach to an email, to be referred to by Content-ID.
+
+    An image that is used more than once -- the same sparkline in two
+    tables, say -- is only attached once.
+    """
+    def __init__(self):
+        # All the Content-IDs in this email end with this, to make them
+        # globally unique as RFC 2392 wants.
+        self._id_suffix = email.utils.make_msgid('image')[1:-1]
+        self._ids = {}          # map from image contents to its Content-ID
+        self.mimes = []
+
+    def img_tag(self, image):
+        """Return an <img> tag for the given PNG, attaching it if needed."""
+        image_id = self._ids.get(image)
+        if image_id is None:
+            image_id = '%d.%s' % (len(self.mimes), self._id_suffix)
+            self._ids[image] = image_id
+            image_mime = email.mime.image.MIMEImage(image, 'png')
+            image_mime.add_header('Content-ID', '<%s>' % image_id)
+            # Cause the images to only render inline, not as attachments
+            # (hopefully; this seems to be a bit buggy in Gmail)
+            image_mime.add_header('Content-Disposition', 'inline')
+            self.mimes.append(image_mime)
+        return '<img src="cid:%s" alt=""/>' % image_id
+
+
+def _write_table(out, table, images, max_rows=_MAX_TABLE_ROWS):
+    """Write a table, as html, to the file-like object out.
+
+    "table" is a list of lists, the first of which is the headers.
+    Cells that are lists are rendered as sparklines, and added to
+    "images", an _InlineImages.  At most max_rows rows (not counting
+    the headers) are written; we say how many we left out.
     """
-    existing_data = [datum for datum in data if datum is not None]
-    if len(existing_data) < 3:
-        return None
-    data_lines = []
-    for i, datum in enumerate(data):
-        if datum is None:
-            data_lines.append("")
-        else:
-            data_lines.append("%s %s" % (i, datum))
-    gnuplot_script = """\
-unset border
-unset xtics
-unset ytics
-unset key
-set lmargin 0
-set rmargin 0
-set tmargin 0
-set bmargin 0
-set yrange [%(ymin)s:%(ymax)s]
-set xrange [%(xmin)s:%(xmax)s]
-set terminal pngcairo size 100,20
-plot "-" using 1:2 notitle with lines linetype rgb "black"
-%(data)s
-e
-""" % {
-    'data': '\n'.join(data_lines),
-    # The bottom of the plot looks better if it has a bit of buffer around the
-    # top and bottom data points.  We force the min to be near zero so small
-    # increases to something that started out large are viewed in context.
-    'ymax': 1.05 * max(existing_data),
-    'ymin': -0.05 * max(existing_data),
-    # To make the width per time fixed, set the min and max x value so that
-    # the plot will include space for any missing data.
-    'xmin': 1,
-    'xmax': len(data),
-}
-    gnuplot_proc = subprocess.Popen(['gnuplot'], stdin=subprocess.PIPE,
-                                    stdout=subprocess.PIPE)
-    png, _ = gnuplot_proc.communicate(gnuplot_script)
-    return png
+    out.write(_TABLE_START)
+    out.write('\n<thead>\n<tr>\n')
+    for header in table[0]:
+        out.write('<th>%s</th>\n' % header)
+    out.write('</tr>\n</thead>\n<tbody>\n')
+    for row in itertools.islice(table, 1, max_rows + 1):
+        out.write('<tr>\n')
+        for col in row:
+            style = 'padding: 3px 5px 3px 8px;'
+            # If the column isn't a string, convert it to one.
+            if isinstance(col, (int, long)):
+                style += 'text-align: right;'
+            elif isinstance(col, float):
+                style += 'text-align: right;'
+                col = '%.2f' % col     # make the output reasonable
+            elif isinstance(col, list):
+                # If we get a list, plot it as a sparkline.
+                style = 'padding: 0px; text-align: center;'
+                image = sparkline_util.render_sparkline(col)
+                if image:
+                    col = images.img_tag(image)
+                else:
+                    # If the image didn't render due to insufficient
+                    # data, say so rather than leaving it out.
+                    col = '(insufficient data)'
+            else:
+                # The column was a regular string, and might have
+                # HTML-like characters, so escape those.
+                col = cgi.escape(col)
+            out.write('<td style="%s">%s</td>\n' % (style, col))
+        out.write('</tr>\n')
+    out.write('</tbody>\n</table>\n')
+    num_omitted = len(table) - 1 - max_rows
+    if num_omitted > 0:
+        out.write('<p>(%s more rows not shown)</p>\n' % num_omitted)
 
 
 def _send_email(tables, graph, to, cc=None, subject='bq data', preamble=None):
@@ -122,73 +161,32 @@ def _send_email(tables, graph, to, cc=None, subject='bq data', preamble=None):
        tables: a dict, with headings as keys, and values lists of lists of the
            form: [[1A, 1B], [2A, 2B], ...].  Can be None.  If the heading is
            the empty string, it won't be displayed.  If a table cell value is
-           itself a list, it will be plotted as a sparkline.
+           itself a list, it will be plotted as a sparkline.  Only the first
+           _MAX_TABLE_ROWS rows of each table are shown.
        graph: TODO(csilvers).  Can be None.
        to: a list of email addresses
        cc: an optional list of email addresses
        subject: subject of the email
        preamble: text to put before the table and graph.
     """
-    body = []
+    body = cStringIO.StringIO()
     if preamble:
-        body.append('<p>%s</p>' % preamble)
+        body.write('<p>%s</p>\n' % preamble)
 
     if not isinstance(tables, dict):
         tables = {'': tables}
 
-    images = []
+    images = _InlineImages()
     for heading, table in sorted(tables.iteritems()):
         if heading:
-            body.append('<h3>%s</h3>' % heading)
+            body.write('<h3>%s</h3>\n' % heading)
         if table and table[0]:
-            body.append('<table cellspacing="1" cellpadding="3" border="1"'
-                        '       style="table-layout:fixed;font-size:13px;'
-                        '              font-family:arial,sans,sans-serif;'
-                        '              border-collapse:collapse;border:1px '
-                        '              solid rgb(204,204,204)">')
-            body.append('<thead>')
-            body.append('<tr>')
-            for header in table[0]:
-                body.append('<th>%s</th>' % header)
-            body.append('</tr>')
-            body.append('</thead>')
-            body.append('<tbody>')
-            for row in table[1:]:
-                body.append('<tr>')
-                for col in row:
-                    style = 'padding: 3px 5px 3px 8px;'
-                    # If the column isn't a string, convert it to one.
-                    if isinstance(col, (int, long)):
-                        style += 'text-align: right;'
-                    elif isinstance(col, float):
-                        style += 'text-align: right;'
-                        col = '%.2f' % col     # make the output reasonable
-                    elif isinstance(col, list):
-                        # If we get a list, plot it as a sparkline.
-                        style = 'padding: 0px; text-align: center;'
-                        # Just put in a placeholder for the datum, we'll fill
-                        # in the image in _embed_images_to_mime().
-                        image = _render_sparkline(col)
-                        if image:
-                            images.append(image)
-                            col = '%s'
-                        else:
-                            # If the image didn't render due to insufficient
-                            # data, say so rather than leaving it out.
-                            col = '(insufficient data)'
-                    else:
-                        # The column was a regular string, and might have
-                        # HTML-like characters, so escape those.
-                        col = cgi.escape(col)
-                    body.append('<td style="%s">%s</td>' % (style, col))
-                body.append('</tr>')
-            body.append('</tbody>')
-            body.append('</table>')
+            _write_table(body, table, images)
 
     if graph:
         pass
 
-    msg = _embed_images_to_mime('\n'.join(body), images)
+    msg = _make_mime(body.getvalue(), images)
     msg['Subject'] = subject
     msg['From'] = '"bq-cron-reporter" <toby-admin+bq-cron@khanacademy.org>'
     msg['To'] = ', '.join(to)
@@ -259,35 +257,15 @@ def _send_table_to_stackdriver(table, metric_name, metric_label_name,
         _GOOGLE_PROJECT_ID, stackdriver_input)
 
 
-def _embed_images_to_mime(html, images):
-    """Given HTML with placeholders, insert images and return a MIME object.
-
-    "html" should be the HTML body, with %s placeholders for the images.  Other
-    % signs must be escaped as %%.  "images" should be a list of PNG images,
-    such as those read from a PNG file.  The images will then attached to the
-    message, and a MIME object will be returned.
-    """
-    if not images:
-        # For consistency, we should still do a trivial string format to
-        # unescape the % signs.  But there's no point jumping through all the
-        # hoops of making the multipart MIME.
-        return email.MIMEText.MIMEText(html % (), 'html')
-    image_tag_template = '<img src="cid:%s" alt=""/>'
-    image_tags = []
-    image_mimes = []
-    for image in images:
-        image_id = "%s@khanacademy.org" % hashlib.sha1(image).hexdigest()
-        image_tags.append(image_tag_template % image_id)
-        image_mime = email.MIMEImage.MIMEImage(image)
-        image_mime.add_header('Content-ID', '<%s>' % image_id)
-        # Cause the images to only render inline, not as attachments
-        # (hopefully; this seems to be a bit buggy in Gmail)
-        image_mime.add_header('Content-Disposition', 'inline')
-        image_mimes.append(image_mime)
-    msg_root = email.MIMEMultipart.MIMEMultipart('related')
-    msg_body = email.MIMEText.MIMEText(html % tuple(image_tags), 'html')
-    msg_root.attach(msg_body)
-    for image_mime in image_mimes:
+def _make_mime(html, images):
+    """Return a MIME object for the given HTML body and _InlineImages."""
+    if not images.mimes:
+        # There's no point jumping through all the hoops of making the
+        # multipart MIME.
+        return email.mime.text.MIMEText(html, 'html')
+    msg_root = email.mime.multipart.MIMEMultipart('related')
+    msg_root.attach(email.mime.text.MIMEText(html, 'html'))
+    for image_mime in images.mimes:
         msg_root.attach(image_mime)
     return msg_root
 
@@ -352,7 +330,8 @@ ORDER BY instance_hours DESC
     data = bq_util.query_bigquery(query)
     bq_util.save_daily_data(data, "instance_hours", yyyymmdd)
     historical_data = bq_util.process_past_data(
-        "instance_hours", date, 14, lambda row: row['url_route'])
+        "instance_hours", date, 14, 'url_route',
+        columns=('instance_hours', 'count_'))
 
     # Munge the table by adding a few columns.
     total_instance_hours = 0.0
@@ -360,7 +339,7 @@ ORDER BY instance_hours DESC
         total_instance_hours += row['instance_hours']
 
     for row in data:
-        row['%% of total'] = row['instance_hours'] / total_instance_hours * 100
+        row['% of total'] = row['instance_hours'] / total_instance_hours * 100
         row['per 1k requests'] = row['instance_hours'] / row['count_'] * 1000
         sparkline_data = []
         for old_data in historical_data:
@@ -372,7 +351,7 @@ ORDER BY instance_hours DESC
                 sparkline_data.append(None)
         row['last 2 weeks (per request)'] = sparkline_data
 
-    _ORDER = ('%% of total', 'instance_hours', 'count_', 'per 1k requests',
+    _ORDER = ('% of total', 'instance_hours', 'count_', 'per 1k requests',
               'last 2 weeks (per request)', 'url_route')
     data = _convert_table_rows_to_lists(data, _ORDER)
 
@@ -390,57 +369,57 @@ ORDER BY instance_hours DESC
                                data_col='last 2 weeks (per request)')
 
 
-def email_rpcs(date):
-    """Email RPCs-per-route report for the given datetime.date object.
+_RPC_FIELDS = ('Get', 'Put', 'Next', 'RunQuery', 'Delete', 'Commit')
 
-    Also email a more urgent message if one of the RPCs is too expensive.
-    This indicates a bug that is costing us money.
+_MICROPENNIES = '&mu;&cent;'
+
+
+def _rpcs_query(yyyymmdd):
+    """Return the query for per-route RPC counts and cost on the given day.
+
+    Each log record has a repeated elog_stats_rpc_ops field of
+    key/value pairs.  We pull out the stats we want with a conditional
+    sum WITHIN RECORD, so we read the day's logs only once, and then
+    total them up by route.
     """
-    yyyymmdd = date.strftime("%Y%m%d")
-    rpc_fields = ('Get', 'Put', 'Next', 'RunQuery', 'Delete', 'Commit')
-
-    inits = ["IFNULL(INTEGER(t%s.rpc_%s), 0) AS rpc_%s" % (name, name, name)
-             for name in rpc_fields]
-    inits.append("IFNULL(tcost.rpc_cost, 0) AS rpc_cost")
-    joins = ["LEFT OUTER JOIN ( "
-             "SELECT elog_url_route AS url_route, "
-             "       SUM(elog_stats_rpc_ops.value) as rpc_%s "
-             "FROM [logs.requestlogs_%s] "
-             "WHERE elog_stats_rpc_ops.key = 'stats.rpc_ops.%s.count' "
-             "GROUP BY url_route) AS t%s "
-             "ON t1.url_route = t%s.url_route"
-             % (name, yyyymmdd, name, name, name)
-             for name in rpc_fields]
-    joins.append("LEFT OUTER JOIN ( "
-                 "SELECT elog_url_route AS url_route, "
-                 "       SUM(elog_stats_rpc_ops.value) AS rpc_cost "
-                 "FROM [logs.requestlogs_%s] "
-                 "WHERE elog_stats_rpc_ops.key = 'stats.rpc_ops.cost' "
-                 "GROUP BY url_route) AS tcost "
-                 "ON t1.url_route = tcost.url_route"
-                 % yyyymmdd)
-    query = """\
-SELECT t1.url_route AS url_route,
-t1.url_requests AS requests,
+    per_record_sums = [
+        "SUM(IF(elog_stats_rpc_ops.key = 'stats.rpc_ops.%s.count', "
+        "elog_stats_rpc_ops.value, 0)) WITHIN RECORD AS rpc_%s"
+        % (name, name)
+        for name in _RPC_FIELDS]
+    per_record_sums.append(
+        "SUM(IF(elog_stats_rpc_ops.key = 'stats.rpc_ops.cost', "
+        "elog_stats_rpc_ops.value, 0)) WITHIN RECORD AS rpc_cost")
+
+    per_route_sums = ["IFNULL(INTEGER(SUM(rpc_%s)), 0) AS rpc_%s"
+                      % (name, name)
+                      for name in _RPC_FIELDS]
+    per_route_sums.append("IFNULL(SUM(rpc_cost), 0) AS rpc_cost")
+
+    return """\
+SELECT url_route,
+COUNT(*) AS requests,
 %s
 FROM (
-SELECT elog_url_route AS url_route, COUNT(*) AS url_requests
-FROM [logs.requestlogs_%s]
-GROUP BY url_route) AS t1
+SELECT elog_url_route AS url_route,
 %s
-ORDER BY tcost.rpc_cost DESC;
-""" % (',\n'.join(inits), yyyymmdd, '\n'.join(joins))
-    data = bq_util.query_bigquery(query)
-    bq_util.save_daily_data(data, "rpcs", yyyymmdd)
-    historical_data = bq_util.process_past_data(
-        "rpcs", date, 14, lambda row: row['url_route'])
+FROM [logs.requestlogs_%s])
+GROUP BY url_route
+ORDER BY rpc_cost DESC;
+""" % (',\n'.join(per_route_sums), ',\n'.join(per_record_sums), yyyymmdd)
+
 
+def _munge_rpcs_data(data, historical_data):
+    """Add per-request columns and sparklines to the email_rpcs rows.
+
+    Returns the table as a list of lists, with a heading row, ready to
+    be emailed.
+    """
     # Munge the table by getting per-request counts for every RPC stat.
-    micropennies = '&mu;&cent;'
     for row in data:
-        for stat in rpc_fields:
+        for stat in _RPC_FIELDS:
             row['%s/req' % stat] = row['rpc_%s' % stat] * 1.0 / row['requests']
-        row[micropennies + '/req'] = row['rpc_cost'] * 1.0 / row['requests']
+        row[_MICROPENNIES + '/req'] = row['rpc_cost'] * 1.0 / row['requests']
         row['$'] = row['rpc_cost'] * 1.0e-8
         sparkline_data = []
         for old_data in historical_data:
@@ -450,16 +429,31 @@ ORDER BY tcost.rpc_cost DESC;
                     old_row['rpc_cost'] * 1.0 / old_row['requests'])
             else:
                 sparkline_data.append(None)
-        row['last 2 weeks (%s/req)' % micropennies] = sparkline_data
+        row['last 2 weeks (%s/req)' % _MICROPENNIES] = sparkline_data
 
         del row['rpc_cost']
 
     # Convert each row from a dict to a list, in a specific order.
-    _ORDER = (['url_route', 'requests', '$', micropennies + '/req',
-               'last 2 weeks (%s/req)' % micropennies] +
-              ['rpc_%s' % f for f in rpc_fields] +
-              ['%s/req' % f for f in rpc_fields])
-    data = _convert_table_rows_to_lists(data, _ORDER)
+    _ORDER = (['url_route', 'requests', '$', _MICROPENNIES + '/req',
+               'last 2 weeks (%s/req)' % _MICROPENNIES] +
+              ['rpc_%s' % f for f in _RPC_FIELDS] +
+              ['%s/req' % f for f in _RPC_FIELDS])
+    return _convert_table_rows_to_lists(data, _ORDER)
+
+
+def email_rpcs(date):
+    """Email RPCs-per-route report for the given datetime.date object.
+
+    Also email a more urgent message if one of the RPCs is too expensive.
+    This indicates a bug that is costing us money.
+    """
+    yyyymmdd = date.strftime("%Y%m%d")
+    data = bq_util.query_bigquery(_rpcs_query(yyyymmdd))
+    bq_util.save_daily_data(data, "rpcs", yyyymmdd)
+    historical_data = bq_util.process_past_data(
+        "rpcs", date, 14, 'url_route', columns=('rpc_cost', 'requests'))
+
+    data = _munge_rpcs_data(data, historical_data)
 
     subject = 'RPC calls by route'
     heading = 'RPC calls by route for %s' % _pretty_date(yyyymmdd)
@@ -469,10 +463,10 @@ ORDER BY tcost.rpc_cost DESC;
                 subject=subject)
 
     # We'll also send the most-most expensive ones to stackdriver.
-    _send_table_to_stackdriver(data[:20],
-                               'webapp.routes.rpc_cost.week_over_week',
-                               'url_route', metric_label_col='url_route',
-                               data_col='last 2 weeks (%s/req)' % micropennies)
+    _send_table_to_stackdriver(
+        data[:20], 'webapp.routes.rpc_cost.week_over_week',
+        'url_route', metric_label_col='url_route',
+        data_col='last 2 weeks (%s/req)' % _MICROPENNIES)
 
     # As of 1 Feb 2016, the most expensive RPC route is about $300 a
     # day.  More than $750 a day and we should be very suspcious.
@@ -511,8 +505,8 @@ ORDER BY count_ DESC
     data = bq_util.query_bigquery(query)
     bq_util.save_daily_data(data, "out_of_memory_errors_by_module", yyyymmdd)
     historical_data = bq_util.process_past_data(
-        "out_of_memory_errors_by_module", date, 14,
-        lambda row: row['module_id'])
+        "out_of_memory_errors_by_module", date, 14, 'module_id',
+        columns=('count_',))
 
     for row in data:
         sparkline_data = []
@@ -549,8 +543,8 @@ ORDER BY count_ DESC
     data = bq_util.query_bigquery(query)
     bq_util.save_daily_data(data, "out_of_memory_errors_by_route", yyyymmdd)
     historical_data = bq_util.process_past_data(
-        "out_of_memory_errors_by_route", date, 14,
-        lambda row: (row['module_id'], row['url_route']))
+        "out_of_memory_errors_by_route", date, 14, ('module_id', 'url_route'),
+        columns=('count_',))
 
     for row in data:
         sparkline_data = []
@@ -674,8 +668,8 @@ ORDER BY added_total DESC
     data = bq_util.query_bigquery(query)
     bq_util.save_daily_data(data, "memory_increases", yyyymmdd)
     historical_data = bq_util.process_past_data(
-        "memory_increases", date, 14,
-        lambda row: (row['module'], row['url_route']))
+        "memory_increases", date, 14, ('module', 'url_route'),
+        columns=('added_avg',))
 
     by_module = collections.defaultdict(list)
     for row in data:
@@ -685,11 +679,11 @@ ORDER BY added_total DESC
             by_module[heading].append(row)
 
     _ORDER = ['count_', 'added_avg', 'last 2 weeks (avg)', 'added_98th',
-              'added_total', 'added %%', 'url_route']
+              'added_total', 'added %', 'url_route']
     for heading in by_module:
         total = sum(row['added_total'] for row in by_module[heading])
         for row in by_module[heading]:
-            row['added %%'] = row['added_total'] / total * 100
+            row['added %'] = row['added_total'] / total * 100
             sparkline_data = []
             for old_data in historical_data:
                 old_row = old_data.get((row['module'], row['url_route']))
@@ -746,6 +740,56 @@ ORDER BY client DESC, build DESC, request_count DESC;
                 subject=subject)
 
 
+# The reports main() runs by default, as (description, function) pairs.
+_ALL_REPORTS = (
+    ('instance hour info', email_instance_hours),
+    ('rpc stats info', email_rpcs),
+    ('out-of-memory info', email_out_of_memory_errors),
+    ('memory profiling info', email_memory_increases),
+    ('client API usage info', email_client_api_usage),
+)
+
+
+def _run_reports(reports, date):
+    """Run the given reports concurrently, for the given datetime.
+
+    Most of the time for each report is spent waiting for bigquery, so
+    we run them all at once in threads, and each report emails as soon
+    as its own data is in.  If any reports fail, we raise an exception
+    once all the others are done.
+
+    reports is a list of (description, report-function) pairs, like
+    _ALL_REPORTS.
+    """
+    def run_report(description, report_method):
+        print 'Emailing %s' % description
+        try:
+            report_method(date)
+        except Exception:
+            # We print the traceback here, since we lose it when the
+            # exception is passed back to the main thread.
+            print ('Error emailing %s:\n%s'
+                   % (description, traceback.format_exc()))
+            raise
+
+    pool = multiprocessing.pool.ThreadPool(len(reports))
+    results = [(description,
+                pool.apply_async(run_report, (description, report_method)))
+               for (description, report_method) in reports]
+    pool.close()
+
+    failures = []
+    for (description, result) in results:
+        try:
+            result.get()
+        except Exception:
+            failures.append(description)
+    pool.join()
+
+    if failures:
+        raise RuntimeError('Failed to email: %s' % ', '.join(failures))
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--date', metavar='YYYYMMDD',
@@ -766,20 +810,7 @@ def main():
         print 'Emailing %s info' % args.report
         report_method(date)
     else:
-        print 'Emailing instance hour info'
-        email_instance_hours(date)
-
-        print 'Emailing rpc stats info'
-        email_rpcs(date)
-
-        print 'Emailing out-of-memory info'
-        email_out_of_memory_errors(date)
-
-        print 'Emailing memory profiling info'
-        email_memory_increases(date)
-
-        print 'Emailing client API usage info'
-        email_client_api_usage(date)
+        _run_reports(_ALL_REPORTS, date)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,149 @@
+import cStringIO
+import email
+import threading
+import unittest
+
+import email_bq_data
+
+
+class TestRpcs(unittest.TestCase):
+    def test_query_scans_the_logs_once(self):
+        query = email_bq_data._rpcs_query('20160301')
+        self.assertEqual(1, query.count('[logs.requestlogs_20160301]'))
+        self.assertNotIn('JOIN', query)
+        self.assertIn('GROUP BY url_route', query)
+        for name in email_bq_data._RPC_FIELDS:
+            self.assertIn("'stats.rpc_ops.%s.count'" % name, query)
+            self.assertIn('AS rpc_%s' % name, query)
+        self.assertIn("'stats.rpc_ops.cost'", query)
+        self.assertIn('AS rpc_cost', query)
+
+    def test_munge(self):
+        data = [{'url_route': '/a', 'requests': 10, 'rpc_cost': 500,
+                 'rpc_Get': 20, 'rpc_Put': 5, 'rpc_Next': 0,
+                 'rpc_RunQuery': 1, 'rpc_Delete': 0, 'rpc_Commit': 5}]
+        historical_data = [{'/a': {'url_route': '/a', 'rpc_cost': 100,
+                                   'requests': 10}},
+                           {},
+                           {'/a': {'url_route': '/a', 'requests': 10}}]
+        table = email_bq_data._munge_rpcs_data(data, historical_data)
+
+        micropennies = email_bq_data._MICROPENNIES
+        self.assertEqual(['url_route', 'requests', '$', micropennies + '/req',
+                          'last 2 weeks (%s/req)' % micropennies,
+                          'rpc_Get', 'rpc_Put', 'rpc_Next', 'rpc_RunQuery',
+                          'rpc_Delete', 'rpc_Commit',
+                          'Get/req', 'Put/req', 'Next/req', 'RunQuery/req',
+                          'Delete/req', 'Commit/req'],
+                         table[0])
+        self.assertEqual(['/a', 10, 500 * 1.0e-8, 50.0, [10.0, None, None],
+                          20, 5, 0, 1, 0, 5,
+                          2.0, 0.5, 0.0, 0.1, 0.0, 0.5],
+                         table[1])
+
+
+class TestSendEmail(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        sent = self.sent
+
+        class FakeSMTP(object):
+            def __init__(self, host):
+                pass
+
+            def sendmail(self, from_addr, to_addrs, msg):
+                sent.append(email.message_from_string(msg))
+
+            def quit(self):
+                pass
+
+        self.orig_smtp = email_bq_data.smtplib.SMTP
+        email_bq_data.smtplib.SMTP = FakeSMTP
+
+    def tearDown(self):
+        email_bq_data.smtplib.SMTP = self.orig_smtp
+
+    def test_no_images(self):
+        email_bq_data._send_email(
+            {'Costs': [['% of total', 'route'], [12.5, '/a%20b<c>']]},
+            None, to=['me@example.com'])
+        [msg] = self.sent
+        self.assertEqual('text/html', msg.get_content_type())
+        html = msg.get_payload(decode=True)
+        self.assertIn('<h3>Costs</h3>', html)
+        self.assertIn('<th>% of total</th>', html)
+        self.assertIn('>12.50</td>', html)
+        self.assertIn('>/a%20b&lt;c&gt;</td>', html)
+
+    def test_identical_images_are_attached_once(self):
+        email_bq_data._send_email(
+            [['route', 'history'],
+             ['/a', [1, 2, 3]],
+             ['/b', [1, 2, 3]],
+             ['/c', [3, 2, 1]],
+             ['/d', [1, None]]],
+            None, to=['me@example.com'])
+        [msg] = self.sent
+        self.assertEqual('multipart/related', msg.get_content_type())
+        [html_part, image1, image2] = msg.get_payload()
+        html = html_part.get_payload(decode=True)
+        self.assertEqual(3, html.count('<img src="cid:'))
+        self.assertIn('(insufficient data)', html)
+        for image in (image1, image2):
+            self.assertEqual('image/png', image.get_content_type())
+            content_id = image['Content-ID'].strip('<>')
+            self.assertIn('<img src="cid:%s"' % content_id, html)
+        self.assertEqual(2, html.count(
+            '<img src="cid:%s"' % image1['Content-ID'].strip('<>')))
+
+    def test_rows_are_capped(self):
+        table = [['n']] + [[i] for i in xrange(10)]
+        out = cStringIO.StringIO()
+        email_bq_data._write_table(out, table,
+                                   email_bq_data._InlineImages(), max_rows=3)
+        html = out.getvalue()
+        self.assertEqual(3, html.count('<td '))
+        self.assertIn('>2</td>', html)
+        self.assertNotIn('>3</td>', html)
+        self.assertIn('(7 more rows not shown)', html)
+
+
+class TestRunReports(unittest.TestCase):
+    def test_reports_run_concurrently(self):
+        num_started = [0]
+        lock = threading.Lock()
+        all_started = threading.Event()
+        dates = []
+
+        def report(date):
+            with lock:
+                num_started[0] += 1
+                if num_started[0] == 3:
+                    all_started.set()
+            # If we ran the reports one at a time, this would time out.
+            self.assertTrue(all_started.wait(5))
+            dates.append(date)
+
+        email_bq_data._run_reports(
+            [('a', report), ('b', report), ('c', report)], 'DATE')
+        self.assertEqual(['DATE'] * 3, dates)
+
+    def test_failures_are_raised_after_all_reports_finish(self):
+        finished = []
+
+        def bad_report(date):
+            raise ValueError('oops')
+
+        def good_report(date):
+            finished.append(date)
+
+        with self.assertRaises(RuntimeError) as e:
+            email_bq_data._run_reports(
+                [('bad', bad_report), ('good', good_report)], 'DATE')
+        self.assertIn('bad', str(e.exception))
+        self.assertNotIn('good', str(e.exception))
+        self.assertEqual(['DATE'], finished)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,6 +8,9 @@ summary of the last week's uptime to infrastructure-blackhole.  It runs on the
 7 days preceding the current UTC-day, so it should likely be run at least 2
 hours after UTC-midnight, to ensure all the logs have made it to BQ.
 """
+import argparse
+import bisect
+import collections
 import datetime
 import email.mime.text
 import smtplib
@@ -20,6 +23,146 @@ DEFAULT_DOWN_THRESHOLD = 0.0025
 DEFAULT_SEC_PER_CHUNK = 10
 
 
+# We cache, for each day, how many requests and errors there were in
+# each BASE_SEC_PER_CHUNK-second chunk of that day.  From those we can
+# compute the uptime for any threshold, and for any chunk size that's a
+# multiple of this one, without going back to bigquery.
+BASE_SEC_PER_CHUNK = 10
+
+# The per-chunk counts for one day, to be unioned over many days with
+# bq_util.daily_tables_union.  chunk is the chunk's index since the
+# epoch.  See get_uptime_for_day for the details.
+CHUNK_COUNTS_SUBQUERY_PATTERN = """
+SELECT
+  '%%(yyyymmdd)s' AS yyyymmdd,
+  INTEGER(start_time / %(base_sec_per_chunk)s) AS chunk,
+  COUNT(*) AS reqs,
+  SUM(status >= 500) AS errs,
+FROM [logs.requestlogs_%%(yyyymmdd)s]
+WHERE
+  instance_key IS NOT NULL
+  -- We only include requests that actually started on the day in
+  -- question.  This will exclude a few stragglers, so our data might be
+  -- a little off for the last bucket of the day.
+  -- TODO(benkraft): include a little of the next day's data to fix this.
+  AND SEC_TO_TIMESTAMP(INTEGER(start_time)) > TIMESTAMP('%%(yyyy_mm_dd)s')
+  -- TODO(benkraft): exclude automated requests, priming, etc.
+GROUP BY yyyymmdd, chunk
+"""
+
+
+def get_chunk_counts_for_days(dts):
+    """Gets the per-chunk request and error counts for each given day.
+
+    Returns a list with, for each day, a map from 'chunk', 'reqs' and
+    'errs' to a list of the values of that column; there's an entry in
+    each for every BASE_SEC_PER_CHUNK-second chunk of the day that had
+    any requests.  Any days that aren't already cached are fetched with
+    a single query, and cached.
+    """
+    yyyymmdds = [dt.strftime('%Y%m%d') for dt in dts]
+    missing = sorted(set(
+        yyyymmdd for yyyymmdd in yyyymmdds
+        if not bq_util.has_daily_data('uptime_chunks', yyyymmdd)))
+    if missing:
+        subquery = CHUNK_COUNTS_SUBQUERY_PATTERN % {
+            'base_sec_per_chunk': BASE_SEC_PER_CHUNK,
+        }
+        query = 'SELECT yyyymmdd, chunk, reqs, errs FROM %s' % (
+            bq_util.daily_tables_union(subquery, missing))
+        print "-- Running query for uptime_chunks on %s days --" % (
+            len(missing))
+        print query
+        rows_by_day = {yyyymmdd: [] for yyyymmdd in missing}
+        max_rows = len(missing) * 24 * 60 * 60 / BASE_SEC_PER_CHUNK
+        for row in bq_util.query_bigquery_iter(query, max_rows=max_rows):
+            rows_by_day[str(row.pop('yyyymmdd'))].append(row)
+        for yyyymmdd in missing:
+            bq_util.save_daily_data(rows_by_day[yyyymmdd], 'uptime_chunks',
+                                    yyyymmdd)
+
+    return [bq_util.get_daily_columns('uptime_chunks', yyyymmdd,
+                                      ('chunk', 'reqs', 'errs')) or {}
+            for yyyymmdd in yyyymmdds]
+
+
+def chunk_error_ratios(chunk_counts, sec_per_chunk):
+    """Returns the sorted errs/reqs of each sec_per_chunk-second chunk.
+
+    chunk_counts is one day's entry from get_chunk_counts_for_days.
+    Only chunks with requests are included.  sec_per_chunk must be a
+    multiple of BASE_SEC_PER_CHUNK, and an integer fraction of a day.
+    """
+    if (sec_per_chunk % BASE_SEC_PER_CHUNK or
+            (24 * 60 * 60) % sec_per_chunk):
+        raise ValueError('sec_per_chunk must be a multiple of %s that '
+                         'divides a day, not %s'
+                         % (BASE_SEC_PER_CHUNK, sec_per_chunk))
+    base_chunks_per_chunk = sec_per_chunk / BASE_SEC_PER_CHUNK
+    chunks = chunk_counts.get('chunk', [])
+    reqs = chunk_counts.get('reqs', [])
+    errs = chunk_counts.get('errs', [])
+    if base_chunks_per_chunk == 1:
+        return sorted(e / float(r) for (r, e) in zip(reqs, errs))
+
+    # Days are a whole number of chunks, so this groups chunks the same
+    # way INTEGER(start_time / sec_per_chunk) would.
+    total_reqs = collections.defaultdict(int)
+    total_errs = collections.defaultdict(int)
+    for (chunk, r, e) in zip(chunks, reqs, errs):
+        total_reqs[chunk // base_chunks_per_chunk] += r
+        total_errs[chunk // base_chunks_per_chunk] += e
+    return sorted(total_errs[chunk] / float(total_reqs[chunk])
+                  for chunk in total_reqs)
+
+
+def downtime_from_error_ratios(error_ratios, sec_per_chunk,
+                               down_threshold):
+    """Returns the fraction of the day we were down, as a fraction.
+
+    error_ratios is the output of chunk_error_ratios.
+    """
+    num_down = (len(error_ratios) -
+                bisect.bisect_right(error_ratios, down_threshold))
+    return num_down / float(24 * 60 * 60 / sec_per_chunk)
+
+
+def get_uptimes_for_days(dts, sec_per_chunk, down_threshold):
+    """Gets the uptime for each of the given days, as a list of percentages.
+
+    This is the same as calling get_uptime_for_day for each day, but
+    any data that isn't already cached is fetched with a single query,
+    grouped by day, rather than a query per day.
+    """
+    yyyymmdds = [dt.strftime('%Y%m%d') for dt in dts]
+    is_default = (sec_per_chunk, down_threshold) == (DEFAULT_SEC_PER_CHUNK,
+                                                     DEFAULT_DOWN_THRESHOLD)
+    downtimes = {}
+    if is_default:
+        # We also cache just the downtime for the default parameters.
+        # This is the only data we have for days from before we cached
+        # chunk counts, and whose logs may no longer be in bigquery.
+        for yyyymmdd in yyyymmdds:
+            results = bq_util.get_daily_data('uptime', yyyymmdd)
+            if results:
+                downtimes[yyyymmdd] = results[0]['downtime']
+
+    missing = sorted(set(yyyymmdds) - set(downtimes))
+    all_chunk_counts = get_chunk_counts_for_days(
+        [datetime.datetime.strptime(yyyymmdd, '%Y%m%d')
+         for yyyymmdd in missing])
+    for (yyyymmdd, chunk_counts) in zip(missing, all_chunk_counts):
+        downtimes[yyyymmdd] = downtime_from_error_ratios(
+            chunk_error_ratios(chunk_counts, sec_per_chunk),
+            sec_per_chunk, down_threshold)
+        if is_default:
+            bq_util.save_daily_data([{'downtime': downtimes[yyyymmdd]}],
+                                    'uptime', yyyymmdd)
+
+    # Convert from a downtime fraction to an uptime percentage for display.
+    return [100 * (1 - downtimes[yyyymmdd]) for yyyymmdd in yyyymmdds]
+
+
 def get_uptime_for_day(dt, sec_per_chunk, down_threshold):
     """
     Gets the uptime for the given day, as a percentage.
@@ -52,38 +195,7 @@ def get_uptime_for_day(dt, sec_per_chunk, down_threshold):
             our baseline rate changes significantly, we may want to adjust
             this, although that will affect our historical data.
     """
-    yyyymmdd = dt.strftime('%Y%m%d')
-    yyyy_mm_dd = dt.strftime('%Y-%m-%d')
-    chunks_per_day = 24 * 60 * 60 / sec_per_chunk
-    query = """
-    SELECT COUNT(*) / %(chunks_per_day)s AS downtime
-    FROM (
-      SELECT
-        SEC_TO_TIMESTAMP(INTEGER(start_time / %(sec_per_chunk)s)
-                         * %(sec_per_chunk)s) AS t,
-        COUNT(*) AS reqs,
-        SUM(status >= 500) AS errs,
-      FROM [logs.requestlogs_%(yyyymmdd)s]
-      WHERE
-        instance_key IS NOT NULL
-        -- We only include requests that actually started on the day in
-        -- question.  This will exclude a few stragglers, so our data might be
-        -- a little off for the last bucket of the day.
-        -- TODO(benkraft): include a little of the next day's data to fix this.
-        AND SEC_TO_TIMESTAMP(INTEGER(start_time)) > TIMESTAMP('%(yyyy_mm_dd)s')
-        -- TODO(benkraft): exclude automated requests, priming, etc.
-      GROUP BY t)
-    WHERE errs / reqs > %(down_threshold)s
-    """ % {
-        'yyyymmdd': yyyymmdd,
-        'yyyy_mm_dd': yyyy_mm_dd,
-        'chunks_per_day': chunks_per_day,
-        'sec_per_chunk': sec_per_chunk,
-        'down_threshold': down_threshold,
-    }
-    results = bq_util.get_daily_data_from_disk_or_bq(query, 'uptime', yyyymmdd)
-    # Convert from a downtime fraction to an uptime percentage for display.
-    return 100 * (1 - results[0]['downtime'])
+    return get_uptimes_for_days([dt], sec_per_chunk, down_threshold)[0]
 
 
 def average_uptime_for_period(start_dt, end_dt, sec_per_chunk, down_threshold):
@@ -96,17 +208,13 @@ def average_uptime_for_period(start_dt, end_dt, sec_per_chunk, down_threshold):
     assert delta.seconds == 0
     assert delta.microseconds == 0
     assert delta.days > 0
-    uptimes = []
-    for day in xrange(delta.days):
-        uptimes.append(get_uptime_for_day(start_dt + datetime.timedelta(day),
-                                          sec_per_chunk, down_threshold))
+    uptimes = get_uptimes_for_days(
+        [start_dt + datetime.timedelta(day) for day in xrange(delta.days)],
+        sec_per_chunk, down_threshold)
     return float(sum(uptimes)) / len(uptimes)
 
 
-def _daily_uptime_table_row_data(date, sec_per_chunk, down_threshold):
-    uptime_today = get_uptime_for_day(date, sec_per_chunk, down_threshold)
-    uptime_last_week = get_uptime_for_day(date - datetime.timedelta(7),
-                                          sec_per_chunk, down_threshold)
+def _daily_uptime_table_row_data(date, uptime_today, uptime_last_week):
     if uptime_today >= uptime_last_week:
         change_style = 'color: green;'
         change_symbol = '▴'
@@ -148,6 +256,10 @@ def daily_uptime_email_body(end_date, sec_per_chunk=DEFAULT_SEC_PER_CHUNK,
     TODO(benkraft): Send a summary to slack, again once we have a better idea
     of things.
     """
+    # Get all the days we need -- the last 30 days, which includes the
+    # last two weeks -- at once.  uptimes[i] is the uptime on days[i].
+    days = [end_date - datetime.timedelta(d) for d in xrange(30, 0, -1)]
+    uptimes = get_uptimes_for_days(days, sec_per_chunk, down_threshold)
     return """
     <h3 style="text-align: center;">
         <span style="padding: 10px;">Weekly uptime: %(weekly).3f%%</span>
@@ -170,17 +282,11 @@ def daily_uptime_email_body(end_date, sec_per_chunk=DEFAULT_SEC_PER_CHUNK,
         details.
     </p>
     """ % {
-        # Super wasteful, but hey, everything is cached anyway!
-        'weekly': average_uptime_for_period(end_date - datetime.timedelta(7),
-                                            end_date, sec_per_chunk,
-                                            down_threshold),
-        'monthly': average_uptime_for_period(end_date - datetime.timedelta(30),
-                                             end_date, sec_per_chunk,
-                                             down_threshold),
+        'weekly': sum(uptimes[-7:]) / 7,
+        'monthly': sum(uptimes[-30:]) / 30,
         'table_data': ''.join(
-            _daily_uptime_table_row_data(end_date - datetime.timedelta(d),
-                                         sec_per_chunk, down_threshold)
-            for d in range(7, 0, -1)),
+            _daily_uptime_table_row_data(days[i], uptimes[i], uptimes[i - 7])
+            for i in xrange(len(days) - 7, len(days))),
         'down_threshold_pct': down_threshold * 100,
         'source_url': 'https://github.com/Khan/internal-webserver/'
                       'blob/master/gae_dashboard/email_uptime.py'
@@ -200,10 +306,64 @@ def send_uptime_email(end_date):
     s.quit()
 
 
+def sweep_uptime(end_date, num_days, secs_per_chunk, down_thresholds):
+    """Returns the average uptime for each chunk-size and threshold.
+
+    The uptime is averaged over the num_days days before end_date, and
+    returned as a map from (sec_per_chunk, down_threshold) to a
+    percentage.  This only needs bigquery for days whose chunk counts
+    aren't already cached, so we can try out lots of parameters cheaply.
+    """
+    days = [end_date - datetime.timedelta(d)
+            for d in xrange(num_days, 0, -1)]
+    all_chunk_counts = get_chunk_counts_for_days(days)
+    retval = {}
+    for sec_per_chunk in secs_per_chunk:
+        all_error_ratios = [chunk_error_ratios(chunk_counts, sec_per_chunk)
+                            for chunk_counts in all_chunk_counts]
+        for down_threshold in down_thresholds:
+            downtimes = [downtime_from_error_ratios(
+                             error_ratios, sec_per_chunk, down_threshold)
+                         for error_ratios in all_error_ratios]
+            retval[(sec_per_chunk, down_threshold)] = (
+                100 * (1 - sum(downtimes) / len(downtimes)))
+    return retval
+
+
 def main():
-    # TODO(benkraft): allow specifying a date and overriding the default
-    # parameters
-    send_uptime_email(datetime.datetime.utcnow().date())
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sweep', action='store_true',
+                        help=('Instead of sending the email, print the '
+                              'average uptime for each combination of '
+                              '--sec-per-chunk and --down-threshold'))
+    parser.add_argument('--days', type=int, default=90,
+                        help=('With --sweep, the number of days to average '
+                              'over (default %(default)s)'))
+    parser.add_argument('--sec-per-chunk', type=int, nargs='+',
+                        default=[10, 30, 60],
+                        help=('With --sweep, the chunk sizes to try; each '
+                              'must be a multiple of %s (default %%(default)s)'
+                              % BASE_SEC_PER_CHUNK))
+    parser.add_argument('--down-threshold', type=float, nargs='+',
+                        default=[0.001, 0.0025, 0.005, 0.01, 0.025],
+                        help=('With --sweep, the thresholds to try '
+                              '(default %(default)s)'))
+    args = parser.parse_args()
+
+    # TODO(benkraft): allow specifying a date
+    end_date = datetime.datetime.utcnow().date()
+    if args.sweep:
+        uptimes = sweep_uptime(end_date, args.days, args.sec_per_chunk,
+                               args.down_threshold)
+        print '%-12s %s' % ('sec/chunk', ' '.join(
+            '%10s' % down_threshold for down_threshold in args.down_threshold))
+        for sec_per_chunk in args.sec_per_chunk:
+            print '%-12s %s' % (sec_per_chunk, ' '.join(
+                '%9.3f%%' % uptimes[(sec_per_chunk, down_threshold)]
+                for down_threshold in args.down_threshold))
+    else:
+        send_uptime_email(end_date)
+
 
 if __name__ == '__main__':
     main()
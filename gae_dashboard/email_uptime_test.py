@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+import calendar
+import datetime
+import os
+import random
+import time
+import unittest
+
+import bq_util
+import email_uptime
+
+
+class TestGetUptimesForDays(unittest.TestCase):
+    def setUp(self):
+        bq_util.use_temp_data_directory(self)
+        self.orig_backend = bq_util._BACKEND
+
+    def tearDown(self):
+        bq_util.set_backend(self.orig_backend)
+
+    def _days(self, first_day, num_days):
+        return [datetime.date(2016, 3, first_day) + datetime.timedelta(d)
+                for d in xrange(num_days)]
+
+    def _chunk_rows(self, yyyymmdd, errs):
+        """Rows for consecutive chunks with 1000 reqs and the given errs."""
+        day = datetime.datetime.strptime(yyyymmdd, '%Y%m%d')
+        first_chunk = (calendar.timegm(day.timetuple()) /
+                       email_uptime.BASE_SEC_PER_CHUNK)
+        return [{'yyyymmdd': yyyymmdd, 'chunk': str(first_chunk + i),
+                 'reqs': '1000', 'errs': str(e)}
+                for (i, e) in enumerate(errs)]
+
+    def test_one_query_for_all_missing_days(self):
+        # The 2nd is already cached.
+        bq_util.save_daily_data([{'downtime': 0.5}], 'uptime', '20160302')
+        # There were no requests at all on the 3rd.
+        backend = bq_util.FakeBackend(
+            default_rows=(self._chunk_rows('20160301', [10, 1, 3]) +
+                          self._chunk_rows('20160304', [0])))
+        bq_util.set_backend(backend)
+
+        uptimes = email_uptime.get_uptimes_for_days(
+            self._days(1, 4), email_uptime.DEFAULT_SEC_PER_CHUNK,
+            email_uptime.DEFAULT_DOWN_THRESHOLD)
+
+        # Two of the 8640 chunks on the 1st were above the threshold.
+        self.assertEqual([100 * (1 - 2 / 8640.0), 50.0, 100.0, 100.0],
+                         uptimes)
+        [(_, query)] = backend.calls
+        self.assertIn('[logs.requestlogs_20160301]', query)
+        self.assertIn("TIMESTAMP('2016-03-01')", query)
+        self.assertNotIn('[logs.requestlogs_20160302]', query)
+        self.assertIn('[logs.requestlogs_20160303]', query)
+        self.assertIn('[logs.requestlogs_20160304]', query)
+
+        # Now everything is cached.
+        self.assertEqual(uptimes[0], email_uptime.get_uptime_for_day(
+            datetime.date(2016, 3, 1), email_uptime.DEFAULT_SEC_PER_CHUNK,
+            email_uptime.DEFAULT_DOWN_THRESHOLD))
+        self.assertEqual(1, len(backend.calls))
+        # Even the 3rd, which had no rows.
+        email_uptime.get_chunk_counts_for_days(self._days(3, 1))
+        self.assertEqual(1, len(backend.calls))
+
+    def test_other_parameters_are_computed_locally(self):
+        backend = bq_util.FakeBackend(
+            default_rows=self._chunk_rows('20160301', [10, 1, 3]))
+        bq_util.set_backend(backend)
+        email_uptime.get_chunk_counts_for_days(self._days(1, 1))
+        self.assertEqual(1, len(backend.calls))
+
+        day = datetime.date(2016, 3, 1)
+        self.assertEqual(100 * (1 - 1 / 8640.0),
+                         email_uptime.get_uptime_for_day(day, 10, 0.005))
+        self.assertEqual(100.0,
+                         email_uptime.get_uptime_for_day(day, 10, 0.01))
+        # With 30-second chunks, the three chunks are one chunk with an
+        # error rate of 14 / 3000.
+        self.assertEqual(100 * (1 - 1 / 2880.0),
+                         email_uptime.get_uptime_for_day(day, 30, 0.0025))
+        self.assertEqual(100.0,
+                         email_uptime.get_uptime_for_day(day, 30, 0.005))
+        self.assertEqual(1, len(backend.calls))
+        # We don't overwrite the cached downtime for the real parameters.
+        self.assertFalse(bq_util.has_daily_data('uptime', '20160301'))
+
+        with self.assertRaises(ValueError):
+            email_uptime.get_uptime_for_day(day, 15, 0.0025)
+
+    def test_sweep(self):
+        backend = bq_util.FakeBackend(
+            default_rows=(self._chunk_rows('20160301', [10, 1, 3]) +
+                          self._chunk_rows('20160302', [0])))
+        bq_util.set_backend(backend)
+        uptimes = email_uptime.sweep_uptime(
+            datetime.date(2016, 3, 3), 2, [10, 30], [0.0025, 0.005])
+        self.assertEqual(1, len(backend.calls))
+        self.assertEqual({(10, 0.0025): 100 * (1 - 1 / 8640.0),
+                          (10, 0.005): 100 * (1 - 0.5 / 8640.0),
+                          (30, 0.0025): 100 * (1 - 0.5 / 2880.0),
+                          (30, 0.005): 100.0},
+                         uptimes)
+
+    def test_email_body(self):
+        for (i, day) in enumerate(self._days(1, 30)):
+            bq_util.save_daily_data([{'downtime': i / 1000.0}],
+                                    'uptime', day.strftime('%Y%m%d'))
+        backend = bq_util.FakeBackend()
+        bq_util.set_backend(backend)
+
+        body = email_uptime.daily_uptime_email_body(
+            datetime.date(2016, 3, 31))
+
+        self.assertEqual([], backend.calls)
+        # The last week's downtime is 2.3% .. 2.9%.
+        self.assertIn('Weekly uptime: 97.400%', body)
+        self.assertIn('Monthly uptime: 98.550%', body)
+        # Each day is .7 points worse than the week before.
+        self.assertIn('<td>97.100%</td>', body)
+        self.assertEqual(7, body.count('▾0.700%'))
+
+
+@unittest.skipUnless(os.environ.get('BENCHMARK'),
+                     'set BENCHMARK=1 to run benchmarks')
+class BenchmarkSweep(unittest.TestCase):
+    def setUp(self):
+        bq_util.use_temp_data_directory(self)
+
+    def test_sweep_90_days(self):
+        end_date = datetime.date(2016, 6, 1)
+        for d in xrange(1, 91):
+            day = end_date - datetime.timedelta(d)
+            first_chunk = (calendar.timegm(day.timetuple()) /
+                           email_uptime.BASE_SEC_PER_CHUNK)
+            bq_util.save_daily_data(
+                [{'chunk': first_chunk + i, 'reqs': 1000,
+                  'errs': random.randint(0, 5)}
+                 for i in xrange(24 * 60 * 60 /
+                                 email_uptime.BASE_SEC_PER_CHUNK)],
+                'uptime_chunks', day.strftime('%Y%m%d'))
+        # Make sure we never go to bigquery.
+        orig_backend = bq_util._BACKEND
+        bq_util.set_backend(bq_util.FakeBackend())
+        try:
+            start = time.time()
+            email_uptime.sweep_uptime(end_date, 90, [10, 30, 60],
+                                      [0.001, 0.0025, 0.005, 0.01, 0.025])
+            elapsed = time.time() - start
+            self.assertEqual([], bq_util._BACKEND.calls)
+        finally:
+            bq_util.set_backend(orig_backend)
+        print '\n90-day sweep of 3 chunk sizes x 5 thresholds: %.2fs' % (
+            elapsed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,13 +11,39 @@ It's expected this script will be run periodically as a cron job every 5
 minutes.
 """
 
+import array
+import itertools
+import json
+import multiprocessing.pool
+import os
 import re
+import threading
 import time
 
 import apiclient.errors
 import cloudmonitoring_util
 
 
+# How many instances we fetch the serial port output of at once.
+_MAX_CONCURRENT_FETCHES = 16
+
+# We run every 5 minutes, so we give up on any instances we haven't
+# heard from after this many seconds, so runs don't overlap.
+_DEFAULT_DEADLINE_SECONDS = 4 * 60
+
+# The compute service isn't thread-safe, so each thread gets its own.
+_THREAD_LOCAL = threading.local()
+
+# Where we keep, for each instance, how far into its serial port output
+# we've read, and what we've learned about its health so far.
+_STATE_DB = os.path.expanduser('~/fetch_instance_stats_state.json')
+
+# The most unhealthy timestamps we remember for an instance.
+_MAX_UNHEALTHY_TIMES = 1000
+
+_TIMESTAMP_RE = re.compile(r'TIME=(\d+)')
+
+
 class GCEInstance(object):
     """Simple class to hold gce instance data."""
     def __init__(self, instance_name, zone_name):
@@ -25,38 +51,50 @@ class GCEInstance(object):
         self.zone_name = zone_name
 
 
-def _instance_is_failed(serial_port_output, unhealthy_count_threshold):
-    """Return true if instance is considered failed.
+def _parse_statuses(serial_port_output):
+    """Return the timestamps and health of the status lines in the output.
 
-    Return true if the gce instance is considered to have failed because
-    there are at least `unhealthy_count_threshold` consecutive lines indicating
-    unhealthy instance status in the most recent 1000 serial output port lines,
-    uninterrupted by a healthy status message when sorted by timestamp.
+    serial_port_output is a list of lines.  We only look at status
+    update lines -- those with a STATUS= and a TIME= -- ignoring
+    heartbeats and everything else.  We return a pair of arrays: the
+    integer timestamps of the statuses, and for each one whether it was
+    unhealthy.
     """
-    # only look at last (most recent) 1000 entries in serial port output so
-    # that the full serial port output history isn't sorted
-    serial_port_output = serial_port_output[-1000:]
-    timestamp_re = re.compile(r'TIME=(\d+)')
-    serial_port_output.sort(key=lambda l: timestamp_re.findall(l),
-                            reverse=True)
-
-    num_consecutive_unhealthy = 0
+    times = array.array('d')      # doubles hold millisecond times exactly
+    unhealthy = array.array('b')
     for line in serial_port_output:
-        if 'STATUS=HEALTH_CHECK_UNHEALTHY' in line:
-            num_consecutive_unhealthy += 1
-        elif 'STATUS=' in line:  # probably 'ALL_COMMANDS_SUCCEEDED'
-            break
+        if 'STATUS=' not in line:
+            continue
+        match = _TIMESTAMP_RE.search(line)
+        if match is None:
+            continue
+        times.append(int(match.group(1)))
+        unhealthy.append('STATUS=HEALTH_CHECK_UNHEALTHY' in line)
+    return (times, unhealthy)
 
-    return num_consecutive_unhealthy >= unhealthy_count_threshold
 
+def _latest_healthy_time(times, unhealthy, healthy_time):
+    """Return the latest timestamp of a healthy status, or healthy_time.
 
-def _get_serial_port_output_lines_from_cloud_compute(service, project_id,
-                                                     gce_instance):
-    """Return a list of serial port output lines for the gce instance.
+    times and unhealthy are as returned by _parse_statuses; healthy_time
+    is the latest healthy time we already knew about, if any.
+    """
+    for (time_t, is_unhealthy) in itertools.izip(times, unhealthy):
+        if not is_unhealthy and (healthy_time is None or
+                                 time_t > healthy_time):
+            healthy_time = time_t
+    return healthy_time
 
-    List of serial port output lines for the gce instance is ordered from
-    least recent to most recent. With each port output as a separate list
-    entry.
+
+def _get_serial_port_output_from_cloud_compute(service, project_id,
+                                               gce_instance, start=0):
+    """Return new serial port output for the gce instance.
+
+    We return the output starting at byte-offset `start`, as a triple
+    (contents, start, next).  The returned start may be later than the
+    start we asked for, if the instance no longer has the output from
+    that far back.  next is where to start from to get just the output
+    after this.  If we can't get the output, we return None.
 
     Documentation: cloud.google.com/compute/docs/reference/latest/instances
     Examples of expected serial_port_output lines:
@@ -79,13 +117,91 @@ def _get_serial_port_output_lines_from_cloud_compute(service, project_id,
     """
     request = service.instances().getSerialPortOutput(
         project=project_id, zone=gce_instance.zone_name,
-        instance=gce_instance.instance_name)
+        instance=gce_instance.instance_name, start=start)
     try:
         response = cloudmonitoring_util.execute_with_retries(request)
     # This can fail, for example when an instance is spinning up.
     except apiclient.errors.HttpError:
-        return []
-    return response['contents'].split('\n')
+        return None
+    return (response['contents'], int(response.get('start', start)),
+            int(response['next']))
+
+
+def _new_instance_state():
+    """Return the state we keep for an instance we haven't seen before.
+
+    'next' is the offset into the serial port output to read from next,
+    and 'partial_line' the end of the output we've read so far, if it
+    didn't end with a newline.  'healthy_time' is the latest timestamp
+    of a healthy status that we've seen, and 'unhealthy_times' the
+    sorted timestamps of the unhealthy statuses since then.
+    """
+    return {'next': 0, 'partial_line': '',
+            'healthy_time': None, 'unhealthy_times': []}
+
+
+def _update_instance_state(state, output):
+    """Update an instance's state with new serial port output.
+
+    output is what _get_serial_port_output_from_cloud_compute returned
+    for state['next'].  We only look at the new lines, so we never
+    re-read the whole output.
+    """
+    (contents, start, next_offset) = output
+    if next_offset < state['next']:
+        # The output went backwards, so the instance must have been
+        # recreated.  Forget everything we knew about it.
+        state.update(_new_instance_state())
+    if start != state['next']:
+        # We missed some output, so the partial line we had isn't the
+        # start of the first line here.
+        state['partial_line'] = ''
+    lines = (state['partial_line'] + contents).split('\n')
+    state['partial_line'] = lines.pop()
+    state['next'] = next_offset
+
+    (times, unhealthy) = _parse_statuses(lines)
+    # The instance was healthy at healthy_time, so it's only the
+    # unhealthy statuses after that which count.
+    healthy_time = _latest_healthy_time(times, unhealthy,
+                                        state['healthy_time'])
+    unhealthy_times = state['unhealthy_times'] + [
+        int(time_t)
+        for (time_t, is_unhealthy) in itertools.izip(times, unhealthy)
+        if is_unhealthy]
+    if healthy_time is not None:
+        state['healthy_time'] = int(healthy_time)
+        unhealthy_times = [t for t in unhealthy_times if t > healthy_time]
+    unhealthy_times.sort()
+    state['unhealthy_times'] = unhealthy_times[-_MAX_UNHEALTHY_TIMES:]
+
+
+def _instance_state_is_failed(state, unhealthy_count_threshold):
+    """Return true if the instance with this state is considered failed.
+
+    The gce instance is considered to have failed if there are at least
+    `unhealthy_count_threshold` consecutive lines indicating unhealthy
+    instance status, uninterrupted by a healthy status message when
+    sorted by timestamp.  That is, there are that many unhealthy
+    statuses timestamped after the most recent healthy one.
+    """
+    return len(state['unhealthy_times']) >= unhealthy_count_threshold
+
+
+def _read_instance_states():
+    """Return a map from instance name to its state, from _STATE_DB."""
+    if os.path.exists(_STATE_DB):
+        with open(_STATE_DB) as f:
+            return json.load(f)
+    return {}
+
+
+def _write_instance_states(states):
+    """Save the map from instance name to its state to _STATE_DB."""
+    # Write to a temp-file so a crash never leaves us a partial file.
+    with open(_STATE_DB + '.tmp', 'w') as f:
+        json.dump(states, f)
+    os.rename(_STATE_DB + '.tmp', _STATE_DB)
 
 
 def _get_instances_matching_name_from_response(instances_list_response,
@@ -116,8 +232,56 @@ def _get_instances_list_from_cloud_compute(service, project_id):
     return response
 
 
-def main(project_id, dry_run):
+def _get_thread_compute_service():
+    if not hasattr(_THREAD_LOCAL, 'service'):
+        _THREAD_LOCAL.service = cloudmonitoring_util.get_cloud_service(
+            'compute', 'v1')
+    return _THREAD_LOCAL.service
+
+
+def _get_serial_port_output_for_instance(project_id, gce_instance, start):
+    return _get_serial_port_output_from_cloud_compute(
+        _get_thread_compute_service(), project_id, gce_instance, start)
+
+
+def _get_all_serial_port_output(project_id, gce_instances, starts, deadline):
+    """Return the new serial port output for each of the gce instances.
+
+    We fetch them concurrently, each from the corresponding offset in
+    starts.  The return value is a list of the output for each
+    instance, in the same order as gce_instances, as returned by
+    _get_serial_port_output_from_cloud_compute.  It is None for any
+    instance whose output we didn't get by deadline (a time.time()
+    value).
+    """
+    if not gce_instances:
+        return []
+    pool = multiprocessing.pool.ThreadPool(
+        min(_MAX_CONCURRENT_FETCHES, len(gce_instances)))
+    try:
+        async_results = [
+            pool.apply_async(_get_serial_port_output_for_instance,
+                             (project_id, gce_instance, start))
+            for (gce_instance, start) in zip(gce_instances, starts)]
+        retval = []
+        for (gce_instance, async_result) in zip(gce_instances, async_results):
+            try:
+                retval.append(
+                    async_result.get(max(0, deadline - time.time())))
+            except multiprocessing.TimeoutError:
+                print ('Timed out getting serial port output for %s'
+                       % gce_instance.instance_name)
+                retval.append(None)
+        return retval
+    finally:
+        # Any fetches still running are abandoned; the pool's threads
+        # are daemon threads, so they won't keep us from exiting.
+        pool.terminate()
+
+
+def main(project_id, dry_run, deadline_seconds=_DEFAULT_DEADLINE_SECONDS):
     now = time.time()
+    deadline = now + deadline_seconds
 
     service = cloudmonitoring_util.get_cloud_service('compute', 'v1')
 
@@ -130,36 +294,60 @@ def main(project_id, dry_run):
     # that module in GCE instance names.
     module_id_to_name_substring = {'react-render': 'gae-react--render',
                                    'vm': 'gae-vm-'}
+    module_instances = []     # (module_id, GCEInstance) pairs
     for module_id, name_substring in module_id_to_name_substring.iteritems():
         instances = _get_instances_matching_name_from_response(
             instance_list_response, name_substring)
-
-        serial_port_output_lines = [
-            _get_serial_port_output_lines_from_cloud_compute(
-                service, project_id, instance)
-            for instance in instances
-        ]
-
-        # Number of consecutive "unhealthy" instance statuses required to
-        # consider that instance "failed".
-        unhealthy_count_threshold = 5
-
-        num_failed_instances = len(
-            [l for l in serial_port_output_lines
-             if _instance_is_failed(l, unhealthy_count_threshold)])
-
+        module_instances.extend((module_id, instance)
+                                for instance in instances)
+
+    # Fetch the new serial port output for every module's instances at
+    # once, and update what we know about each instance's health.
+    old_states = _read_instance_states()
+    states = {}
+    for (_, instance) in module_instances:
+        states[instance.instance_name] = old_states.get(
+            instance.instance_name, _new_instance_state())
+    outputs = _get_all_serial_port_output(
+        project_id, [instance for (_, instance) in module_instances],
+        [states[instance.instance_name]['next']
+         for (_, instance) in module_instances],
+        deadline)
+
+    # Number of consecutive "unhealthy" instance statuses required to
+    # consider that instance "failed".
+    unhealthy_count_threshold = 5
+
+    num_failed_instances = {module_id: 0
+                            for module_id in module_id_to_name_substring}
+    for ((module_id, instance), output) in zip(module_instances, outputs):
+        state = states[instance.instance_name]
+        # If we timed out on an instance, or couldn't get its output,
+        # we go by what we already knew about it.
+        if output is not None:
+            _update_instance_state(state, output)
+        if _instance_state_is_failed(state, unhealthy_count_threshold):
+            num_failed_instances[module_id] += 1
+
+    # We only keep state for instances that still exist.
+    if not dry_run:
+        _write_instance_states(states)
+
+    data = []
+    for (module_id, num_failed) in sorted(num_failed_instances.iteritems()):
         if dry_run:
             print ('module=%s, num_failed_instances=%s'
-                   % (module_id, num_failed_instances))
+                   % (module_id, num_failed))
             continue
+        data.append(('gce.failed_instance_count',
+                     {'module_id': module_id},
+                     num_failed,
+                     now))
 
-        # Send metric to Stackdriver.
-        data = ('gce.failed_instance_count',
-                {'module_id': module_id},
-                num_failed_instances,
-                now)
+    # Send the metrics for all the modules to Stackdriver in one call.
+    if data:
         cloudmonitoring_util.send_timeseries_to_cloudmonitoring(project_id,
-                                                                [data])
+                                                                data)
 
 
 if __name__ == '__main__':
@@ -170,5 +358,10 @@ if __name__ == '__main__':
                               'stats for (Default: %(default)s)'))
     parser.add_argument('-n', '--dry-run', action='store_true', default=False,
                         help='do not write metrics to Cloud Monitoring')
+    parser.add_argument('--deadline', type=int,
+                        default=_DEFAULT_DEADLINE_SECONDS,
+                        help=('give up on instances whose serial port output '
+                              'we have not gotten after this many seconds '
+                              '(Default: %(default)s)'))
     args = parser.parse_args()
-    main(args.project_id, args.dry_run)
+    main(args.project_id, args.dry_run, args.deadline)
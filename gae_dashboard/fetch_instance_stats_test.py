@@ -1,56 +1,182 @@
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
 import cloudmonitoring_util
 import fetch_instance_stats
 
 
+def _instance_is_failed(serial_port_output, unhealthy_count_threshold):
+    """Return whether an instance with this serial port output has failed."""
+    state = fetch_instance_stats._new_instance_state()
+    fetch_instance_stats._update_instance_state(
+        state, (serial_port_output, 0, len(serial_port_output)))
+    return fetch_instance_stats._instance_state_is_failed(
+        state, unhealthy_count_threshold)
+
+
 class TestInstanceIsFailed(unittest.TestCase):
     def test_unhealthy_over_threshold_returns_true(self):
         serial_port_output = 'TIME=10;STATUS=HEALTH_CHECK_UNHEALTHY\n' * 10
-        serial_port_output_lines = serial_port_output.split('\n')
         unhealthy_count_threshold = 5
-        self.assertTrue(fetch_instance_stats._instance_is_failed(
-            serial_port_output_lines, unhealthy_count_threshold))
+        self.assertTrue(_instance_is_failed(
+            serial_port_output, unhealthy_count_threshold))
 
     def test_unhealthy_under_threshold_returns_false(self):
         serial_port_output = 'TIME=10;STATUS=HEALTH_CHECK_UNHEALTHY\n' * 4
-        serial_port_output_lines = serial_port_output.split('\n')
         unhealthy_count_threshold = 5
-        self.assertFalse(fetch_instance_stats._instance_is_failed(
-            serial_port_output_lines, unhealthy_count_threshold))
+        self.assertFalse(_instance_is_failed(
+            serial_port_output, unhealthy_count_threshold))
 
     def test_not_unhealthy_returns_false(self):
         serial_port_output = 'TIME=10;STATUS=HEALTH_CHECK_HEALTHY\n' * 10
-        serial_port_output_lines = serial_port_output.split('\n')
         unhealthy_count_threshold = 5
-        self.assertFalse(fetch_instance_stats._instance_is_failed(
-            serial_port_output_lines, unhealthy_count_threshold))
+        self.assertFalse(_instance_is_failed(
+            serial_port_output, unhealthy_count_threshold))
 
     def test_unhealthy_long_time_ago_returns_false(self):
         serial_port_output = 'TIME=10;STATUS=HEALTH_CHECK_UNHEALTHY\n' * 10
         serial_port_output += 'TIME=20;STATUS=ALL_COMMANDS_SUCCEEDED\n' * 100
-        serial_port_output_lines = serial_port_output.split('\n')
         unhealthy_count_threshold = 5
-        self.assertFalse(fetch_instance_stats._instance_is_failed(
-            serial_port_output_lines, unhealthy_count_threshold))
+        self.assertFalse(_instance_is_failed(
+            serial_port_output, unhealthy_count_threshold))
 
     def test_out_of_order_timestamps_unhealthy_recent_returns_true(self):
         serial_port_output = 'TIME=30;STATUS=HEALTH_CHECK_UNHEALTHY\n' * 100
         serial_port_output += 'TIME=10;STATUS=HEALTH_CHECK_UNHEALTHY\n' * 10
         serial_port_output += 'TIME=20;STATUS=ALL_COMMANDS_SUCCEEDED\n' * 100
-        serial_port_output_lines = serial_port_output.split('\n')
         unhealthy_count_threshold = 5
-        self.assertTrue(fetch_instance_stats._instance_is_failed(
-            serial_port_output_lines, unhealthy_count_threshold))
+        self.assertTrue(_instance_is_failed(
+            serial_port_output, unhealthy_count_threshold))
 
     def test_out_of_order_timestamps_healthy_recent_returns_false(self):
         serial_port_output = 'TIME=30;STATUS=ALL_COMMANDS_SUCCEEDED\n' * 100
         serial_port_output += 'TIME=10;STATUS=HEALTH_CHECK_UNHEALTHY\n' * 10
         serial_port_output += 'TIME=20;STATUS=HEALTH_CHECK_UNHEALTHY\n' * 100
-        serial_port_output_lines = serial_port_output.split('\n')
         unhealthy_count_threshold = 5
-        self.assertFalse(fetch_instance_stats._instance_is_failed(
-            serial_port_output_lines, unhealthy_count_threshold))
+        self.assertFalse(_instance_is_failed(
+            serial_port_output, unhealthy_count_threshold))
+
+    def test_timestamps_are_compared_as_numbers(self):
+        # As strings, 'TIME=9' would sort after 'TIME=10'.
+        serial_port_output = 'TIME=9;STATUS=ALL_COMMANDS_SUCCEEDED\n'
+        serial_port_output += 'TIME=10;STATUS=HEALTH_CHECK_UNHEALTHY\n' * 10
+        self.assertTrue(_instance_is_failed(serial_port_output, 5))
+
+        serial_port_output = 'TIME=10;STATUS=ALL_COMMANDS_SUCCEEDED\n'
+        serial_port_output += 'TIME=9;STATUS=HEALTH_CHECK_UNHEALTHY\n' * 10
+        self.assertFalse(_instance_is_failed(serial_port_output, 5))
+
+    def test_heartbeats_are_ignored(self):
+        serial_port_output = ''
+        for i in xrange(10):
+            serial_port_output += (
+                'gcm-StatusUpdate:TIME=%s000;STATUS=HEALTH_CHECK_UNHEALTHY;'
+                'STATUS_MESSAGE=0\ngcm-Heartbeat:%s000\n' % (100 + i, 200 + i))
+        serial_port_output += ('gcm-StatusUpdate:TIME=105000;'
+                               'STATUS=ALL_COMMANDS_SUCCEEDED\n')
+        # 4 unhealthy statuses (106-109) after the healthy one.
+        self.assertTrue(_instance_is_failed(serial_port_output, 4))
+        self.assertFalse(_instance_is_failed(serial_port_output, 5))
+
+
+@unittest.skipUnless(os.environ.get('BENCHMARK'),
+                     'set BENCHMARK=1 to run benchmarks')
+class BenchmarkInstanceIsFailed(unittest.TestCase):
+    def _old_instance_is_failed(self, serial_port_output,
+                                unhealthy_count_threshold):
+        """The sort-by-regex implementation we used to have."""
+        timestamp_re = re.compile(r'TIME=(\d+)')
+        serial_port_output.sort(key=lambda l: timestamp_re.findall(l),
+                                reverse=True)
+        num_consecutive_unhealthy = 0
+        for line in serial_port_output:
+            if 'STATUS=HEALTH_CHECK_UNHEALTHY' in line:
+                num_consecutive_unhealthy += 1
+            elif 'STATUS=' in line:
+                break
+        return num_consecutive_unhealthy >= unhealthy_count_threshold
+
+    def test_100k_lines(self):
+        lines = []
+        for i in xrange(50000):
+            time_t = 1467830173000 + i * 5000
+            if i % 1000 < 990:
+                lines.append('gcm-StatusUpdate:TIME=%s;'
+                             'STATUS=ALL_COMMANDS_SUCCEEDED' % time_t)
+            else:
+                lines.append('gcm-StatusUpdate:TIME=%s;'
+                             'STATUS=HEALTH_CHECK_UNHEALTHY;'
+                             'STATUS_MESSAGE=0' % time_t)
+            lines.append('gcm-Heartbeat:%s' % time_t)
+        random.shuffle(lines)
+
+        start = time.time()
+        old_result = self._old_instance_is_failed(list(lines), 5)
+        old_time = time.time() - start
+
+        start = time.time()
+        new_result = _instance_is_failed('\n'.join(lines) + '\n', 5)
+        new_time = time.time() - start
+
+        print '\n100k lines: sort-by-regex %.3fs, parse-and-scan %.3fs' % (
+            old_time, new_time)
+        self.assertEqual(old_result, new_result)
+        self.assertLess(new_time, old_time)
+
+
+class TestUpdateInstanceState(unittest.TestCase):
+    def _update(self, state, contents, start=None):
+        if start is None:
+            start = state['next']
+        fetch_instance_stats._update_instance_state(
+            state, (contents, start, start + len(contents)))
+
+    def test_lines_split_across_reads(self):
+        state = fetch_instance_stats._new_instance_state()
+        self._update(state, 'gcm-Heartbeat:5\nTIME=10;STATUS=HEALTH_CHE')
+        self.assertEqual([], state['unhealthy_times'])
+        self._update(state, 'CK_UNHEALTHY\nTIME=20;STATUS=HEALTH_CHECK_UNH')
+        self.assertEqual([10], state['unhealthy_times'])
+        self.assertEqual('TIME=20;STATUS=HEALTH_CHECK_UNH',
+                         state['partial_line'])
+        self.assertEqual(85, state['next'])
+
+    def test_healthy_status_resets_unhealthy_count(self):
+        state = fetch_instance_stats._new_instance_state()
+        self._update(state, 'TIME=10;STATUS=HEALTH_CHECK_UNHEALTHY\n' * 10)
+        self.assertTrue(
+            fetch_instance_stats._instance_state_is_failed(state, 5))
+        self._update(state, 'TIME=20;STATUS=ALL_COMMANDS_SUCCEEDED\n')
+        self.assertFalse(
+            fetch_instance_stats._instance_state_is_failed(state, 5))
+        # Old unhealthy statuses that show up late don't count.
+        self._update(state, 'TIME=15;STATUS=HEALTH_CHECK_UNHEALTHY\n' * 10)
+        self.assertFalse(
+            fetch_instance_stats._instance_state_is_failed(state, 5))
+        self._update(state, 'TIME=30;STATUS=HEALTH_CHECK_UNHEALTHY\n' * 5)
+        self.assertTrue(
+            fetch_instance_stats._instance_state_is_failed(state, 5))
+
+    def test_missed_output_drops_partial_line(self):
+        state = fetch_instance_stats._new_instance_state()
+        self._update(state, 'TIME=10;STATUS=HEALTH_CHECK_')
+        self._update(state, 'ALL_COMMANDS_SUCCEEDED\n', start=1000)
+        self.assertIsNone(state['healthy_time'])
+        self.assertEqual(1023, state['next'])
+
+    def test_recreated_instance_starts_over(self):
+        state = fetch_instance_stats._new_instance_state()
+        self._update(state, 'TIME=10;STATUS=HEALTH_CHECK_UNHEALTHY\n' * 10)
+        fetch_instance_stats._update_instance_state(
+            state, ('TIME=5;STATUS=HEALTH_CHECK_UNHEALTHY\n', 0, 37))
+        self.assertEqual([5], state['unhealthy_times'])
+        self.assertEqual(37, state['next'])
 
 
 class TestGetInstancesFromResponse(unittest.TestCase):
@@ -101,17 +227,27 @@ class TestMain(unittest.TestCase):
             }
             return instance_list_response
 
-        def new_get_serial_port_output_lines_from_cloud_compute(service,
-                                                                project_id,
-                                                                gce_instance):
+        self.starts = []
+
+        def new_get_serial_port_output_from_cloud_compute(service,
+                                                          project_id,
+                                                          gce_instance,
+                                                          start=0):
+            self.starts.append((gce_instance.instance_name, start))
             if 'instance' in gce_instance.instance_name:
-                serial_port_output = 'STATUS=HEALTH_CHECK_UNHEALTHY\n' * 10
-                serial_port_output_lines = serial_port_output.split('\n')
-                return serial_port_output_lines
+                num_unhealthy = 10
+            else:
+                num_unhealthy = 2
+            serial_port_output = ''.join(
+                'TIME=%s;STATUS=HEALTH_CHECK_UNHEALTHY\n' % (start + i)
+                for i in xrange(num_unhealthy))
+            return (serial_port_output, start,
+                    start + len(serial_port_output))
 
-            serial_port_output = 'STATUS=HEALTH_CHECK_UNHEALTHY\n' * 2
-            serial_port_output_lines = serial_port_output.split('\n')
-            return serial_port_output_lines
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.mock(fetch_instance_stats, '_STATE_DB',
+                  os.path.join(self.tmpdir, 'state.json'))
 
         self.mock(cloudmonitoring_util.alertlib.Alert, 'send_to_stackdriver',
                   new_send_to_stackdriver)
@@ -119,8 +255,10 @@ class TestMain(unittest.TestCase):
                   '_get_instances_list_from_cloud_compute',
                   new_get_instances_list_from_cloud_compute)
         self.mock(fetch_instance_stats,
-                  '_get_serial_port_output_lines_from_cloud_compute',
-                  new_get_serial_port_output_lines_from_cloud_compute)
+                  '_get_serial_port_output_from_cloud_compute',
+                  new_get_serial_port_output_from_cloud_compute)
+        self.mock(fetch_instance_stats, '_get_thread_compute_service',
+                  lambda: None)
 
     def mock(self, container, var_str, new_value):
         if hasattr(container, var_str):
@@ -138,5 +276,95 @@ class TestMain(unittest.TestCase):
                           'vm': ('gce.failed_instance_count', 0)},
                          self.sent_to_cloud_monitoring)
 
+    def test_all_modules_are_sent_in_one_call(self):
+        calls = []
+        self.mock(cloudmonitoring_util, 'send_timeseries_to_cloudmonitoring',
+                  lambda project_id, data: calls.append((project_id, data)))
+        fetch_instance_stats.main('proj_id', False)
+        [(project_id, data)] = calls
+        self.assertEqual('proj_id', project_id)
+        self.assertEqual(
+            [('gce.failed_instance_count', {'module_id': 'react-render'}, 2),
+             ('gce.failed_instance_count', {'module_id': 'vm'}, 0)],
+            [(name, labels, value) for (name, labels, value, _) in data])
+
+    def test_second_run_only_reads_new_output(self):
+        fetch_instance_stats.main('proj_id', False)
+        fetch_instance_stats.main('proj_id', False)
+        self.assertEqual(
+            [('gae-react--render-instance1', 0),
+             ('gae-react--render-instance2', 0),
+             ('gae-react--render-instance1', 370),
+             ('gae-react--render-instance2', 370)],
+            sorted(self.starts, key=lambda (_, start): start))
+        # Both runs saw the instances as failed.
+        self.assertEqual({'react-render': ('gce.failed_instance_count', 2),
+                          'vm': ('gce.failed_instance_count', 0)},
+                         self.sent_to_cloud_monitoring)
+
+    def test_instances_are_fetched_concurrently(self):
+        num_started = [0]
+        lock = threading.Lock()
+        all_started = threading.Event()
+
+        def get_output(service, project_id, gce_instance, start=0):
+            with lock:
+                num_started[0] += 1
+                if num_started[0] == 2:
+                    all_started.set()
+            # If we fetched one instance at a time, this would time out.
+            self.assertTrue(all_started.wait(5))
+            return ('TIME=1;STATUS=HEALTH_CHECK_UNHEALTHY\n' * 10, 0, 380)
+
+        self.mock(fetch_instance_stats,
+                  '_get_serial_port_output_from_cloud_compute',
+                  get_output)
+        fetch_instance_stats.main('proj_id', False)
+        self.assertEqual(2, num_started[0])
+        self.assertEqual({'react-render': ('gce.failed_instance_count', 2),
+                          'vm': ('gce.failed_instance_count', 0)},
+                         self.sent_to_cloud_monitoring)
+
+    def test_instances_past_the_deadline_are_skipped(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def get_output(service, project_id, gce_instance, start=0):
+            if gce_instance.instance_name.endswith('instance2'):
+                release.wait(10)
+            return ('TIME=1;STATUS=HEALTH_CHECK_UNHEALTHY\n' * 10, 0, 380)
+
+        self.mock(fetch_instance_stats,
+                  '_get_serial_port_output_from_cloud_compute',
+                  get_output)
+        start = time.time()
+        fetch_instance_stats.main('proj_id', False, deadline_seconds=0.2)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual({'react-render': ('gce.failed_instance_count', 1),
+                          'vm': ('gce.failed_instance_count', 0)},
+                         self.sent_to_cloud_monitoring)
+
+    def test_failed_instance_that_times_out_is_still_failed(self):
+        fetch_instance_stats.main('proj_id', False)
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def get_output(service, project_id, gce_instance, start=0):
+            if gce_instance.instance_name.endswith('instance2'):
+                release.wait(10)
+            return ('TIME=999;STATUS=ALL_COMMANDS_SUCCEEDED\n', start,
+                    start + 39)
+
+        self.mock(fetch_instance_stats,
+                  '_get_serial_port_output_from_cloud_compute',
+                  get_output)
+        fetch_instance_stats.main('proj_id', False, deadline_seconds=0.2)
+        # instance1 is healthy now, but all we know about instance2 is
+        # that it had failed.
+        self.assertEqual({'react-render': ('gce.failed_instance_count', 1),
+                          'vm': ('gce.failed_instance_count', 0)},
+                         self.sent_to_cloud_monitoring)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -8,7 +8,9 @@ graphite under the keys
 """
 
 import functools
+import multiprocessing.pool
 import os
+import threading
 import time
 
 import cloudmonitoring_util
@@ -39,54 +41,160 @@ def _write_time_t_of_latest_record(time_t):
         print >>f, time_t
 
 
-def _get_percentiles(values):
-    """Given a list of (value, count) pairs, returns percentiles as a dict.
+# The percentiles we send to graphite for distribution-valued stats.
+_PERCENTILES = (1, 5, 25, 50, 75, 95, 99)
+
+
+class _Distribution(object):
+    """A histogram of values, stored as exponential-bucket counts.
+
+    This is how cloud-monitoring gives us distributionValues.  The
+    bucket options are a (num_finite_buckets, growth_factor, scale)
+    tuple, and counts is a list of num_finite_buckets + 2 ints: an
+    underflow bucket, the finite buckets, and an overflow bucket.  Two
+    distributions with the same bucket options can be combined by
+    adding their counts element-wise.
+
+    Different versions or modules may report different bucket options
+    for the same metric.  We keep the counts for each other set of
+    bucket options in other_layouts, a map from bucket options to a
+    _Distribution, and combine them all in value_counts().
+    """
+    # Map from bucket options to the estimated value for each bucket.
+    _BUCKET_VALUES = {}
+
+    def __init__(self, bucket_options, counts):
+        self.bucket_options = bucket_options
+        self.counts = counts
+        self.other_layouts = {}
+
+    def copy(self):
+        retval = _Distribution(self.bucket_options, list(self.counts))
+        for other in self.other_layouts.itervalues():
+            retval.add(other)
+        return retval
+
+    def add(self, other):
+        """Add the counts from another distribution into this one."""
+        for layout in [other] + other.other_layouts.values():
+            if layout.bucket_options == self.bucket_options:
+                counts = self.counts
+                for (i, count) in enumerate(layout.counts):
+                    if count:
+                        counts[i] += count
+            elif layout.bucket_options in self.other_layouts:
+                self.other_layouts[layout.bucket_options].add(layout)
+            else:
+                self.other_layouts[layout.bucket_options] = _Distribution(
+                    layout.bucket_options, list(layout.counts))
+
+    def bucket_values(self):
+        """Return a list of the estimated value of each bucket.
+
+        Since we're only given buckets and not real values, we
+        estimate each value as the midpoint of its bucket.
+        """
+        if self.bucket_options not in self._BUCKET_VALUES:
+            (num_finite_buckets, growthfactor, scale) = self.bucket_options
+            # The option exponentialBuckets defines buckets as
+            # `numFiniteBuckets + 2` (= N) buckets with these
+            # boundaries for bucket i:
+            #  Lower bound (1 <= i < N): scale * (growthFactor ^ (i - 1))
+            #  Upper bound (0 <= i < N-1): scale * (growthFactor ^ i)
+            # Note that bucket 0 is the underflow bucket, and bucket n - 1
+            # is the overflow bucket.
+            n = num_finite_buckets + 2
+            values = []
+            for i in xrange(n):
+                # For underflow buckets, assume the lowest bound is 0.
+                lower_bound = 0 if i == 0 else scale * pow(growthfactor, i - 1)
+                # For overflow buckets, be optimistic they're all *barely* over
+                upper_bound = lower_bound if i == n - 1 else (
+                    scale * pow(growthfactor, i))
+                values.append((lower_bound + upper_bound) / 2.0)
+            self._BUCKET_VALUES[self.bucket_options] = values
+        return self._BUCKET_VALUES[self.bucket_options]
+
+    def value_counts(self):
+        """Return a list of (value, count) for non-empty buckets, by value."""
+        retval = [(value, count)
+                  for (value, count) in zip(self.bucket_values(), self.counts)
+                  if count]
+        if self.other_layouts:
+            for other in self.other_layouts.itervalues():
+                retval.extend(other.value_counts())
+            retval.sort()
+        return retval
+
+
+def _get_percentiles(distribution):
+    """Given a _Distribution, returns percentiles as a dict.
 
     The dict looks like:
     {1: <value at 1st percentile>, 5: <value at 5th percentile>, ...}
+
+    We find all the percentiles in a single cumulative walk over the
+    non-empty buckets, sorted by value.
     """
-    if not values:
+    value_counts = distribution.value_counts()
+    total_count = sum(count for (_, count) in value_counts)
+    if not total_count:
         return {}
 
-    total_count = sum(c for (_, c) in values)
-    retval = {1: None, 5: None, 25: None, 50: None,
-              75: None, 95: None, 99: None}
+    retval = dict.fromkeys(_PERCENTILES)
+    percentiles = sorted(_PERCENTILES)
+    next_percentile = 0
     count_so_far = 0
-    for (i, (value, count)) in enumerate(sorted(values)):
+    for (i, (value, count)) in enumerate(value_counts):
         count_so_far += count
         pct_so_far = count_so_far * 100.0 / total_count
-        for pct in retval:
-            if pct_so_far > pct and retval[pct] is None:
+        while (next_percentile < len(percentiles) and
+               percentiles[next_percentile] <= pct_so_far):
+            pct = percentiles[next_percentile]
+            if pct_so_far == pct and i + 1 < len(value_counts):
+                # Right on the border!, so we need to average this
+                # bucket's value with that of the next non-empty bucket.
+                retval[pct] = (value + value_counts[i + 1][0]) / 2
+            else:
                 retval[pct] = value
-            elif pct_so_far == pct and retval[pct] is None:
-                # Right on the border!, so we need to average the buckets.
-                next_value = values[i + 1][1]
-                retval[pct] = (value + next_value) / 2
+            next_percentile += 1
     return retval
 
 
-_TIMESERIES = None
-_TIMESERIES_CACHE = {}      # map from fn args to returned dict.
+# How many windows' worth of data we ask cloud-monitoring for in a
+# single request.  When we're catching up after some downtime, this
+# lets us fetch each metric once for a big range of time (72 5-minute
+# windows is 6 hours) rather than once per window.
+_WINDOWS_PER_FETCH = 72
 
+# Map from (window_start_time_t, window_end_time_t) to a map from
+# (project_id, metric) to the timeSeries data for that window.
+# Windows are evicted once we've sent their data to graphite.
+_TIMESERIES_CACHE = {}
 
-def _get_timeseries(metric, project_id, start_time_t, end_time_t):
-    """service.projects().timeSeries().list() plus caching and auto-paging."""
-    global _TIMESERIES
+# The apiclient objects use httplib2, which isn't thread-safe, so
+# each fetcher thread gets its own.
+_THREAD_LOCAL = threading.local()
 
-    cache_key = (project_id, metric, start_time_t, end_time_t)
-    if cache_key in _TIMESERIES_CACHE:
-        return _TIMESERIES_CACHE[cache_key]
 
-    if _TIMESERIES is None:
+def _get_timeseries_resource():
+    """Return service.projects().timeSeries() for the current thread."""
+    if getattr(_THREAD_LOCAL, 'timeseries', None) is None:
         service = cloudmonitoring_util.get_cloud_service('monitoring', 'v3')
-        _TIMESERIES = service.projects().timeSeries()
+        _THREAD_LOCAL.timeseries = service.projects().timeSeries()
+    return _THREAD_LOCAL.timeseries
+
+
+def _fetch_timeseries(metric, project_id, start_time_t, end_time_t):
+    """service.projects().timeSeries().list() plus auto-paging."""
+    timeseries_resource = _get_timeseries_resource()
 
     retval = {'timeSeries': []}
     page_token = None
     while True:
         # TODO(csilvers): do I want to set 'window'?
         r = cloudmonitoring_util.execute_with_retries(
-            _TIMESERIES.list(
+            timeseries_resource.list(
                 name='projects/%s' % project_id,
                 filter='metric.type = "%s"' % metric,
                 interval_startTime=cloudmonitoring_util.to_rfc3339(
@@ -103,8 +211,79 @@ def _get_timeseries(metric, project_id, start_time_t, end_time_t):
         else:
             break
 
-    _TIMESERIES_CACHE[cache_key] = retval
-    return _TIMESERIES_CACHE[cache_key]
+    return retval
+
+
+def _split_timeseries_by_window(data, start_time_t, end_time_t,
+                                interval_in_seconds):
+    """Split timeSeries data for a big time-range into per-window data.
+
+    Returns a map from window-start time_t to a timeSeries dict that
+    looks just like what we would have gotten back from cloud-monitoring
+    if we had asked for just that window.  We assign each point to the
+    window its end-time falls in, treating windows as (start, end] so
+    a point that falls right on a boundary is only counted once.
+    Timeseries that have no points in a window are omitted from it.
+    """
+    retval = {window_start: {'timeSeries': []}
+              for window_start in xrange(start_time_t, end_time_t,
+                                         interval_in_seconds)}
+    for timeseries in data['timeSeries']:
+        points_by_window = {}
+        for point in timeseries['points']:
+            point_end_time = cloudmonitoring_util.from_rfc3339(
+                point['interval']['endTime'])
+            window_start = (
+                start_time_t +
+                (point_end_time - start_time_t - 1) // interval_in_seconds *
+                interval_in_seconds)
+            if window_start in retval:
+                points_by_window.setdefault(window_start, []).append(point)
+
+        for (window_start, points) in points_by_window.iteritems():
+            retval[window_start]['timeSeries'].append(
+                dict(timeseries, points=points))
+    return retval
+
+
+def _prefetch_timeseries(pool, metrics, project_id, start_time_t, end_time_t,
+                         interval_in_seconds):
+    """Fetch all the given metrics for a time-range into our cache.
+
+    Each metric is fetched with a single (auto-paged) request for the
+    whole range, and the metrics are fetched in parallel using the
+    given thread-pool.  The results are then split up into windows of
+    interval_in_seconds, so _get_timeseries() can find them.
+    """
+    fetcher = functools.partial(_fetch_timeseries,
+                                project_id=project_id,
+                                start_time_t=start_time_t,
+                                end_time_t=end_time_t)
+    all_data = pool.map(fetcher, metrics)
+
+    for (metric, data) in zip(metrics, all_data):
+        data_by_window = _split_timeseries_by_window(
+            data, start_time_t, end_time_t, interval_in_seconds)
+        for (window_start, window_data) in data_by_window.iteritems():
+            window_key = (window_start, window_start + interval_in_seconds)
+            _TIMESERIES_CACHE.setdefault(window_key, {})[
+                (project_id, metric)] = window_data
+
+
+def _evict_timeseries(start_time_t, end_time_t):
+    """Drop the cached data for a window once we're done with it."""
+    _TIMESERIES_CACHE.pop((start_time_t, end_time_t), None)
+
+
+def _get_timeseries(metric, project_id, start_time_t, end_time_t):
+    """Return timeSeries data for a window, using our cache if possible."""
+    window_cache = _TIMESERIES_CACHE.setdefault((start_time_t, end_time_t),
+                                                {})
+    cache_key = (project_id, metric)
+    if cache_key not in window_cache:
+        window_cache[cache_key] = _fetch_timeseries(
+            metric, project_id, start_time_t, end_time_t)
+    return window_cache[cache_key]
 
 
 def _get_module(timeseries):
@@ -126,13 +305,41 @@ def _parse_points(points, make_per_second=False):
     cloudmonitoring likes to give absolute counts over a time-range.
 
     If points is a distributionValue, value not a single number but a
-    list of (value, count) pairs.  Since we're only given buckets and
-    not real values, these values are estimates.
+    _Distribution holding the count in each of its buckets.
 
     See
         https://developers.google.com/resources/api-libraries/documentation/monitoring/v3/python/latest/monitoring_v3.projects.timeSeries.html
     for a description of the 'points' array.
 
+    """
+    parsed_points = _parse_points_with_intervals(points)
+    if make_per_second:
+        return _make_per_second(parsed_points)
+    return _drop_start_times(parsed_points)
+
+
+def _drop_start_times(parsed_points):
+    """Convert (start_time, end_time, value) triples to (time_t, value)."""
+    # We associate the number with the minute it *ends* on.
+    return [(end_time, value) for (_, end_time, value) in parsed_points]
+
+
+def _make_per_second(parsed_points):
+    """Like _drop_start_times, but divide each value by its time-range."""
+    retval = []
+    for (start_time, end_time, value) in parsed_points:
+        assert not isinstance(value, _Distribution), (
+            "no per-second for distributions")
+        assert end_time > start_time, (   # not a 'sum' type
+            start_time, end_time, value)
+        retval.append((end_time, value * 1.0 / (end_time - start_time)))
+    return retval
+
+
+def _parse_points_with_intervals(points):
+    """Return a list of (start_time, end_time, value) for each point.
+
+    See _parse_points for details.
     """
     retval = []
     for point in points:
@@ -153,63 +360,44 @@ def _parse_points(points, make_per_second=False):
         elif 'int64Value' in point_value:
             value = int(point_value['int64Value'])
         elif 'distributionValue' in point_value:
-            assert not make_per_second, "no per-second for distributions"
             assert 'exponentialBuckets' in point_value['distributionValue'][
                 'bucketOptions'], 'unsupported non-exponential distribution'
             # distributionValue is documented here:
             # https://developers.google.com/resources/api-libraries/documentation/monitoring/v3/python/latest/monitoring_v3.projects.timeSeries.html
-            # The option exponentialBuckets defines buckets as
-            # `numFiniteBuckets + 2` (= N) buckets with these
-            # boundaries for bucket i:
-            #  Lower bound (1 <= i < N): scale * (growthFactor ^ (i - 1))
-            #  Upper bound (0 <= i < N-1): scale * (growthFactor ^ i)
-            # Note that bucket 0 is the underflow bucket, and bucket n - 1
-            # is the overflow bucket.
+            # See _Distribution for how exponentialBuckets work.
             exponential_options = point_value['distributionValue'][
                 'bucketOptions']['exponentialBuckets']
-            n = exponential_options['numFiniteBuckets'] + 2
+            num_finite_buckets = exponential_options['numFiniteBuckets']
             # Scale is 1 if missing (empirically compared to v2 API).
-            scale = exponential_options.get('scale', 1)
-            growthfactor = exponential_options['growthFactor']
-            value = []
+            bucket_options = (num_finite_buckets,
+                              exponential_options['growthFactor'],
+                              exponential_options.get('scale', 1))
+            counts = [0] * (num_finite_buckets + 2)
             # Trailing buckets with 0 counts may be omitted; there may
             # be not buckets at all.
             for i, count in enumerate(point_value['distributionValue'].get(
                     'bucketCounts', [])):
-                count = int(count)
-                if count == 0:
-                    continue
-                # For underflow buckets, assume the lowest bound is 0.
-                lower_bound = 0 if i == 0 else scale * pow(growthfactor, i - 1)
-                # For overflow buckets, be optimistic they're all *barely* over
-                upper_bound = lower_bound if i == n - 1 else (
-                    scale * pow(growthfactor, i))
-                avg = (lower_bound + upper_bound) / 2.0
-                value.append((avg, count))
+                counts[i] = int(count)
+            value = _Distribution(bucket_options, counts)
         else:
             raise ValueError('Point %s lacks an expected value key' % point)
 
-        if make_per_second:
-            assert end_time > start_time, point   # not a 'sum' type
-            value = value * 1.0 / (end_time - start_time)
-
-        # We associate the number with the minute it *ends* on.
-        retval.append((end_time, value))
+        retval.append((start_time, end_time, value))
 
     return retval
 
 
-def _add_points(existing_points, new_points, combinator):
-    """Appends or combined all the points in new_points with existing_points.
+class _PointAccumulator(object):
+    """Combines parsed points from many timeseries, per module.
 
-    This worked on parsed points (so (time_t,value) pairs).  If an
-    existing point already exists with the same time_t as a new point,
-    we replace the existing point with the combined value of the
-    existing and new point.  If no such existing point exists, we just
-    add the new point to existing_points.
+    This works on parsed points (so (time_t, value) pairs).  Points
+    are kept in a map from time_t to value for each module, so
+    combining a new point with an existing point at the same time_t
+    is a dict lookup.  Every point added for a module is also added to
+    the grand total, which is stored under the module 'None'.
 
-    The combinator should be 'sum' for normal values and 'append' for
-    distribution values.  If there's a need for 'avg', we'll need to
+    The combinator should be 'sum' for normal values and 'merge' for
+    _Distribution values.  If there's a need for 'avg', we'll need to
     re-implement this to do proper weighting.
 
     This is used when combining points from the same module but
@@ -217,59 +405,37 @@ def _add_points(existing_points, new_points, combinator):
     timeseries-maps over the same time-period, but with different
     module and version fields.
     """
-    new_points = dict(new_points)     # convert to map from time_t -> value
-    for i in xrange(len(existing_points)):
-        (time_t, value) = existing_points[i]
-        if time_t in new_points:
-            if combinator == 'sum':
-                assert isinstance(value, (int, float)), value
-                new_value = value + new_points.pop(time_t)
-            elif combinator == 'append':
-                assert isinstance(value, list), value
-                # Same implementation!  But a more descriptive name.
-                new_value = value + new_points.pop(time_t)
-            else:
-                raise NotImplementedError("We don't support %s" % combinator)
-            existing_points[i] = (time_t, new_value)
-    existing_points.extend(sorted(new_points.iteritems()))
-
-
-def _collect_per_module_per_second(data, filter=None):
-    """Create a per-module dict of (time_t, value) pairs.
-
-    For every timeseries in 'data', which is a timeSeries object
-    returned by the cloudmonitoring API, we apply the filter (if
-    given), ignoring the timeseries if the filter returns False.
-    Then, we take every datapoint in the timeseries and add it
-    to our return value, which is a dict of module->data.  (Each
-    timeseries says what module it goes with.)
-
-    The return value also has a key of 'None', and its values
-    are the totals across all module.
-
-    This function is only appropriate for stats where cloudmonitoring
-    returns count-in-this-timerange, and we want to convert that to
-    counts-per-second.  In particular, it's not appropriate when
-    cloudmonitoring returns an average.
-
-    Arguments:
-       data: A cloudmonitoring data structure as returned by
-           service.projects().timeSeries().list(...).execute()
-       filter: a function that takes a timeseries dict and
-           returns True if we should consider that dict and
-           False else.  The timeseries dict is described at
-               https://developers.google.com/resources/api-libraries/documentation/monitoring/v3/python/latest/monitoring_v3.projects.timeSeries.html
-    """
-    retval = {}
-    for timeseries in data['timeSeries']:
-        if filter and not filter(timeseries):
-            continue
+    def __init__(self, combinator):
+        if combinator not in ('sum', 'merge'):
+            raise NotImplementedError("We don't support %s" % combinator)
+        self.combinator = combinator
+        self.points_by_module = {}    # module -> {time_t: value}
+
+    def add_points(self, module, points):
+        """Combine points into those for module and for the grand total."""
+        module_points = self.points_by_module.setdefault(module, {})
+        total_points = self.points_by_module.setdefault(None, {})
+        if self.combinator == 'sum':
+            # (Adding a non-number to 0 will raise a TypeError for us.)
+            get_module_value = module_points.get
+            get_total_value = total_points.get
+            for (time_t, value) in points:
+                module_points[time_t] = get_module_value(time_t, 0) + value
+                total_points[time_t] = get_total_value(time_t, 0) + value
+        else:
+            for (time_t, value) in points:
+                assert isinstance(value, _Distribution), value
+                # We copy so the module and the total don't share counts.
+                for combined_points in (module_points, total_points):
+                    if time_t in combined_points:
+                        combined_points[time_t].add(value)
+                    else:
+                        combined_points[time_t] = value.copy()
 
-        module = _get_module(timeseries)
-        points = _parse_points(timeseries['points'], make_per_second=True)
-        _add_points(retval.setdefault(module, []), points, 'sum')
-        _add_points(retval.setdefault(None, []), points, 'sum')  # grand total
-    return retval
+    def get_values(self):
+        """Return a map from module to a sorted list of (time_t, value)."""
+        return {module: sorted(points.iteritems())
+                for (module, points) in self.points_by_module.iteritems()}
 
 
 def _send_to_graphite_given_values(graphite_host, graphite_name, values,
@@ -303,7 +469,7 @@ def _send_to_graphite_given_values(graphite_host, graphite_name, values,
         key = 'webapp.gae.dashboard.%s' % graphite_name
         graphite_data = []
         for (time_t, value) in values:
-            if hasattr(value, '__iter__'):    # a list or the like
+            if isinstance(value, _Distribution):
                 assert '%(percentile)s' in graphite_name, graphite_name
                 percentile_map = _get_percentiles(value)
                 for (pct, pct_value) in percentile_map.iteritems():
@@ -332,285 +498,315 @@ def _send_to_graphite_given_values(graphite_host, graphite_name, values,
             return max(time_t for (_, (time_t, __)) in graphite_data)
 
 
-# This decorator marks a function that returns data suitable for
-# sending to graphite.  All functions marked with this decorator will
-# automatically be called from main(), and send data to graphite
-# with the name webapp.gae.dashboard.<string>.  By default, the
-# decorated function should return a list of (time_t, value) pairs;
-# these will be sent to graphite with the graphite-key taken from
-# the decorator argument.  The decorator-argument can include
-# the following special substrings:
-#    * '%(module_name)s': in this case, the decorated function must
-#      return a map from module-name to (time_t, value) pairs.  We
-#      will incorporate the module name into the graphite-key.  The
-#      map can include a "None" key, which will replace the
-#      "%(module_name)" component of the key with nothing.
-#    * '%(percentile)s': in this case, instead of (time_t, value)
-#      the decorated function should return (time_t, count_value_pairs)
-#      We will generate 7 different graphite stats from a given
-#      piece of data: the 1st percentile value, 5th, 25th, 50th, 75th,
-#      95th, and 99th.
+# This decorator registers a stat to send to graphite.  All stats
+# registered with this decorator will automatically be computed from
+# main(), and send data to graphite with the name
+# webapp.gae.dashboard.<string>.  Each stat is declared by:
+#    * the graphite-key (the decorator's first argument)
+#    * the cloud-monitoring metric it is computed from.  A metric of
+#      None means the stat is not implemented yet.
+#    * whether we should convert the metric's counts-over-a-time-range
+#      to per-second values.  This is only appropriate for stats where
+#      cloudmonitoring returns count-in-this-timerange; in particular,
+#      it's not appropriate when cloudmonitoring returns an average.
+#    * how to combine points from different timeseries at the same
+#      time: 'sum' or 'merge' (see _PointAccumulator).
+#    * a label filter, which is the decorated function: it takes an
+#      entry in the 'timeSeries' array, as described at
+#         https://developers.google.com/resources/api-libraries/documentation/monitoring/v3/python/latest/monitoring_v3.projects.timeSeries.html
+#      and returns True if that timeseries should count towards the
+#      stat and False else.
+# Points are combined per module, and across all modules.  The
+# decorator-argument can include the following special substrings:
+#    * '%(module_name)s': we will incorporate the module name into
+#      the graphite-key, sending one stat per module.  We will also
+#      send the total across all modules, replacing the
+#      "%(module_name)" component of the key with nothing.  Without
+#      this, we only send the total across all modules.
+#    * '%(percentile)s': in this case, the metric must have
+#      distribution values, and we will generate 7 different graphite
+#      stats from a given piece of data: the 1st percentile value,
+#      5th, 25th, 50th, 75th, 95th, and 99th.
 #    It is possible to have both %(module_name)s and %(percentile)s in a
 #    single key-name.
-_FUNC_MAP = {}     # map from graphite-name to function to call for it
-
-
-def _send_to_graphite(graphite_name):
-    def graphite_wrapper(func):
-        @functools.wraps(func)
-        def wrapper(project_id, graphite_host, start_time_t, end_time_t,
-                    verbose=False, dry_run=False):
-            """Returns the number of datapoints we sent to graphite."""
-            timeseries_getter = functools.partial(   # all but the metric
-                _get_timeseries,
-                project_id=project_id,
-                start_time_t=start_time_t,
-                end_time_t=end_time_t)
-
-            retval = func(timeseries_getter)
-
-            if dry_run:
-                graphite_host = None    # disable the actual sending
-                verbose = True          # print what we would have done
-
-            return _send_to_graphite_given_values(
-                graphite_host, graphite_name, retval, verbose=verbose)
-
-        assert graphite_name not in _FUNC_MAP, 'Dup: %s' % graphite_name
-        _FUNC_MAP[graphite_name] = wrapper
-        return wrapper
-    return graphite_wrapper
+_STATS = {}     # map from graphite-name to _Stat
 
 
-# -------------------------------------------------------------------------
-#                                  THE STATS
-# -------------------------------------------------------------------------
-
-
-@_send_to_graphite('summary.%(module_name)s.client_errors_per_second')
-def client_errors_per_second(timeseries_getter):
-    data = timeseries_getter(
-        'appengine.googleapis.com/http/server/response_count')
-
-    filter = lambda ts: (ts['metric']['labels'][
-        'response_code'].startswith('4'))  # 4xx
-
-    return _collect_per_module_per_second(data, filter)
-
-
-@_send_to_graphite('summary.%(module_name)s.server_errors_per_second')
-def server_errors_per_second(timeseries_getter):
-    data = timeseries_getter(
-        'appengine.googleapis.com/http/server/response_count')
-
-    filter = lambda ts: (ts['metric']['labels'][
-        'response_code'].startswith('5'))  # 5xx
+class _Stat(object):
+    """Simple class to hold a stat registered via _send_to_graphite."""
+    def __init__(self, graphite_name, metric, per_second, combinator,
+                 filter):
+        self.graphite_name = graphite_name
+        self.metric = metric
+        self.per_second = per_second
+        self.combinator = combinator
+        self.filter = filter
 
-    return _collect_per_module_per_second(data, filter)
 
+def _register_stat(graphite_name, metric, per_second, combinator, filter):
+    assert graphite_name not in _STATS, 'Dup: %s' % graphite_name
+    _STATS[graphite_name] = _Stat(graphite_name, metric, per_second,
+                                  combinator, filter)
 
-@_send_to_graphite('summary.%(module_name)s.requests_per_second')
-def requests_per_second(timeseries_getter):
-    # TODO(csilvers): is there a 1-to-1 correspondence between responses
-    # and requests?
-    data = timeseries_getter(
-        'appengine.googleapis.com/http/server/response_style_count')
-    return _collect_per_module_per_second(data)
 
+def _send_to_graphite(graphite_name, metric, per_second=False,
+                      combinator='sum'):
+    """Register a stat; the decorated function is its label filter."""
+    def register_stat(filter):
+        _register_stat(graphite_name, metric, per_second, combinator, filter)
+        return filter
+    return register_stat
 
-@_send_to_graphite('summary.%(module_name)s.static_requests_per_second')
-def static_requests_per_second(timeseries_getter):
-    data = timeseries_getter(
-        'appengine.googleapis.com/http/server/response_style_count')
 
-    filter = lambda ts: (ts['metric']['labels']['dynamic'] == 'false')
+def _register_unimplemented_stat(graphite_name):
+    """Register a stat we don't have a cloud-monitoring metric for yet."""
+    _register_stat(graphite_name, None, False, 'sum', None)
 
-    return _collect_per_module_per_second(data, filter)
 
+def _metrics_used_by_stats():
+    """Return a sorted list of all the metrics our stats are computed from."""
+    return sorted(set(stat.metric for stat in _STATS.itervalues()
+                      if stat.metric))
 
-@_send_to_graphite('summary.%(module_name)s.dynamic_requests_per_second')
-def dynamic_requests_per_second(timeseries_getter):
-    data = timeseries_getter(
-        'appengine.googleapis.com/http/server/response_style_count')
 
-    filter = lambda ts: (ts['metric']['labels']['dynamic'] == 'true')
+def _compute_stats(stats, timeseries_getter):
+    """Compute the values for the given stats from cloud-monitoring data.
 
-    return _collect_per_module_per_second(data, filter)
-
-
-@_send_to_graphite('summary.%(module_name)s.cached_requests_per_second')
-def cached_requests_per_second(timeseries_getter):
-    data = timeseries_getter(
-        'appengine.googleapis.com/http/server/response_style_count')
-
-    filter = lambda ts: (ts['metric']['labels']['cached'] == 'true')
-
-    return _collect_per_module_per_second(data, filter)
+    We fetch and parse each metric's timeSeries only once, no matter
+    how many stats use it, and route each parsed timeseries to every
+    stat whose filter accepts it.
 
+    Arguments:
+       stats: a list of _Stat objects.
+       timeseries_getter: a function that takes a metric and returns
+           the timeSeries data for it, as returned by
+           service.projects().timeSeries().list(...).execute()
 
-@_send_to_graphite(
-    'summary.%(module_name)s.milliseconds_per_dynamic_request.%(percentile)s')
-def milliseconds_per_dynamic_request(timeseries_getter):
-    data = timeseries_getter(
-        'appengine.googleapis.com/http/server/response_latencies')
+    Returns a map from graphite-name to the values to send for that
+    stat: a map from module-name to a list of (time_t, value) pairs,
+    or just the list of pairs for the total across all modules if the
+    graphite-name doesn't have a '%(module_name)s'.
+    """
+    stats_by_metric = {}
+    for stat in stats:
+        if stat.metric:      # None means 'not implemented yet'
+            stats_by_metric.setdefault(stat.metric, []).append(stat)
+
+    accumulators = {}
+    for (metric, metric_stats) in stats_by_metric.iteritems():
+        for stat in metric_stats:
+            accumulators[stat.graphite_name] = _PointAccumulator(
+                stat.combinator)
+
+        data = timeseries_getter(metric)
+        for timeseries in data['timeSeries']:
+            matching_stats = [stat for stat in metric_stats
+                              if stat.filter(timeseries)]
+            if not matching_stats:
+                continue
+
+            module = _get_module(timeseries)
+            parsed_points = _parse_points_with_intervals(timeseries['points'])
+            points = per_second_points = None
+            for stat in matching_stats:
+                if stat.per_second:
+                    if per_second_points is None:
+                        per_second_points = _make_per_second(parsed_points)
+                    stat_points = per_second_points
+                else:
+                    if points is None:
+                        points = _drop_start_times(parsed_points)
+                    stat_points = points
+                accumulators[stat.graphite_name].add_points(module,
+                                                            stat_points)
 
     retval = {}
-    for timeseries in data['timeSeries']:
-        if timeseries['metric']['labels']['loading'] == 'true':
-            # TODO(csilvers): this is really
-            # "milliseconds_per_non_loading_request().  Figure out how
-            # to filter out non-dynamic!
-            continue
-
-        module = _get_module(timeseries)
-        points = _parse_points(timeseries['points'])
-        _add_points(retval.setdefault(module, []), points, 'append')
-        _add_points(retval.setdefault(None, []), points, 'append')
-
+    for (graphite_name, accumulator) in accumulators.iteritems():
+        values = accumulator.get_values()
+        if '%(module_name)s' not in graphite_name:
+            values = values.get(None)
+        retval[graphite_name] = values
     return retval
 
 
-@_send_to_graphite(
-    'summary.%(module_name)s.milliseconds_per_loading_request.%(percentile)s')
-def milliseconds_per_loading_request(timeseries_getter):
-    data = timeseries_getter(
-        'appengine.googleapis.com/http/server/response_latencies')
+# -------------------------------------------------------------------------
+#                                  THE STATS
+# -------------------------------------------------------------------------
 
-    retval = {}
-    for timeseries in data['timeSeries']:
-        if timeseries['metric']['labels']['loading'] != 'true':
-            continue
 
-        module = _get_module(timeseries)
-        points = _parse_points(timeseries['points'])
-        _add_points(retval.setdefault(module, []), points, 'append')
-        _add_points(retval.setdefault(None, []), points, 'append')
+@_send_to_graphite('summary.%(module_name)s.client_errors_per_second',
+                   'appengine.googleapis.com/http/server/response_count',
+                   per_second=True)
+def _is_client_error(timeseries):
+    return timeseries['metric']['labels']['response_code'].startswith('4')
 
-    return retval
 
+@_send_to_graphite('summary.%(module_name)s.server_errors_per_second',
+                   'appengine.googleapis.com/http/server/response_count',
+                   per_second=True)
+def _is_server_error(timeseries):
+    return timeseries['metric']['labels']['response_code'].startswith('5')
 
-@_send_to_graphite('summary.%(module_name)s.quota_denials_per_second')
-def quota_denials_per_second(timeseries_getter):
-    data = timeseries_getter(
-        'appengine.googleapis.com/http/server/quota_denial_count')
-    return _collect_per_module_per_second(data)
 
+# TODO(csilvers): is there a 1-to-1 correspondence between responses
+# and requests?
+@_send_to_graphite('summary.%(module_name)s.requests_per_second',
+                   'appengine.googleapis.com/http/server/response_style_count',
+                   per_second=True)
+def _all_requests(timeseries):
+    return True
 
-@_send_to_graphite('summary.%(module_name)s.dos_api_denials_per_second')
-def dos_api_denials_per_second(timeseries_getter):
-    data = timeseries_getter(
-        'appengine.googleapis.com/http/server/dos_intercept_count')
-    return _collect_per_module_per_second(data)
 
+@_send_to_graphite('summary.%(module_name)s.static_requests_per_second',
+                   'appengine.googleapis.com/http/server/response_style_count',
+                   per_second=True)
+def _is_static_request(timeseries):
+    return timeseries['metric']['labels']['dynamic'] == 'false'
 
-@_send_to_graphite('summary.%(module_name)s.bytes_sent_per_second')
-def bytes_sent_per_second(timeseries_getter):
-    # TODO(csilvers): should I filter out cached responses?
-    data = timeseries_getter(
-        'appengine.googleapis.com/system/network/sent_bytes_count')
-    return _collect_per_module_per_second(data)
 
+@_send_to_graphite('summary.%(module_name)s.dynamic_requests_per_second',
+                   'appengine.googleapis.com/http/server/response_style_count',
+                   per_second=True)
+def _is_dynamic_request(timeseries):
+    return timeseries['metric']['labels']['dynamic'] == 'true'
 
-@_send_to_graphite('summary.%(module_name)s.bytes_received_per_second')
-def bytes_received_per_second(timeseries_getter):
-    # TODO(csilvers): figure out what 'cached' means here.
-    data = timeseries_getter(
-        'appengine.googleapis.com/system/network/received_bytes_count')
-    return _collect_per_module_per_second(data)
 
+@_send_to_graphite('summary.%(module_name)s.cached_requests_per_second',
+                   'appengine.googleapis.com/http/server/response_style_count',
+                   per_second=True)
+def _is_cached_request(timeseries):
+    return timeseries['metric']['labels']['cached'] == 'true'
 
-@_send_to_graphite('summary.%(module_name)s.total_instance_count')
-def total_instance_count(timeseries_getter):
-    data = timeseries_getter(
-        'appengine.googleapis.com/system/instance_count')
-
-    # Can't use _collect_per_module_per_second because we're not per-second.
-    retval = {}
-    for timeseries in data['timeSeries']:
-        module = _get_module(timeseries)
-        points = _parse_points(timeseries['points'])
-        _add_points(retval.setdefault(module, []), points, 'sum')
-        _add_points(retval.setdefault(None, []), points, 'sum')  # grand total
-    return retval
 
+# TODO(csilvers): this is really
+# "milliseconds_per_non_loading_request().  Figure out how
+# to filter out non-dynamic!
+@_send_to_graphite(
+    'summary.%(module_name)s.milliseconds_per_dynamic_request.%(percentile)s',
+    'appengine.googleapis.com/http/server/response_latencies',
+    combinator='merge')
+def _is_non_loading_request(timeseries):
+    return timeseries['metric']['labels']['loading'] != 'true'
 
-@_send_to_graphite('summary.%(module_name)s.active_instance_count')
-def active_instance_count(timeseries_getter):
-    data = timeseries_getter(
-        'appengine.googleapis.com/system/instance_count')
 
-    retval = {}
-    for timeseries in data['timeSeries']:
-        if timeseries['metric']['labels']['state'] != 'active':
-            continue
-        module = _get_module(timeseries)
-        points = _parse_points(timeseries['points'])
-        _add_points(retval.setdefault(module, []), points, 'sum')
-        _add_points(retval.setdefault(None, []), points, 'sum')  # grand total
-    return retval
+@_send_to_graphite(
+    'summary.%(module_name)s.milliseconds_per_loading_request.%(percentile)s',
+    'appengine.googleapis.com/http/server/response_latencies',
+    combinator='merge')
+def _is_loading_request(timeseries):
+    return timeseries['metric']['labels']['loading'] == 'true'
 
 
-@_send_to_graphite('summary.%(module_name)s.billed_instance_count')
-def billed_instance_count(timeseries_getter):
-    return None      # not implemented yet :-(
+@_send_to_graphite('summary.%(module_name)s.quota_denials_per_second',
+                   'appengine.googleapis.com/http/server/quota_denial_count',
+                   per_second=True)
+def _all_quota_denials(timeseries):
+    return True
 
 
-@_send_to_graphite('memcache.hit_count')
-def memcache_hit_count(timeseries_getter):
-    return None
+@_send_to_graphite('summary.%(module_name)s.dos_api_denials_per_second',
+                   'appengine.googleapis.com/http/server/dos_intercept_count',
+                   per_second=True)
+def _all_dos_api_denials(timeseries):
+    return True
 
 
-@_send_to_graphite('memcache.hit_ratio')
-def memcache_hit_ratio(timeseries_getter):
-    return None
+# TODO(csilvers): should I filter out cached responses?
+@_send_to_graphite('summary.%(module_name)s.bytes_sent_per_second',
+                   'appengine.googleapis.com/system/network/sent_bytes_count',
+                   per_second=True)
+def _all_sent_bytes(timeseries):
+    return True
 
 
-@_send_to_graphite('memcache.item_count')
-def memcache_item_count(timeseries_getter):
-    return None
+# TODO(csilvers): figure out what 'cached' means here.
+@_send_to_graphite(
+    'summary.%(module_name)s.bytes_received_per_second',
+    'appengine.googleapis.com/system/network/received_bytes_count',
+    per_second=True)
+def _all_received_bytes(timeseries):
+    return True
 
 
-@_send_to_graphite('memcache.miss_count')
-def memcache_miss_count(timeseries_getter):
-    return None
+@_send_to_graphite('summary.%(module_name)s.total_instance_count',
+                   'appengine.googleapis.com/system/instance_count')
+def _all_instances(timeseries):
+    return True
 
 
-@_send_to_graphite('memcache.oldest_item_age_seconds')
-def memcache_oldest_item_age_seconds(timeseries_getter):
-    return None
+@_send_to_graphite('summary.%(module_name)s.active_instance_count',
+                   'appengine.googleapis.com/system/instance_count')
+def _is_active_instance(timeseries):
+    return timeseries['metric']['labels']['state'] == 'active'
 
 
-@_send_to_graphite('memcache.total_cache_size_bytes')
-def memcache_total_cache_size_bytes(timeseries_getter):
-    return None
+# These are not implemented yet :-(
+_register_unimplemented_stat('summary.%(module_name)s.billed_instance_count')
+_register_unimplemented_stat('memcache.hit_count')
+_register_unimplemented_stat('memcache.hit_ratio')
+_register_unimplemented_stat('memcache.item_count')
+_register_unimplemented_stat('memcache.miss_count')
+_register_unimplemented_stat('memcache.oldest_item_age_seconds')
+_register_unimplemented_stat('memcache.total_cache_size_bytes')
 
 
 def main(project_id, graphite_host, interval_in_seconds=300,
-         verbose=False, dry_run=False):
+         verbose=False, dry_run=False, num_threads=4):
     start_time_t = _time_t_of_latest_record() or _NOW - 86400 * 30
     end_time_t = _NOW
 
+    if dry_run:
+        graphite_host = None    # disable the actual sending
+        verbose = True          # print what we would have done
+
+    metrics = _metrics_used_by_stats()
+    fetch_range_in_seconds = interval_in_seconds * _WINDOWS_PER_FETCH
+    pool = multiprocessing.pool.ThreadPool(num_threads)
+
     last_time_t_seen = start_time_t
-    for range_start in xrange(start_time_t, end_time_t, interval_in_seconds):
-        range_end = range_start + interval_in_seconds
-        for (name, stat_func) in _FUNC_MAP.iteritems():
+    for fetch_start in xrange(start_time_t, end_time_t,
+                              fetch_range_in_seconds):
+        range_starts = range(fetch_start,
+                             min(fetch_start + fetch_range_in_seconds,
+                                 end_time_t),
+                             interval_in_seconds)
+        fetch_end = range_starts[-1] + interval_in_seconds
+        if verbose:
+            print ("Fetching %s metrics from %s - %s"
+                   % (len(metrics), fetch_start, fetch_end))
+        _prefetch_timeseries(pool, metrics, project_id,
+                             fetch_start, fetch_end, interval_in_seconds)
+
+        for range_start in range_starts:
+            range_end = range_start + interval_in_seconds
             if verbose:
-                print ("Calculating stats for %s from %s - %s"
-                       % (name, range_start, range_end))
-            this_last_time_t = stat_func(project_id, graphite_host,
-                                         range_start, range_end,
-                                         verbose=verbose, dry_run=dry_run)
-            if this_last_time_t:     # can be None for 'not implemented yet'
-                last_time_t_seen = max(last_time_t_seen, this_last_time_t)
-
-        if dry_run:
-            print ("Would update last-processed-time from %s to %s"
-                   % (_time_t_of_latest_record(), last_time_t_seen))
-        else:
-            print ("Updating last-processed-time from %s to %s"
-                   % (_time_t_of_latest_record(), last_time_t_seen))
-            _write_time_t_of_latest_record(last_time_t_seen)
+                print ("Calculating stats from %s - %s"
+                       % (range_start, range_end))
+            timeseries_getter = functools.partial(   # all but the metric
+                _get_timeseries,
+                project_id=project_id,
+                start_time_t=range_start,
+                end_time_t=range_end)
+            all_values = _compute_stats(_STATS.values(), timeseries_getter)
+
+            for (name, values) in sorted(all_values.iteritems()):
+                this_last_time_t = _send_to_graphite_given_values(
+                    graphite_host, name, values, verbose=verbose)
+                if this_last_time_t:     # can be None if there's no data
+                    last_time_t_seen = max(last_time_t_seen, this_last_time_t)
+            _evict_timeseries(range_start, range_end)
 
+            if dry_run:
+                print ("Would update last-processed-time from %s to %s"
+                       % (_time_t_of_latest_record(), last_time_t_seen))
+            else:
+                print ("Updating last-processed-time from %s to %s"
+                       % (_time_t_of_latest_record(), last_time_t_seen))
+                # Make sure graphite has everything we're recording.
+                graphite_util.flush()
+                _write_time_t_of_latest_record(last_time_t_seen)
+
+    pool.close()
     print "Done!"
 
 
@@ -629,6 +825,10 @@ if __name__ == '__main__':
                         default=300,
                         help=('Process this many minutes of logs at a time '
                               '(Default: %(default)s)'))
+    parser.add_argument('--threads', type=int, default=4,
+                        help=('How many metrics to fetch from '
+                              'cloud-monitoring in parallel '
+                              '(Default: %(default)s)'))
     parser.add_argument('--verbose', '-v', action='store_true',
                         help="Show more information about what we're doing.")
     parser.add_argument('--dry-run', '-n', action='store_true',
@@ -636,4 +836,4 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     main(args.project_id, args.graphite_host, args.interval,
-         args.verbose, args.dry_run)
+         args.verbose, args.dry_run, args.threads)
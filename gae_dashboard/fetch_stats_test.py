@@ -0,0 +1,359 @@
+import os
+import time
+import unittest
+
+import fetch_stats
+
+
+def _to_rfc3339(time_t):
+    """Format a time_t the way cloud-monitoring does, with milliseconds."""
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(time_t))
+
+
+def _make_timeseries(module, version, response_code, time_ts, value):
+    """Return a fake timeSeries entry, as returned by cloud-monitoring."""
+    points = []
+    for time_t in time_ts:
+        points.append({
+            'interval': {
+                'startTime': _to_rfc3339(time_t - 60),
+                'endTime': _to_rfc3339(time_t),
+            },
+            'value': {'int64Value': str(value)},
+        })
+    return {
+        'resource': {'labels': {'module_id': module, 'version_id': version}},
+        'metric': {'labels': {'response_code': response_code}},
+        'points': points,
+    }
+
+
+def _make_parsed_points(num_timeseries, num_points):
+    """Return a list of (module, [(time_t, value), ...]) pairs.
+
+    Each timeseries has a point a minute, and each starts 10 minutes
+    after the one before, like versions being deployed over the
+    course of a backfill.
+    """
+    return [('module%d' % (i % 5),
+             [(600 * i + 60 * j, i) for j in xrange(num_points)])
+            for i in xrange(num_timeseries)]
+
+
+def _quadratic_add_points(existing_points, new_points):
+    """The list-based 'sum' merge that _PointAccumulator replaced."""
+    new_points = dict(new_points)
+    for i in xrange(len(existing_points)):
+        (time_t, value) = existing_points[i]
+        if time_t in new_points:
+            existing_points[i] = (time_t, value + new_points.pop(time_t))
+    existing_points.extend(sorted(new_points.iteritems()))
+
+
+class TestPointAccumulator(unittest.TestCase):
+    def test_sums_points_per_module_and_total(self):
+        accumulator = fetch_stats._PointAccumulator('sum')
+        accumulator.add_points('default', [(60, 1), (120, 2)])
+        accumulator.add_points('default', [(120, 3), (180, 4)])
+        accumulator.add_points('batch', [(60, 10)])
+        self.assertEqual({'default': [(60, 1), (120, 5), (180, 4)],
+                          'batch': [(60, 10)],
+                          None: [(60, 11), (120, 5), (180, 4)]},
+                         accumulator.get_values())
+
+    def test_merges_distributions_without_sharing_counts(self):
+        accumulator = fetch_stats._PointAccumulator('merge')
+        options = (2, 2, 1)
+        accumulator.add_points(
+            'default',
+            [(60, fetch_stats._Distribution(options, [1, 2, 0, 0]))])
+        accumulator.add_points(
+            'batch',
+            [(60, fetch_stats._Distribution(options, [0, 1, 1, 0]))])
+        values = accumulator.get_values()
+        self.assertEqual([1, 2, 0, 0], values['default'][0][1].counts)
+        self.assertEqual([0, 1, 1, 0], values['batch'][0][1].counts)
+        self.assertEqual([1, 3, 1, 0], values[None][0][1].counts)
+
+    def test_merges_distributions_with_different_buckets(self):
+        accumulator = fetch_stats._PointAccumulator('merge')
+        accumulator.add_points(
+            'default',
+            [(60, fetch_stats._Distribution((2, 2, 1), [1, 2, 0, 0]))])
+        accumulator.add_points(
+            'batch',
+            [(60, fetch_stats._Distribution((3, 2, 10), [0, 1, 1, 0, 0]))])
+        accumulator.add_points(
+            'batch',
+            [(60, fetch_stats._Distribution((2, 2, 1), [0, 0, 1, 0]))])
+        values = accumulator.get_values()
+        self.assertEqual([(3.0, 1), (15.0, 1), (30.0, 1)],
+                         values['batch'][0][1].value_counts())
+        self.assertEqual([(0.5, 1), (1.5, 2), (3.0, 1), (15.0, 1),
+                          (30.0, 1)],
+                         values[None][0][1].value_counts())
+        self.assertEqual([(0.5, 1), (1.5, 2)],
+                         values['default'][0][1].value_counts())
+
+    def test_values_are_sorted_by_time(self):
+        accumulator = fetch_stats._PointAccumulator('sum')
+        accumulator.add_points('default', [(180, 1), (60, 1)])
+        accumulator.add_points('default', [(120, 1)])
+        self.assertEqual([60, 120, 180],
+                         [t for (t, _) in accumulator.get_values()[None]])
+
+    def test_unknown_combinator(self):
+        with self.assertRaises(NotImplementedError):
+            fetch_stats._PointAccumulator('avg')
+
+
+class TestGetPercentiles(unittest.TestCase):
+    def test_bucket_values(self):
+        distribution = fetch_stats._Distribution((3, 2, 10), [0] * 5)
+        # Underflow, 3 finite buckets, and an overflow bucket.
+        self.assertEqual([5.0, 15.0, 30.0, 60.0, 80.0],
+                         distribution.bucket_values())
+
+    def test_percentiles(self):
+        # 100 values: 10 in the first bucket, 80 in the second, 10 in
+        # the overflow bucket.
+        distribution = fetch_stats._Distribution((3, 2, 10),
+                                                 [10, 80, 0, 0, 10])
+        self.assertEqual({1: 5.0, 5: 5.0, 25: 15.0, 50: 15.0, 75: 15.0,
+                          95: 80.0, 99: 80.0},
+                         fetch_stats._get_percentiles(distribution))
+
+    def test_border_averages_with_next_nonempty_bucket(self):
+        # Exactly 50% of values are in the first bucket.
+        distribution = fetch_stats._Distribution((3, 2, 10),
+                                                 [1, 0, 1, 0, 0])
+        percentiles = fetch_stats._get_percentiles(distribution)
+        self.assertEqual((5.0 + 30.0) / 2, percentiles[50])
+        self.assertEqual(5.0, percentiles[25])
+        self.assertEqual(30.0, percentiles[75])
+
+    def test_percentiles_across_bucket_layouts(self):
+        distribution = fetch_stats._Distribution((3, 2, 10),
+                                                 [1, 0, 0, 0, 0])
+        distribution.add(fetch_stats._Distribution((2, 10, 1),
+                                                   [0, 0, 2, 1]))
+        # The values are 5.0, 55.0 (twice), and the overflow's 100.0.
+        self.assertEqual({1: 5.0, 5: 5.0, 25: (5.0 + 55.0) / 2, 50: 55.0,
+                          75: (55.0 + 100.0) / 2, 95: 100.0, 99: 100.0},
+                         fetch_stats._get_percentiles(distribution))
+
+    def test_empty_distribution(self):
+        distribution = fetch_stats._Distribution((3, 2, 10), [0] * 5)
+        self.assertEqual({}, fetch_stats._get_percentiles(distribution))
+
+    def test_parse_distribution_point(self):
+        point = {
+            'interval': {'startTime': _to_rfc3339(0),
+                         'endTime': _to_rfc3339(60)},
+            'value': {'distributionValue': {
+                'bucketOptions': {'exponentialBuckets': {
+                    'numFiniteBuckets': 3, 'growthFactor': 2, 'scale': 10}},
+                # Trailing empty buckets are omitted.
+                'bucketCounts': ['1', '2'],
+            }},
+        }
+        [(time_t, distribution)] = fetch_stats._parse_points([point])
+        self.assertEqual(60, time_t)
+        self.assertEqual((3, 2, 10), distribution.bucket_options)
+        self.assertEqual([1, 2, 0, 0, 0], distribution.counts)
+
+
+class TestComputeStats(unittest.TestCase):
+    def setUp(self):
+        self.data = {'timeSeries': [
+            _make_timeseries('default', 'v1', '404', [60, 120], 60),
+            _make_timeseries('default', 'v2', '404', [120], 120),
+            _make_timeseries('batch', 'v1', '500', [60], 600),
+        ]}
+        self.fetched_metrics = []
+
+    def _getter(self, metric):
+        self.fetched_metrics.append(metric)
+        return self.data
+
+    def _stat(self, name, response_code_prefix, per_second=True):
+        return fetch_stats._Stat(
+            name, 'response_count', per_second, 'sum',
+            lambda ts: ts['metric']['labels']['response_code'].startswith(
+                response_code_prefix))
+
+    def test_filter_and_per_second(self):
+        retval = fetch_stats._compute_stats(
+            [self._stat('%(module_name)s.client_errors', '4')], self._getter)
+        self.assertEqual({'%(module_name)s.client_errors': {
+            'default': [(60, 1.0), (120, 3.0)],
+            None: [(60, 1.0), (120, 3.0)]}},
+            retval)
+
+    def test_stats_sharing_a_metric_fetch_it_once(self):
+        retval = fetch_stats._compute_stats(
+            [self._stat('client_errors', '4'),
+             self._stat('server_errors', '5'),
+             self._stat('responses', '', per_second=False)],
+            self._getter)
+        self.assertEqual(['response_count'], self.fetched_metrics)
+        self.assertEqual({'client_errors': [(60, 1.0), (120, 3.0)],
+                          'server_errors': [(60, 10.0)],
+                          'responses': [(60, 660), (120, 180)]},
+                         retval)
+
+    def test_unimplemented_stats_are_skipped(self):
+        retval = fetch_stats._compute_stats(
+            [fetch_stats._Stat('memcache.hit_count', None, False, 'sum',
+                               None)],
+            self._getter)
+        self.assertEqual({}, retval)
+        self.assertEqual([], self.fetched_metrics)
+
+    def test_registered_stats(self):
+        stat = fetch_stats._STATS[
+            'summary.%(module_name)s.active_instance_count']
+        self.assertEqual('appengine.googleapis.com/system/instance_count',
+                         stat.metric)
+        self.assertIs(fetch_stats._is_active_instance, stat.filter)
+        self.assertIsNone(fetch_stats._STATS['memcache.hit_count'].metric)
+        self.assertNotIn(None, fetch_stats._metrics_used_by_stats())
+
+
+def _end_times(window_data):
+    """Return [(module, [point end-time, ...]), ...] for a window."""
+    return [(fetch_stats._get_module(timeseries),
+             [point['interval']['endTime'] for point in timeseries['points']])
+            for timeseries in window_data['timeSeries']]
+
+
+class TestSplitTimeseriesByWindow(unittest.TestCase):
+    def test_points_on_window_boundaries(self):
+        data = {'timeSeries': [
+            _make_timeseries('default', 'v1', '200',
+                             [600, 601, 660, 661, 720], 1)]}
+        retval = fetch_stats._split_timeseries_by_window(data, 600, 720, 60)
+        # Windows are (start, end], so a point ending at 660 is in the
+        # window that starts at 600, and one ending at 600 is in the
+        # window before our range.
+        self.assertEqual(
+            {600: [('default', [_to_rfc3339(601), _to_rfc3339(660)])],
+             660: [('default', [_to_rfc3339(661), _to_rfc3339(720)])]},
+            {window_start: _end_times(window_data)
+             for (window_start, window_data) in retval.iteritems()})
+
+    def test_points_outside_the_range_are_dropped(self):
+        data = {'timeSeries': [
+            _make_timeseries('default', 'v1', '200', [0, 540, 721, 6000], 1),
+            _make_timeseries('batch', 'v1', '200', [630], 1)]}
+        retval = fetch_stats._split_timeseries_by_window(data, 600, 720, 60)
+        # Timeseries with no points in a window are left out of it.
+        self.assertEqual(
+            {600: [('batch', [_to_rfc3339(630)])], 660: []},
+            {window_start: _end_times(window_data)
+             for (window_start, window_data) in retval.iteritems()})
+
+    def test_many_windows(self):
+        timeseries = _make_timeseries('default', 'v1', '200',
+                                      range(630, 3600, 60), 7)
+        data = {'timeSeries': [timeseries]}
+        retval = fetch_stats._split_timeseries_by_window(data, 600, 3600, 60)
+        self.assertEqual(range(600, 3600, 60), sorted(retval))
+        for (window_start, window_data) in retval.iteritems():
+            [window_timeseries] = window_data['timeSeries']
+            # Everything but the points is the same as the original.
+            self.assertEqual(dict(timeseries, points=None),
+                             dict(window_timeseries, points=None))
+            self.assertEqual([_to_rfc3339(window_start + 30)],
+                             [point['interval']['endTime']
+                              for point in window_timeseries['points']])
+
+
+class _SerialPool(object):
+    """Stands in for a thread-pool, running everything in this thread."""
+    def map(self, fn, iterable):
+        return map(fn, iterable)
+
+
+class TestPrefetchTimeseries(unittest.TestCase):
+    def setUp(self):
+        self.fetches = []
+        self.orig_fetch_timeseries = fetch_stats._fetch_timeseries
+        fetch_stats._fetch_timeseries = self._fetch_timeseries
+        fetch_stats._TIMESERIES_CACHE.clear()
+
+    def tearDown(self):
+        fetch_stats._fetch_timeseries = self.orig_fetch_timeseries
+        fetch_stats._TIMESERIES_CACHE.clear()
+
+    def _fetch_timeseries(self, metric, project_id, start_time_t,
+                          end_time_t):
+        self.fetches.append((metric, start_time_t, end_time_t))
+        return {'timeSeries': [
+            _make_timeseries(metric, 'v1', '200',
+                             range(start_time_t + 60, end_time_t + 1, 60),
+                             1)]}
+
+    def test_prefetch_fills_the_cache(self):
+        fetch_stats._prefetch_timeseries(
+            _SerialPool(), ['requests', 'latencies'], 'proj', 600, 780, 60)
+        self.assertEqual([('requests', 600, 780), ('latencies', 600, 780)],
+                         self.fetches)
+
+        data = fetch_stats._get_timeseries('latencies', 'proj', 660, 720)
+        self.assertEqual([('latencies', [_to_rfc3339(720)])],
+                         _end_times(data))
+        # That came from the cache.
+        self.assertEqual(2, len(self.fetches))
+
+    def test_windows_not_prefetched_are_fetched(self):
+        fetch_stats._prefetch_timeseries(
+            _SerialPool(), ['requests'], 'proj', 600, 780, 60)
+        fetch_stats._get_timeseries('requests', 'proj', 780, 840)
+        fetch_stats._get_timeseries('latencies', 'proj', 600, 660)
+        self.assertEqual([('requests', 780, 840), ('latencies', 600, 660)],
+                         self.fetches[1:])
+
+    def test_evict(self):
+        fetch_stats._prefetch_timeseries(
+            _SerialPool(), ['requests'], 'proj', 600, 780, 60)
+        fetch_stats._evict_timeseries(600, 660)
+        self.assertEqual([(660, 720), (720, 780)],
+                         sorted(fetch_stats._TIMESERIES_CACHE))
+
+        # Once evicted, we have to fetch the window again.
+        fetch_stats._get_timeseries('requests', 'proj', 600, 660)
+        self.assertEqual(('requests', 600, 660), self.fetches[-1])
+        # Evicting a window we don't have is fine.
+        fetch_stats._evict_timeseries(6000, 6060)
+
+
+@unittest.skipUnless(os.environ.get('BENCHMARK'),
+                     'set BENCHMARK=1 to run benchmarks')
+class BenchmarkPointAccumulator(unittest.TestCase):
+    def test_accumulator_is_faster_than_list_merge(self):
+        # 300 module/version/response-code series with 12 hours of
+        # minutely points each, spread over a 2.5-day backfill.
+        all_points = _make_parsed_points(300, 720)
+
+        start = time.time()
+        retval = {}
+        for (module, points) in all_points:
+            _quadratic_add_points(retval.setdefault(module, []), points)
+            _quadratic_add_points(retval.setdefault(None, []), points)
+        list_merge_time = time.time() - start
+
+        start = time.time()
+        accumulator = fetch_stats._PointAccumulator('sum')
+        for (module, points) in all_points:
+            accumulator.add_points(module, points)
+        accumulator.get_values()
+        accumulator_time = time.time() - start
+
+        print ('\nlist merge: %.3fs, accumulator: %.3fs'
+               % (list_merge_time, accumulator_time))
+        self.assertLess(accumulator_time, list_merge_time)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -200,6 +200,7 @@ def main(graphite_host, verbose=False, dry_run=False):
 
         print "Parsed usage records for %s" % date_string
         if not dry_run:
+            graphite_util.flush()
             _write_date_of_latest_record(date_string)
         start_date += datetime.timedelta(days=1)
 
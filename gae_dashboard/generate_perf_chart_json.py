@@ -99,6 +99,92 @@ FROM [logs.requestlogs_%(yyyymmdd)s]
 WHERE status=200 AND elog_url_route="%(elog_url_route)s" %(country_filter)s
 """
 
+# The same stats as LATENCY_QUERY_PATTERN, for many routes and days
+# at once.  We use this to fill the cache that get_series_data reads.
+BATCHED_LATENCY_QUERY_PATTERN = """
+SELECT
+  yyyymmdd,
+  elog_url_route,
+  COUNT(*) as count,
+  NTH(10, QUANTILES(latency)) as latency_10th,
+  NTH(50, QUANTILES(latency)) as latency_50th,
+  NTH(90, QUANTILES(latency)) as latency_90th,
+  NTH(95, QUANTILES(latency)) as latency_95th,
+  NTH(99, QUANTILES(latency)) as latency_99th,
+FROM %(daily_tables)s
+GROUP BY yyyymmdd, elog_url_route
+"""
+
+BATCHED_LATENCY_SUBQUERY_PATTERN = """
+SELECT '%%(yyyymmdd)s' AS yyyymmdd, elog_url_route, latency
+FROM [logs.requestlogs_%%(yyyymmdd)s]
+WHERE status=200 AND elog_url_route IN (%(elog_url_routes)s) %(country_filter)s
+"""
+
+
+def _country_filter_and_file_suffix(country):
+    if country == 'world':
+        return ('', '')
+    return ("AND elog_country='%s'" % country, country)
+
+
+def prefill_series_data(latency_queries, end_date, country='world',
+                        preceding_days=14):
+    """Cache all the data get_series_data needs, using a single query.
+
+    Without this, get_series_data runs a query for every day that
+    isn't already in the bq_util cache, for each route: 360 queries
+    for a cold cache.  Instead, we find which (route, day) pairs are
+    missing from the cache, get them all in one query grouped by route
+    and day, and save each group as its own day's cache entry, exactly
+    as get_series_data would have.
+
+    latency_queries is a list of (report, elog_url_route) pairs, like
+    LATENCY_QUERIES.
+    """
+    (country_filter, file_suffix) = _country_filter_and_file_suffix(country)
+
+    missing = []     # (report, elog_url_route, yyyymmdd) triples
+    for i in xrange(-preceding_days, 1):
+        old_date = end_date + datetime.timedelta(days=i)
+        old_yyyymmdd = old_date.strftime('%Y%m%d')
+        for (report, elog_url_route) in latency_queries:
+            if not bq_util.has_daily_data(report + file_suffix, old_yyyymmdd):
+                missing.append((report, elog_url_route, old_yyyymmdd))
+    if not missing:
+        return
+
+    elog_url_routes = sorted(set(route for (_, route, _) in missing))
+    yyyymmdds = sorted(set(yyyymmdd for (_, _, yyyymmdd) in missing))
+    subquery = BATCHED_LATENCY_SUBQUERY_PATTERN % {
+        'elog_url_routes': ', '.join('"%s"' % r for r in elog_url_routes),
+        'country_filter': country_filter,
+    }
+    query = BATCHED_LATENCY_QUERY_PATTERN % {
+        'daily_tables': bq_util.daily_tables_union(subquery, yyyymmdds),
+    }
+    print "-- Running query for %s days of %s routes (%s) --" % (
+        len(yyyymmdds), len(elog_url_routes), country)
+    print query
+    results = bq_util.query_bigquery(query)
+
+    rows_by_route_and_day = {}
+    for row in results:
+        key = (row.pop('elog_url_route'), str(row.pop('yyyymmdd')))
+        rows_by_route_and_day[key] = row
+
+    for (report, elog_url_route, yyyymmdd) in missing:
+        row = rows_by_route_and_day.get((elog_url_route, yyyymmdd))
+        if row is None:
+            # No requests for this route that day.  A query for just
+            # this route and day would give a count of 0, and nulls
+            # for the rest.
+            row = {'count': 0}
+            for column in ('latency_10th', 'latency_50th', 'latency_90th',
+                           'latency_95th', 'latency_99th'):
+                row[column] = '(None)'
+        bq_util.save_daily_data([row], report + file_suffix, yyyymmdd)
+
 
 def get_series_data(report, query_pattern, elog_url_route,
                     end_date, country='world', preceding_days=14):
@@ -110,11 +196,7 @@ def get_series_data(report, query_pattern, elog_url_route,
     Returned as a dict of column name in the query to a list of
     (datetime, value) pairs of that column over time.
     """
-    country_filter = ''
-    file_suffix = ''
-    if country != 'world':
-        country_filter = "AND elog_country='%s'" % country
-        file_suffix = country
+    (country_filter, file_suffix) = _country_filter_and_file_suffix(country)
 
     series = collections.defaultdict(list)
     for i in xrange(-preceding_days, 1):
@@ -127,12 +209,8 @@ def get_series_data(report, query_pattern, elog_url_route,
             'country_filter': country_filter
         }
 
-        # TODO(mattfaus): You could do this in a single query by doing
-        # FROM table_date_range(logs.requestlogs_, start, end) and adding the
-        # YYYYMMDD as a column and grouping by that. Hopefully BigQuery would
-        # parallelize these groups well and return faster than the sum of these
-        # individual queries. Be careful with the on-disk caching mechanics
-        # inside bq_util, though.
+        # Call prefill_series_data() first to get all the days for
+        # all the routes in a single query, rather than one per day here.
         daily_data = bq_util.get_daily_data_from_disk_or_bq(
             query, report + file_suffix, old_yyyymmdd)
         assert len(daily_data) == 1, daily_data
@@ -153,6 +231,8 @@ def query_and_write_data(date, country):
     """
     charts_data = []
 
+    prefill_series_data(LATENCY_QUERIES, date, country)
+
     for report, elog_url_route in LATENCY_QUERIES:
         series_data = get_series_data(report, LATENCY_QUERY_PATTERN,
                                       elog_url_route, date, country)
@@ -0,0 +1,74 @@
+import datetime
+import unittest
+
+import bq_util
+import generate_perf_chart_json
+
+
+def _latency_row(count, latency):
+    return {'count': str(count), 'latency_10th': str(latency),
+            'latency_50th': str(latency), 'latency_90th': str(latency),
+            'latency_95th': str(latency), 'latency_99th': str(latency)}
+
+
+class TestPrefillSeriesData(unittest.TestCase):
+    def setUp(self):
+        bq_util.use_temp_data_directory(self)
+        self.orig_backend = bq_util._BACKEND
+        self.queries = (('task_latency', 'api.main:/task'),
+                        ('badges_latency', 'api.main:/badges'))
+        self.end_date = datetime.datetime(2016, 3, 3)
+
+    def tearDown(self):
+        bq_util.set_backend(self.orig_backend)
+
+    def test_one_query_fills_every_missing_day(self):
+        # badges_latency for the 2nd is already cached.
+        bq_util.save_daily_data([{'count': 7, 'latency_10th': 1.0,
+                                  'latency_50th': 1.0, 'latency_90th': 1.0,
+                                  'latency_95th': 1.0, 'latency_99th': 1.0}],
+                                'badges_latencyCN', '20160302')
+        rows = []
+        for yyyymmdd in ('20160301', '20160302', '20160303'):
+            row = _latency_row(10, 0.5)
+            row.update({'yyyymmdd': yyyymmdd,
+                        'elog_url_route': 'api.main:/task'})
+            rows.append(row)
+        # No badges requests on the 3rd, so bigquery returns no group.
+        row = _latency_row(20, 0.25)
+        row.update({'yyyymmdd': '20160301',
+                    'elog_url_route': 'api.main:/badges'})
+        rows.append(row)
+        backend = bq_util.FakeBackend(default_rows=rows)
+        bq_util.set_backend(backend)
+
+        generate_perf_chart_json.prefill_series_data(
+            self.queries, self.end_date, 'CN', preceding_days=2)
+
+        [(call_type, query)] = backend.calls
+        self.assertEqual('query', call_type)
+        self.assertIn("elog_country='CN'", query)
+        self.assertIn('[logs.requestlogs_20160301]', query)
+        self.assertIn('[logs.requestlogs_20160303]', query)
+
+        # Now get_series_data doesn't need to run any queries at all.
+        series = generate_perf_chart_json.get_series_data(
+            'badges_latency', generate_perf_chart_json.LATENCY_QUERY_PATTERN,
+            'api.main:/badges', self.end_date, 'CN', preceding_days=2)
+        self.assertEqual(1, len(backend.calls))
+        self.assertEqual([20, 7, 0], [v for (_, v) in series['count']])
+        self.assertEqual([0.25, 1.0, '(None)'],
+                         [v for (_, v) in series['latency_50th']])
+
+    def test_nothing_missing_means_no_query(self):
+        backend = bq_util.FakeBackend()
+        bq_util.set_backend(backend)
+        for (report, _) in self.queries:
+            bq_util.save_daily_data([{'count': 1}], report, '20160303')
+        generate_perf_chart_json.prefill_series_data(
+            self.queries, self.end_date, preceding_days=0)
+        self.assertEqual([], backend.calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
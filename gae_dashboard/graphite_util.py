@@ -4,16 +4,22 @@ Graphite is our timeseries-graphing tool.  We send statistics from
 the GAE admin dashboard to graphite in order to graph them.
 """
 
+import atexit
 import cPickle
 import datetime
+import errno
+import fcntl
 import httplib
 import json
 import logging
 import os
+import select
 import socket
 import struct
+import time
 import urllib
 import urllib2
+import zlib
 
 
 def _retry(fn, description, exceptions_to_retry, retry_count=3):
@@ -86,12 +92,278 @@ def fetch(graphite_host, targets, from_str=None):
         raise
 
 
+def _read_api_key():
+    """Load the api key that we need to send data to graphite."""
+    # This will (properly) raise an exception if this file isn't installed
+    # (based on the contents of webapp secrets.py).
+    with open(os.path.expanduser('~/hostedgraphite_secret')) as f:
+        return f.read().strip()
+
+
+class GraphiteSender(object):
+    """Sends records to one graphite host over a persistent connection.
+
+    Records are buffered, and sent in pickle batches of at most
+    max_batch_size records whenever the buffer fills up, whenever the
+    oldest buffered record is more than max_batch_age seconds old, or
+    when flush() is called.  We flush all senders at exit, but callers
+    that record their progress somewhere should call flush() first.
+
+    Each batch is written to an on-disk spool before we try to send
+    it, and only deleted from the spool once it has been sent.  If
+    graphite is down, the batch stays spooled and is sent -- in order,
+    before anything newer -- the next time any sender for this host
+    flushes, even from a later run.  So once flush() returns, the
+    records are safe even if graphite never saw them.  After a failed
+    send we wait drain_retry_interval seconds before trying graphite
+    again, rather than blocking every flush on a dead host.  We only
+    look at the spool when we know, or at startup suspect, that it has
+    something in it, so a healthy sender doesn't touch the disk except
+    to spool.  The spool holds the records without our api-key; we add
+    it when sending.
+
+    This is not thread-safe.
+    """
+    def __init__(self, graphite_host, max_batch_size=500, max_batch_age=10,
+                 spool_dir=None, drain_retry_interval=60):
+        self.graphite_host = graphite_host
+        self.max_batch_size = max_batch_size
+        self.max_batch_age = max_batch_age
+        self.drain_retry_interval = drain_retry_interval
+        self.spool_dir = spool_dir or os.path.join(
+            os.path.expanduser('~/graphite_spool'),
+            graphite_host.replace(':', '_'))
+        self._api_key = None
+        self._address = None
+        self._socket = None
+        self._records = []
+        self._oldest_record_time = None
+        self._num_segments_written = 0
+        # A previous run may have left segments in the spool.
+        self._spool_may_have_segments = True
+        # When graphite is down, we don't try to reach it again until then.
+        self._next_drain_time = 0
+
+    def _get_address(self):
+        if self._address is None:
+            (hostname, port_string) = self.graphite_host.split(':')
+            self._address = (socket.gethostbyname(hostname), int(port_string))
+        return self._address
+
+    def _connect(self):
+        graphite_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            graphite_socket.connect(self._get_address())
+        except socket.error:
+            graphite_socket.close()
+            raise
+        return graphite_socket
+
+    def _disconnect(self):
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except socket.error:
+                pass
+            self._socket = None
+
+    def _is_stale(self):
+        """True if graphite has closed our connection since we last used it.
+
+        Graphite never sends anything back, so if our socket is
+        readable it's because the other side went away.  We check this
+        before each send, because otherwise the first send after a
+        disconnect would appear to succeed.
+        """
+        try:
+            (readable, _, _) = select.select([self._socket], [], [], 0)
+        except (select.error, socket.error):
+            return True
+        return bool(readable)
+
+    def _send_payload(self, payload):
+        def send():
+            if self._socket is not None and self._is_stale():
+                self._disconnect()
+            if self._socket is None:
+                self._socket = self._connect()
+            try:
+                self._socket.sendall(payload)
+            except socket.error:
+                # Reconnect (and resend the whole batch) next time.
+                self._disconnect()
+                raise
+
+        _retry(send, 'sending to graphite', (socket.error,))
+
+    def send(self, records):
+        """Queue (key, (time_t, value)) records to be sent to graphite."""
+        if not records:
+            return
+        self._records.extend(records)
+        if self._oldest_record_time is None:
+            self._oldest_record_time = time.time()
+
+        if time.time() - self._oldest_record_time >= self.max_batch_age:
+            self.flush()
+        else:
+            self._send_batches(only_full_batches=True)
+
+    def _send_batches(self, only_full_batches):
+        while self._records:
+            if only_full_batches and len(self._records) < self.max_batch_size:
+                break
+            batch = self._records[:self.max_batch_size]
+            self._spool(cPickle.dumps(batch, cPickle.HIGHEST_PROTOCOL))
+            self._spool_may_have_segments = True
+            del self._records[:self.max_batch_size]
+        if not self._records:
+            self._oldest_record_time = None
+        if (self._spool_may_have_segments and
+                time.time() >= self._next_drain_time):
+            self._spool_may_have_segments = not self.drain()
+
+    def _spool(self, pickled_data):
+        """Durably write one batch to a new segment file in the spool.
+
+        A segment is a (length, crc32) header followed by the pickled
+        batch.  We write to a temp-file and rename it into place, so
+        the drainer never sees a partial segment.  Segment names sort
+        in the order they were written.
+        """
+        try:
+            os.makedirs(self.spool_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self._num_segments_written += 1
+        filename = os.path.join(self.spool_dir, '%020d-%010d-%010d.seg' % (
+            int(time.time() * 1000000), os.getpid(),
+            self._num_segments_written))
+        header = struct.pack('!LL', len(pickled_data),
+                             zlib.crc32(pickled_data) & 0xffffffff)
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(header + pickled_data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(filename + '.tmp', filename)
+
+    def _read_segment(self, filename):
+        """Return the pickled batch in a segment file, or None if corrupt."""
+        with open(filename, 'rb') as f:
+            contents = f.read()
+        if len(contents) < 8:
+            return None
+        (length, crc) = struct.unpack('!LL', contents[:8])
+        pickled_data = contents[8:]
+        if (len(pickled_data) != length or
+                zlib.crc32(pickled_data) & 0xffffffff != crc):
+            return None
+        return pickled_data
+
+    def _make_payload(self, pickled_data):
+        """Return what to send graphite for a spooled batch."""
+        if self._api_key is None:
+            self._api_key = _read_api_key()
+        # We need to prepend the api-key to each record we're sending.
+        batch = [('%s.%s' % (self._api_key, k), v)
+                 for (k, v) in cPickle.loads(pickled_data)]
+        pickled_batch = cPickle.dumps(batch, cPickle.HIGHEST_PROTOCOL)
+        return struct.pack("!L", len(pickled_batch)) + pickled_batch
+
+    def drain(self):
+        """Send spooled batches to graphite, oldest first.
+
+        We stop at the first batch we can't send, leaving it and
+        everything after it in the spool for next time.  Only one
+        process drains a given spool at a time; if another process is
+        already draining, we leave it to them.
+
+        Returns True if the spool is now empty.
+        """
+        if not os.path.isdir(self.spool_dir):
+            return True
+
+        with open(os.path.join(self.spool_dir, '.lock'), 'w') as lockfile:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    return False      # someone else is draining
+                raise
+
+            for basename in sorted(os.listdir(self.spool_dir)):
+                if not basename.endswith('.seg'):
+                    continue
+                filename = os.path.join(self.spool_dir, basename)
+                pickled_data = self._read_segment(filename)
+                if pickled_data is None:
+                    logging.error('Corrupt graphite spool segment %s, '
+                                  'moving it aside' % filename)
+                    os.rename(filename, filename + '.corrupt')
+                    continue
+
+                payload = self._make_payload(pickled_data)
+                try:
+                    self._send_payload(payload)
+                except socket.error as e:
+                    logging.warning('Unable to send to graphite at %s (%s); '
+                                    'leaving data in %s for next time'
+                                    % (self.graphite_host, e, self.spool_dir))
+                    self._next_drain_time = (time.time() +
+                                             self.drain_retry_interval)
+                    return False
+                os.unlink(filename)
+
+        return True
+
+    def flush(self):
+        """Spool all buffered records, and send what we can to graphite."""
+        self._send_batches(only_full_batches=False)
+
+    def close(self):
+        self.flush()
+        self._disconnect()
+
+
+_SENDERS = {}     # map from graphite_host to GraphiteSender
+
+
+def get_sender(graphite_host):
+    """Return the (shared) GraphiteSender for the given graphite host."""
+    if graphite_host not in _SENDERS:
+        _SENDERS[graphite_host] = GraphiteSender(graphite_host)
+    return _SENDERS[graphite_host]
+
+
+def flush():
+    """Spool all records passed to send_to_graphite() that are still queued.
+
+    We also send them to graphite, if we can.
+    """
+    for sender in _SENDERS.itervalues():
+        sender.flush()
+
+
+@atexit.register
+def _close_all_senders():
+    for sender in _SENDERS.itervalues():
+        try:
+            sender.close()
+        except Exception:
+            logging.exception('Unable to send queued records to %s'
+                              % sender.graphite_host)
+
+
 def send_to_graphite(graphite_host, records):
     """Sends the given records to the graphite host.
 
     The format of the pickle-protocol data is described at:
     http://graphite.readthedocs.org/en/latest/feeding-carbon.html#the-pickle-protocol
 
+    Records are batched with those from other calls, and may not be
+    sent until you call flush() (or the program exits).
+
     Arguments:
         graphite_host: hostname:port (port should be the port for the
             pickle protocol, probably 2004), or '' or None to avoid
@@ -103,31 +375,7 @@ def send_to_graphite(graphite_host, records):
     if not graphite_host or not records:
         return
 
-    # Load the api key that we need to send data to graphite.
-    # This will (properly) raise an exception if this file isn't installed
-    # (based on the contents of webapp secrets.py).
-    with open(os.path.expanduser('~/hostedgraphite_secret')) as f:
-        api_key = f.read().strip()
-
-    # We need to prepend the api-key to each record we're sending.
-    records = [('%s.%s' % (api_key, k), v) for (k, v) in records]
-
-    (hostname, port_string) = graphite_host.split(':')
-    host_ip = socket.gethostbyname(hostname)
-    port = int(port_string)
-
-    pickled_data = cPickle.dumps(records, cPickle.HIGHEST_PROTOCOL)
-    payload = struct.pack("!L", len(pickled_data)) + pickled_data
-
-    def _connect_to_graphite():
-        graphite_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        graphite_socket.connect((host_ip, port))
-        return graphite_socket
-
-    graphite_socket = _retry(_connect_to_graphite, 'connecting to graphite',
-                             (socket.error,))
-    graphite_socket.send(payload)
-    graphite_socket.close()
+    get_sender(graphite_host).send(records)
 
 
 def maybe_send_to_graphite(graphite_host, category, records, module=None):
@@ -0,0 +1,220 @@
+import cPickle
+import fcntl
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+import graphite_util
+
+
+class _FakeGraphite(object):
+    """A pickle-protocol server that records every batch it receives."""
+    def __init__(self):
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.bind(('127.0.0.1', 0))
+        self.server_socket.listen(5)
+        self.host = '127.0.0.1:%d' % self.server_socket.getsockname()[1]
+        self.batches = []
+        self.num_connections = 0
+        self.close_after_each_batch = False
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _read(self, conn, size):
+        data = ''
+        while len(data) < size:
+            chunk = conn.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def _serve(self):
+        while True:
+            try:
+                (conn, _) = self.server_socket.accept()
+            except socket.error:
+                return
+            self.num_connections += 1
+            while True:
+                header = self._read(conn, 4)
+                if header is None:
+                    break
+                (length,) = struct.unpack('!L', header)
+                self.batches.append(cPickle.loads(self._read(conn, length)))
+                if self.close_after_each_batch:
+                    break
+            conn.close()
+
+    def wait_for_batches(self, num_batches):
+        deadline = time.time() + 5
+        while len(self.batches) < num_batches and time.time() < deadline:
+            time.sleep(0.01)
+
+    def close(self):
+        # shutdown() wakes up the accept() in _serve; close() alone doesn't.
+        try:
+            self.server_socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.server_socket.close()
+        self.thread.join()
+
+
+class TestGraphiteSender(unittest.TestCase):
+    def setUp(self):
+        self.orig_read_api_key = graphite_util._read_api_key
+        graphite_util._read_api_key = lambda: 'KEY'
+        self.graphite = _FakeGraphite()
+        self.spool_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        graphite_util._read_api_key = self.orig_read_api_key
+        self.graphite.close()
+        shutil.rmtree(self.spool_dir)
+
+    def _sender(self, **kwargs):
+        return graphite_util.GraphiteSender(self.graphite.host,
+                                            spool_dir=self.spool_dir,
+                                            **kwargs)
+
+    def _spooled_segments(self):
+        return sorted(os.listdir(self.spool_dir))
+
+    def test_batches_records_over_one_connection(self):
+        sender = self._sender(max_batch_size=3)
+        sender.send([('a', (60, 1)), ('b', (60, 2))])
+        self.assertEqual([], self.graphite.batches)     # still buffered
+        sender.send([('c', (60, 3)), ('d', (60, 4))])   # fills a batch
+        sender.send([('e', (60, 5))])
+        sender.close()
+
+        self.graphite.wait_for_batches(2)
+        self.assertEqual([[('KEY.a', (60, 1)), ('KEY.b', (60, 2)),
+                           ('KEY.c', (60, 3))],
+                          [('KEY.d', (60, 4)), ('KEY.e', (60, 5))]],
+                         self.graphite.batches)
+        self.assertEqual(1, self.graphite.num_connections)
+        self.assertEqual(['.lock'], self._spooled_segments())
+
+    def test_flushes_old_records(self):
+        sender = self._sender(max_batch_age=0)
+        sender.send([('a', (60, 1))])
+        self.graphite.wait_for_batches(1)
+        self.assertEqual([[('KEY.a', (60, 1))]], self.graphite.batches)
+        sender.close()
+
+    def test_reconnects_when_graphite_closes_the_connection(self):
+        self.graphite.close_after_each_batch = True
+        sender = self._sender()
+        for i in xrange(3):
+            sender.send([('a', (60 * i, i))])
+            sender.flush()
+            self.graphite.wait_for_batches(i + 1)
+        sender.close()
+
+        self.assertEqual([[('KEY.a', (0, 0))], [('KEY.a', (60, 1))],
+                          [('KEY.a', (120, 2))]],
+                         self.graphite.batches)
+        self.assertEqual(3, self.graphite.num_connections)
+
+    def test_send_to_graphite_uses_a_shared_sender(self):
+        graphite_util._SENDERS[self.graphite.host] = self._sender()
+        graphite_util.send_to_graphite(self.graphite.host, [('a', (60, 1))])
+        graphite_util.send_to_graphite(self.graphite.host, [('b', (60, 2))])
+        graphite_util.flush()
+        self.graphite.wait_for_batches(1)
+        self.assertEqual([[('KEY.a', (60, 1)), ('KEY.b', (60, 2))]],
+                         self.graphite.batches)
+        graphite_util._SENDERS.pop(self.graphite.host).close()
+
+    def test_no_host_sends_nothing(self):
+        graphite_util.send_to_graphite(None, [('a', (60, 1))])
+        self.assertEqual({}, graphite_util._SENDERS)
+
+    def test_spools_while_graphite_is_down_and_resends_in_order(self):
+        self.graphite.close()
+        sender = self._sender()
+        sender.send([('a', (60, 1))])
+        sender.flush()     # fails to send, but doesn't raise
+        sender.send([('b', (120, 2))])
+        sender.close()     # doesn't retry graphite so soon
+        self.assertEqual(2, len([f for f in self._spooled_segments()
+                                 if f.endswith('.seg')]))
+
+        # A later run, with graphite back up.
+        self.graphite = _FakeGraphite()
+        sender = self._sender()
+        sender.send([('c', (180, 3))])
+        sender.close()
+        self.graphite.wait_for_batches(3)
+        self.assertEqual([[('KEY.a', (60, 1))], [('KEY.b', (120, 2))],
+                          [('KEY.c', (180, 3))]],
+                         self.graphite.batches)
+        self.assertEqual(['.lock'], self._spooled_segments())
+
+    def test_corrupt_segments_are_moved_aside(self):
+        self.graphite.close()
+        sender = self._sender()
+        sender.send([('a', (60, 1))])
+        sender.close()
+        [segment] = [f for f in self._spooled_segments() if f.endswith('.seg')]
+        with open(os.path.join(self.spool_dir, segment), 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.write('X')
+
+        self.graphite = _FakeGraphite()
+        self.assertTrue(self._sender().drain())
+        self.assertEqual([], self.graphite.batches)
+        self.assertEqual(['.lock', segment + '.corrupt'],
+                         self._spooled_segments())
+
+    def test_spool_does_not_hold_the_api_key(self):
+        self.graphite.close()
+        sender = self._sender()
+        sender.send([('a', (60, 1))])
+        sender.close()
+        [segment] = [f for f in self._spooled_segments() if f.endswith('.seg')]
+        with open(os.path.join(self.spool_dir, segment), 'rb') as f:
+            self.assertNotIn('KEY', f.read())
+
+    def test_only_drains_when_something_may_be_spooled(self):
+        sender = self._sender(max_batch_size=2)
+        drains = []
+        orig_drain = sender.drain
+        sender.drain = lambda: drains.append(1) or orig_drain()
+
+        # We check once for segments from a previous run.
+        sender.send([('a', (60, 1))])
+        self.assertEqual(1, len(drains))
+        sender.send([('b', (60, 2))])      # spools a batch
+        self.assertEqual(2, len(drains))
+        sender.send([('c', (60, 3))])
+        self.assertEqual(2, len(drains))
+        sender.close()
+        self.assertEqual(3, len(drains))
+
+    def test_only_one_process_drains_at_a_time(self):
+        sender = self._sender(drain_retry_interval=0)
+        self.graphite.close()
+        sender.send([('a', (60, 1))])
+        sender.flush()
+
+        self.graphite = _FakeGraphite()
+        sender = self._sender()
+        with open(os.path.join(self.spool_dir, '.lock'), 'w') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            self.assertFalse(sender.drain())
+        self.assertTrue(sender.drain())
+        self.graphite.wait_for_batches(1)
+        self.assertEqual([[('KEY.a', (60, 1))]], self.graphite.batches)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -30,9 +30,13 @@ This script uses a configuration file to describe what how to extract
 a metric from the logs and what to name it on Cloud Monitoring.
 
 It's expected this script will be run periodically as a cron job every
-minute.
+minute, or else be left running with --daemon, in which case it sends
+the metrics every minute itself.
 """
 
+import cPickle
+import hashlib
+import heapq
 import json
 import logging
 import os
@@ -70,6 +74,10 @@ _LABELS = {
 
 _LAST_RECORD_DB = os.path.expanduser('~/logs_bridge_time.db')
 
+# Where we keep the _DaysAgoCache, and how far ahead it gets results.
+_DAYS_AGO_CACHE_DB = os.path.expanduser('~/logs_bridge_days_ago.pickle')
+_DAYS_AGO_PREFETCH_SECONDS = 3600
+
 
 def _time_t_of_latest_successful_run():
     """time_t of the most recent successfully logs-bridge run.
@@ -91,10 +99,16 @@ def _write_time_t_of_latest_successful_run(time_t):
         print >>f, time_t
 
 
-def _load_config(config_name):
+def _config_path(config_name):
     """If config_name is a relative path, it's relative to this dir."""
     if not os.path.isabs(config_name):
         config_name = os.path.join(os.path.dirname(__file__), config_name)
+    return config_name
+
+
+def _load_config(config_name):
+    """If config_name is a relative path, it's relative to this dir."""
+    config_name = _config_path(config_name)
 
     # Read the file, ignoring any lines that start with `//`.
     with open(config_name) as f:
@@ -155,21 +169,33 @@ def _tables_for_time(start_time_t, delta):
     # table(s).  (We only keep that table around for a week + 2 hours.)
     if now - start_time_t <= 86400 * 7 + 3600 * 2:
         retval = []
-        for time_t in xrange(start_time_t, start_time_t + delta, 3600):
+        for time_t in xrange(start_time_t - start_time_t % 3600,
+                             start_time_t + delta, 3600):
             retval.append(time.strftime('[logs_hourly.requestlogs_%Y%m%d_%H]',
                                         time.gmtime(time_t)))
         return ', '.join(retval)
 
     # Otherwise just use the appropriate daily logs table(s).
     retval = []
-    for time_t in xrange(start_time_t, start_time_t + delta, 86400):
+    for time_t in xrange(start_time_t - start_time_t % 86400,
+                         start_time_t + delta, 86400):
         retval.append(time.strftime('[logs.requestlogs_%Y%m%d]',
                                     time.gmtime(time_t)))
     return ', '.join(retval)
 
 
-def _query_for_rows_in_time_range(config, start_time_t, time_interval_seconds):
-    """Return a query that yields all rows needed for this config + time."""
+def _all_days_agos(config):
+    """The sorted normalizeByDaysAgo values used by the config."""
+    return sorted(set(c.get('normalizeByDaysAgo') for c in config) - {None})
+
+
+def _query_for_rows_in_time_range(config, start_time_t, time_interval_seconds,
+                                  include_days_ago=True):
+    """Return a query that yields all rows needed for this config + time.
+
+    If include_days_ago is False, we leave out the 'some days ago'
+    rows, because we're getting them from a _DaysAgoCache instead.
+    """
     froms = ["""(
         SELECT 'now' as when, %s, %s
         FROM %s
@@ -181,7 +207,7 @@ def _query_for_rows_in_time_range(config, start_time_t, time_interval_seconds):
             start_time_t, start_time_t + time_interval_seconds)
     ]
 
-    all_days_agos = set(c.get('normalizeByDaysAgo') for c in config) - {None}
+    all_days_agos = _all_days_agos(config) if include_days_ago else []
     for days_ago in all_days_agos:
         old_time_t = start_time_t - 86400 * days_ago
         froms.append("""(
@@ -200,11 +226,56 @@ def _query_for_rows_in_time_range(config, start_time_t, time_interval_seconds):
     return 'SELECT * from %s' % "\n,".join(froms)
 
 
+def _query_for_rows_in_windows(config, start_time_t, time_interval_seconds,
+                               num_windows, include_now=True,
+                               include_days_ago=True):
+    """Return a query that yields all rows needed for consecutive windows.
+
+    This is like _query_for_rows_in_time_range(), but for num_windows
+    windows starting at start_time_t, and each row also has a
+    window_start: the start of the window the row is in, or, for the
+    'some days ago' rows, the window it is compared against.
+    """
+    total_seconds = time_interval_seconds * num_windows
+    times = []
+    if include_now:
+        times.append(('now', start_time_t))
+    if include_days_ago:
+        times.extend(('some days ago', start_time_t - 86400 * days_ago)
+                     for days_ago in _all_days_agos(config))
+
+    froms = []
+    for (when, time_t) in times:
+        froms.append("""(
+        SELECT '%s' as when,
+            %d + %d * INTEGER((end_time - %d) / %d) as window_start, %s, %s
+        FROM %s
+        WHERE end_time >= %d and end_time < %d
+    )""" % (when, start_time_t, time_interval_seconds, time_t,
+            time_interval_seconds,
+            ', '.join(_LABELS.itervalues()),
+            ', '.join('%s as %s' % (v, k)
+                      for (k, v) in _QUERY_FIELDS.iteritems()),
+            _tables_for_time(time_t, total_seconds),
+            time_t, time_t + total_seconds))
+
+    if any(c.get('normalizeByLastDeploy') for c in config):
+        raise NotImplementedError("Augment innermost-from in this case too")
+
+    return 'SELECT * from %s' % "\n,".join(froms)
+
+
 def _create_subquery(config_entry, start_time_t, time_interval_seconds,
-                     table_name):
+                     rows_source, group_by_window=False):
     """Return a query that captures all loglines matching the config-entry.
 
-    We look through table_name to find all requests that *ended*
+    rows_source is what to select the rows from: either a table name
+    in [brackets], or a parenthesized _query_for_rows_in_time_range().
+    If group_by_window is True, the rows come from
+    _query_for_rows_in_windows() instead, and we group by window_start
+    as well as by `when` and the labels.
+
+    We look through rows_source to find all requests that *ended*
     between start_time_t and start_time_t + time_interval_seconds.
     ("start_time_t" is a bit of a confusing name).  We want "ended"
     because that's when a request gets written to the logs.  As an
@@ -218,54 +289,202 @@ def _create_subquery(config_entry, start_time_t, time_interval_seconds,
     """
     label_names = config_entry.get('labels', [])
     selectors = [_LABELS[label_name] for label_name in label_names]
+    bucket_fields = ['when', 'window_start'] if group_by_window else ['when']
 
     # num_requests_by_field is the total number of requests broken down by
     # field. E.g. if this metric is broken down by browser,
     # num_requests_by_field would be for a particular browser such as the
     # total number of requests for Chrome.
-    subquery = ("SELECT '%s' as metricName, when, COUNT(*) as "
+    subquery = ("SELECT '%s' as metricName, %s, COUNT(*) as "
                 "num_requests_by_field, FLOAT(%s) as num"
-                % (config_entry['metricName'], config_entry['query']))
+                % (config_entry['metricName'], ', '.join(bucket_fields),
+                   config_entry['query']))
     for selector in selectors:
         subquery += ', %s' % selector
-    subquery += ' FROM [%s]' % table_name
-    subquery += ' GROUP BY %s' % ', '.join(selectors + ['when'])
+    subquery += ' FROM %s' % rows_source
+    subquery += ' GROUP BY %s' % ', '.join(selectors + bucket_fields)
     subquery += ' HAVING num is not null'
     return '(%s)' % subquery
 
 
-def _run_bigquery(config, start_time_t, time_interval_seconds):
-    """config is as described in logs_bridge.config.json."""
-    # First, create a temporary table that's just the rows from
-    # start_time_t to start_time_t + time_interval_seconds.
-    # We'll give it a random name so we can run multiple copies of
-    # this script at the same time.
+class _DaysAgoCache(object):
+    """The per-metric 'some days ago' results for upcoming windows.
+
+    The logs from some days ago never change, so rather than scanning
+    them again every window, we get the results for an hour's worth of
+    windows at once, grouped by window, and keep them (on disk, so
+    cron runs can share them) until their window comes up.
+
+    We key the cache by the config and the days-agos, as well as by
+    the window, so a change to the config doesn't get stale results.
+
+    save() only writes the cache after we've prefetched.  There's no
+    need to save after using a window, since loading the cache in a
+    later run evicts the windows that are already done.
+    """
+    def __init__(self, filename, config):
+        self.filename = filename
+        self.config = config
+        self.days_agos = _all_days_agos(config)
+        self.config_key = hashlib.md5(
+            json.dumps(config, sort_keys=True)).hexdigest()
+        self.windows = {}
+        self._unsaved = False
+        if os.path.exists(filename):
+            try:
+                with open(filename, 'rb') as f:
+                    self.windows = cPickle.load(f)
+            except Exception:
+                logging.exception('Ignoring unreadable cache %s', filename)
+
+    def save(self):
+        if not self._unsaved:
+            return
+        # Write to a temp-file so a crash never leaves us a partial file.
+        with open(self.filename + '.tmp', 'wb') as f:
+            cPickle.dump(self.windows, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(self.filename + '.tmp', self.filename)
+        self._unsaved = False
+
+    def _key(self, start_time_t, time_interval_seconds):
+        return (self.config_key, start_time_t, time_interval_seconds)
+
+    def _prefetch(self, start_time_t, time_interval_seconds):
+        """Cache the results for the next hour of windows, in one query."""
+        num_windows = max(
+            1, _DAYS_AGO_PREFETCH_SECONDS / time_interval_seconds)
+        rows_query = _query_for_rows_in_windows(
+            self.config, start_time_t, time_interval_seconds, num_windows,
+            include_now=False)
+        rows_source = '(%s)' % rows_query
+        subqueries = [_create_subquery(entry, start_time_t,
+                                       time_interval_seconds, rows_source,
+                                       group_by_window=True)
+                      for entry in self.config]
+        query = 'SELECT * FROM %s' % ',\n'.join(subqueries)
+        logging.debug('BIGQUERY DAYS-AGO QUERY: %s' % query)
+
+        logging.info("Sending days-ago query for %s windows to bigquery",
+                     num_windows)
+        for i in xrange(num_windows):
+            window_start = start_time_t + i * time_interval_seconds
+            self.windows[self._key(window_start, time_interval_seconds)] = []
+        # We need every row: a window missing some would send wrong
+        # metrics.
+        for row in bq_util.query_bigquery_iter(query, max_rows=None):
+            window_start = row.pop('window_start')
+            self.windows[self._key(window_start,
+                                   time_interval_seconds)].append(row)
+        self._unsaved = True
+
+    def pop_results(self, metric_names, start_time_t, time_interval_seconds):
+        """Return the 'some days ago' results for this window.
+
+        We return the same rows that including the days-ago rows in
+        _run_bigquery's query would have, for the given metrics.  The
+        window's results are removed from the cache, as are those for
+        any earlier windows, which we must have skipped, and those for
+        old configs.
+        """
+        key = self._key(start_time_t, time_interval_seconds)
+        if key not in self.windows:
+            self._prefetch(start_time_t, time_interval_seconds)
+        for old_key in self.windows.keys():
+            if old_key[0] != self.config_key or old_key[1] < start_time_t:
+                del self.windows[old_key]
+        return _with_num_requests([row for row in self.windows.pop(key)
+                                   if row['metricName'] in metric_names])
+
+
+def _with_num_requests(rows):
+    """Return copies of the rows, with num_requests set.
+
+    num_requests is the sum of num_requests_by_field over all the rows
+    with the same `when`: what SUM(num_requests_by_field) OVER(PARTITION
+    BY when) gives in _run_bigquery().
+    """
+    num_requests = {}
+    for row in rows:
+        num_requests[row['when']] = (num_requests.get(row['when'], 0) +
+                                     row['num_requests_by_field'])
+    return [dict(row, num_requests=num_requests[row['when']])
+            for row in rows]
+
+
+def _usable_days_ago_cache(config, days_ago_cache):
+    """Return days_ago_cache, or None if it can't be used for config."""
+    # The cache has rows for all the days-agos in the whole config; if
+    # these entries want a different set, we just query them.
+    if (days_ago_cache is None or not days_ago_cache.days_agos or
+            _all_days_agos(config) != days_ago_cache.days_agos):
+        return None
+    return days_ago_cache
+
+
+def _rows_source(rows_query, start_time_t, time_interval_seconds,
+                 single_job):
+    """Return what the subqueries should select the rows_query rows from.
+
+    By default we copy the rows into a temporary table, and return its
+    name.  If single_job is True, we just inline the query.
+
+    Inlining saves two bigquery jobs, and their latency, but each
+    config entry's subquery then reads the logs tables itself: we scan
+    the logs once per config entry rather than once in total, and
+    bigquery bills for every scan (with a 10MB minimum per table read).
+    With the temporary table, the entries read only the columns they
+    use from the much smaller table.  To compare the two for a real
+    config, run with --bq-backend=api -v, which logs the bytes each
+    job processes.
+    """
+    if single_job:
+        return '(%s)' % rows_query
+
+    # We'll give the table a random name so we can run multiple copies
+    # of this script at the same time.
     temp_table_name = (
         'khan-academy:logs_streaming_tmp_analysis.logs_bridge_%d_%04d'
         % (start_time_t, random.randint(0, 9999)))
+    logging.debug("Creating the temporary table for querying over by "
+                  "running " + rows_query)
+    bq_util.make_table(temp_table_name, time_interval_seconds,
+                       project='khan-academy')
+    bq_util.query_to_table(rows_query, temp_table_name)
+    logging.debug("Done creating temporary table %s", temp_table_name)
+    return '[%s]' % temp_table_name
+
+
+def _run_bigquery(config, start_time_t, time_interval_seconds,
+                  single_job=False, days_ago_cache=None):
+    """config is as described in logs_bridge.config.json.
+
+    By default we first copy the rows we need into a temporary table,
+    and then query that table for each config entry.  If single_job is
+    True, we instead inline the query for the rows into each config
+    entry's subquery, so we only run one bigquery job.
+
+    If days_ago_cache is given, we get the 'some days ago' results
+    from there rather than querying for them along with 'now'.
+    """
+    days_ago_cache = _usable_days_ago_cache(config, days_ago_cache)
+    days_ago_results = []
+    if days_ago_cache is not None:
+        days_ago_results = days_ago_cache.pop_results(
+            set(entry['metricName'] for entry in config),
+            start_time_t, time_interval_seconds)
+
     # We assume that this script will not run for longer than
     # time_interval_seconds; if it did, it would continually be
     # falling behind!
-    temp_table_query = _query_for_rows_in_time_range(config, start_time_t,
-                                                     time_interval_seconds)
-    # Apparently the commandline doesn't like newlines in the script.
-    # Reformat for the commandline.
-    temp_table_query = temp_table_query.replace('\n', ' ')
-
-    logging.debug("Creating the temporary table for querying over by running "
-                  + temp_table_query)
-    bq_util.call_bq(['mk', '--expiration', str(time_interval_seconds),
-                     temp_table_name],
-                    project='khan-academy',
-                    return_output=False,
-                    stdout=open(os.devnull, 'w'))
-    bq_util.call_bq(['query', '--destination_table', temp_table_name,
-                     '--allow_large_results', temp_table_query],
-                    return_output=False)
-    logging.debug("Done creating temporary table %s", temp_table_name)
+    rows_query = _query_for_rows_in_time_range(
+        config, start_time_t, time_interval_seconds,
+        include_days_ago=(days_ago_cache is None))
+
+    rows_source = _rows_source(rows_query, start_time_t,
+                               time_interval_seconds, single_job)
 
     subqueries = [_create_subquery(entry, start_time_t, time_interval_seconds,
-                                   temp_table_name)
+                                   rows_source)
                   for entry in config]
 
     # num_requests is the total number of requests in the specified
@@ -278,10 +497,58 @@ def _run_bigquery(config, start_time_t, time_interval_seconds):
     logging.debug('BIGQUERY QUERY: %s' % query)
 
     logging.info("Sending query to bigquery")
-    r = bq_util.query_bigquery(query)
+    r = list(bq_util.query_bigquery_iter(query))
     logging.debug('BIGQUERY RESULTS: %s' % r)
 
-    return r
+    return r + days_ago_results
+
+
+def _run_bigquery_for_windows(configs_by_window, time_interval_seconds,
+                              single_job=False, days_ago_cache=None):
+    """Return a map from window start-time to _run_bigquery()'s results.
+
+    configs_by_window is a list of (start_time_t, config) pairs, for
+    consecutive windows.  This is for catching up when we've fallen
+    behind: rather than a query per window, we run one query for all
+    the windows, bucketed by window, and split up the results.
+    """
+    start_time_t = configs_by_window[0][0]
+    num_windows = len(configs_by_window)
+    config = []
+    for (_, window_config) in configs_by_window:
+        config.extend(e for e in window_config if e not in config)
+
+    days_ago_cache = _usable_days_ago_cache(config, days_ago_cache)
+    rows_query = _query_for_rows_in_windows(
+        config, start_time_t, time_interval_seconds, num_windows,
+        include_days_ago=(days_ago_cache is None))
+    rows_source = _rows_source(rows_query, start_time_t,
+                               time_interval_seconds * num_windows,
+                               single_job)
+
+    subqueries = [_create_subquery(entry, start_time_t, time_interval_seconds,
+                                   rows_source, group_by_window=True)
+                  for entry in config]
+    # We compute num_requests per window ourselves, below.
+    query = 'SELECT * FROM %s' % ',\n'.join(subqueries)
+    logging.debug('BIGQUERY QUERY: %s' % query)
+
+    logging.info("Sending query for %s windows to bigquery", num_windows)
+    rows_by_window = {}
+    # We need every row: a window missing some would send wrong metrics.
+    for row in bq_util.query_bigquery_iter(query, max_rows=None):
+        rows_by_window.setdefault(row.pop('window_start'), []).append(row)
+
+    retval = {}
+    for (window_start, window_config) in configs_by_window:
+        metric_names = set(e['metricName'] for e in window_config)
+        rows = [row for row in rows_by_window.get(window_start, [])
+                if row['metricName'] in metric_names]
+        if days_ago_cache is not None and _all_days_agos(window_config):
+            rows.extend(days_ago_cache.pop_results(
+                metric_names, window_start, time_interval_seconds))
+        retval[window_start] = _with_num_requests(rows)
+    return retval
 
 
 def _maybe_filter_out_infrequent_label_values(config,
@@ -351,19 +618,19 @@ def _maybe_filter_out_infrequent_label_values(config,
     # Determine the top `num_unique_labels` values for both  when='now' and
     # when='some days ago'. Then add the top result entries to the return dict.
     for metric_name, now_label_list in now_results_by_metric.iteritems():
-        # Sort now label_list by the sorting value set in the prior for loop.
-        now_label_list.sort(key=lambda x: x[1], reverse=True)
-
-        # Do the same sorting for the 'then' label list.
         then_label_list = then_results_by_metric.get(metric_name, [])
-        then_label_list.sort(key=lambda x: x[1], reverse=True)
-
         max_num_labels = metric_to_max_num_labels[metric_name][0]
 
         # Get the top label values, unioning over now and some days ago.
-        top_label_values = {v for (v, _, _) in
-                            now_label_list[:max_num_labels] +
-                            then_label_list[:max_num_labels]}
+        # We only need the top few, so we use a heap rather than sorting
+        # all the label values, by the sorting value set in the prior
+        # for loop.
+        top_label_values = {
+            v for (v, _, _) in
+            heapq.nlargest(max_num_labels, now_label_list,
+                           key=lambda x: x[1]) +
+            heapq.nlargest(max_num_labels, then_label_list,
+                           key=lambda x: x[1])}
 
         # Finally, add top label value results to the return dict
         # TODO(alexanderforsyth): combine the non-top label values into an
@@ -383,10 +650,32 @@ def _maybe_filter_out_infrequent_label_values(config,
     return return_dict
 
 
-def _get_values_from_bigquery(config, start_time_t, time_interval_seconds):
+def _get_num(result, normalize_by_requests):
+    """Return result['num'], normalized by num-requests if asked.
+
+    Returns None if the value (or the number of requests) is NULL.
+    """
+    value = result['num']
+    if value is None:
+        return None
+    if normalize_by_requests:
+        if result['num_requests'] is None:
+            return None
+        value /= result['num_requests']
+    return value
+
+
+def _get_values_from_bigquery(config, start_time_t, time_interval_seconds,
+                              single_job=False, days_ago_cache=None):
     """Return a list of (metric-name, metric-labels, values) triples."""
     bigquery_results = _run_bigquery(config, start_time_t,
-                                     time_interval_seconds)
+                                     time_interval_seconds, single_job,
+                                     days_ago_cache)
+    return _values_from_results(config, bigquery_results)
+
+
+def _values_from_results(config, bigquery_results):
+    """Turn _run_bigquery()'s results into _get_values_from_bigquery()'s."""
     # A single result looks like:
     #   {u'module_id': u'multithreaded',
     #    u'num': 10.0,
@@ -395,22 +684,24 @@ def _get_values_from_bigquery(config, start_time_t, time_interval_seconds):
     #    u'num_requests_by_field: 1001
     #    u'metricName': u'logs.status'}
 
+    config_by_metric = {c['metricName']: c for c in config}
+
     # Key each result by its resolved metric name.
     results_by_metric_and_when = {}
     for result in bigquery_results:
-        config_entry = next(c for c in config
-                            if c['metricName'] == result['metricName'])
+        config_entry = config_by_metric[result['metricName']]
         label_values = []
         label_names = config_entry.get('labels', [])
         for label in label_names:
             selector = _LABELS[label]
-            # bq_io can turn labels like '8' into an int; we want them
-            # to be strings so we turn them back.
-            label_value = str(result[selector])
-            # A special case: bigquery doesn't store module-id for default.
-            # "(None)" is how bq_io translates `None`.
-            if label == 'module_id' and label_value == '(None)':
-                label_value = 'default'
+            if result[selector] is None:
+                # A special case: bigquery doesn't store module-id for
+                # default.
+                label_value = 'default' if label == 'module_id' else '(None)'
+            else:
+                # bq_util can turn labels like '8' into an int; we want
+                # them to be strings so we turn them back.
+                label_value = str(result[selector])
             label_values.append(label_value)
         key = (config_entry['metricName'], tuple(label_values), result['when'])
         assert key not in result, "%s is not a unique key!" % key
@@ -420,20 +711,29 @@ def _get_values_from_bigquery(config, start_time_t, time_interval_seconds):
         _maybe_filter_out_infrequent_label_values(
             config, results_by_metric_and_when))
 
+    # Group the 'now' results by metric, so we can send them in config
+    # order.
+    now_results_by_metric = {}
+    for ((metric_name, metric_label_values, when), result) in \
+            results_by_metric_and_when.iteritems():
+        if when == 'now':
+            now_results_by_metric.setdefault(metric_name, []).append(
+                (metric_label_values, result))
+
     retval = []
     for config_entry in config:
-        for ((metric_name, metric_label_values, when), result) in \
-                results_by_metric_and_when.iteritems():
-            if (result['metricName'] != config_entry['metricName'] or
-                    when != 'now'):
-                continue
-
-            value = result['num']
-
-            # Normalize if asked.
+        metric_name = config_entry['metricName']
+        for (metric_label_values, result) in \
+                now_results_by_metric.get(metric_name, []):
+            normalize_by_requests = config_entry.get('normalizeByRequests')
+            # The value can be None if no rows matched the query.
+            # In that case, we just ignore the metric entirely.
+            # TODO(csilvers): better would be to set value to 0 for counts,
+            #                 but to not-send the value for ratios.
             try:
-                if config_entry.get('normalizeByRequests'):
-                    value /= result['num_requests']
+                value = _get_num(result, normalize_by_requests)
+                if value is None:
+                    continue
 
                 if config_entry.get('normalizeByDaysAgo'):
                     last_week_key = (metric_name, metric_label_values,
@@ -446,29 +746,23 @@ def _get_values_from_bigquery(config, start_time_t, time_interval_seconds):
                     # that some browser has 3 users, for example
                     if last_week_key not in results_by_metric_and_when:
                         continue
-                    old_result = results_by_metric_and_when[last_week_key]
-                    old_value = old_result['num']
                     # Weird to normalize by two things, but possible.
-                    if config_entry.get('normalizeByRequests'):
-                        old_value /= old_result['num_requests']
+                    old_value = _get_num(
+                        results_by_metric_and_when[last_week_key],
+                        normalize_by_requests)
+                    if old_value is None:
+                        continue
                     value /= old_value
 
                 if config_entry.get('normalizeByLastDeploy'):
-                    last_deploy_result = results_by_metric_and_when[
-                        (metric_name, metric_label_values, 'last deploy')]
-                    last_deploy_value = last_deploy_result['num']
-                    if config_entry.get('normalizeByRequests'):
-                        last_deploy_value /= last_deploy_result['num_requests']
+                    last_deploy_value = _get_num(
+                        results_by_metric_and_when[
+                            (metric_name, metric_label_values, 'last deploy')],
+                        normalize_by_requests)
+                    if last_deploy_value is None:
+                        continue
                     value /= last_deploy_value
-            except (ZeroDivisionError, TypeError):
-                # A TypeError happens when we do '3 / "(None)"' or the reverse.
-                continue
-
-            # The value can be 'None' if no rows matched the query.
-            # In that case, we just ignore the metric entirely.
-            # TODO(csilvers): better would be to set value to 0 for counts,
-            #                 but to not-send the value for ratios.
-            if value == "(None)":
+            except ZeroDivisionError:
                 continue
 
             # Get the labels to be a dict of label-name->label-value
@@ -496,9 +790,13 @@ def _send_to_stackdriver(google_project_id, bigquery_values,
         google_project_id, data, dry_run)
 
 
-def main(config_filename, google_project_id, time_interval_seconds, dry_run):
-    config = _load_config(config_filename)
+def _run_pending_windows(config, google_project_id, time_interval_seconds,
+                         dry_run, single_job=False, days_ago_cache=None):
+    """Send the metrics for each window since the last successful run.
 
+    days_ago_cache is the _DaysAgoCache for this config; by default we
+    load the one saved on disk.
+    """
     # We'll collect data minute-by-minute until we've collected data
     # from the time range (two-minutes-ago, one-minute-ago).
     run_until = int(time.time()) - time_interval_seconds * 2
@@ -517,32 +815,135 @@ def main(config_filename, google_project_id, time_interval_seconds, dry_run):
                          run_until - time_interval_seconds))
         time_of_last_successful_run = run_until - time_interval_seconds
 
+    if days_ago_cache is None:
+        days_ago_cache = _DaysAgoCache(_DAYS_AGO_CACHE_DB, config)
+    try:
+        _run_windows(config, google_project_id, time_interval_seconds,
+                     dry_run, single_job, days_ago_cache,
+                     time_of_last_successful_run, run_until)
+    finally:
+        days_ago_cache.save()
+
+
+def _run_windows(config, google_project_id, time_interval_seconds, dry_run,
+                 single_job, days_ago_cache, time_of_last_successful_run,
+                 run_until):
+    # Figure out the windows we need to run, and for each one, get rid
+    # of entries we shouldn't run then (because they're only run
+    # hourly, e.g.).
+    configs_by_window = []
     while time_of_last_successful_run < run_until:
         start_time = time_of_last_successful_run + time_interval_seconds
-        # Get rid of entries we shouldn't run now (because they're only
-        # run hourly, e.g.).
-        current_config = [e for e in config
-                          if _should_run_query(e, start_time,
-                                               time_of_last_successful_run)]
+        configs_by_window.append(
+            (start_time,
+             [e for e in config
+              if _should_run_query(e, start_time,
+                                   time_of_last_successful_run)]))
+        time_of_last_successful_run = start_time
 
-        bigquery_values = _get_values_from_bigquery(current_config, start_time,
-                                                    time_interval_seconds)
+    # If we've fallen behind, we catch up with a single query for all
+    # the windows.  We still send each window to stackdriver
+    # separately, since it only takes one point per timeseries per
+    # request.
+    results_by_window = None
+    if len(configs_by_window) > 1:
+        catch_up_start = time.time()
+        results_by_window = _run_bigquery_for_windows(
+            configs_by_window, time_interval_seconds, single_job,
+            days_ago_cache)
+        logging.info("Caught up on %s windows (bigquery: %.1fs)",
+                     len(configs_by_window), time.time() - catch_up_start)
+
+    for (start_time, current_config) in configs_by_window:
+        window_start = time.time()
+        if results_by_window is not None:
+            bigquery_values = _values_from_results(
+                current_config, results_by_window[start_time])
+        else:
+            bigquery_values = _get_values_from_bigquery(
+                current_config, start_time, time_interval_seconds,
+                single_job, days_ago_cache)
+        query_end = time.time()
 
         # TODO(csilvers): compute ALL facet-totals for counting-stats.
 
         num_metrics = _send_to_stackdriver(
             google_project_id, bigquery_values, start_time,
             time_interval_seconds, dry_run)
-
-        time_of_last_successful_run = start_time
+        send_end = time.time()
 
         if dry_run:
-            logging.info("Time %s: would write %s metrics to stackdriver",
-                         start_time + time_interval_seconds, num_metrics)
+            logging.info("Time %s: would write %s metrics to stackdriver "
+                         "(bigquery: %.1fs, stackdriver: %.1fs)",
+                         start_time + time_interval_seconds, num_metrics,
+                         query_end - window_start, send_end - query_end)
         else:
-            logging.info("Time %s: wrote %s metrics to stackdriver",
-                         start_time + time_interval_seconds, num_metrics)
-            _write_time_t_of_latest_successful_run(time_of_last_successful_run)
+            logging.info("Time %s: wrote %s metrics to stackdriver "
+                         "(bigquery: %.1fs, stackdriver: %.1fs)",
+                         start_time + time_interval_seconds, num_metrics,
+                         query_end - window_start, send_end - query_end)
+            _write_time_t_of_latest_successful_run(start_time)
+
+
+def main(config_filename, google_project_id, time_interval_seconds, dry_run,
+         single_job=False):
+    config = _load_config(config_filename)
+    _run_pending_windows(config, google_project_id, time_interval_seconds,
+                         dry_run, single_job)
+
+
+def _monotonic_time():
+    """Seconds since some fixed point; unaffected by system clock changes."""
+    return os.times()[4]
+
+
+def run_daemon(config_filename, google_project_id, time_interval_seconds,
+               dry_run, single_job=False):
+    """Like main(), but run forever, once every time_interval_seconds.
+
+    Unlike running main() from cron, we only pay for starting python,
+    importing and reading the config once, and we keep the
+    _DaysAgoCache in memory rather than reading it from disk every
+    window.  With the api bq-backend, which is the default for
+    --daemon, we also reuse one bigquery client rather than forking bq
+    for every query.  We re-read the config whenever it changes.  If a
+    window fails, we log the error and try again next time; since we
+    keep track of the last successful run, we'll catch up then.
+    """
+    config_path = _config_path(config_filename)
+    config = None
+    config_mtime = None
+    days_ago_cache = None
+    next_run_time = _monotonic_time()
+    while True:
+        try:
+            mtime = os.path.getmtime(config_path)
+            if mtime != config_mtime:
+                config = _load_config(config_path)
+                config_mtime = mtime
+                days_ago_cache = _DaysAgoCache(_DAYS_AGO_CACHE_DB, config)
+                logging.info('Loaded config from %s', config_path)
+        except (IOError, OSError, ValueError):
+            if config is None:
+                raise
+            logging.exception('Could not reload %s, using the old config',
+                              config_path)
+
+        try:
+            _run_pending_windows(config, google_project_id,
+                                 time_interval_seconds, dry_run, single_job,
+                                 days_ago_cache)
+        except Exception:
+            logging.exception('Sending metrics failed; will retry')
+
+        next_run_time += time_interval_seconds
+        now = _monotonic_time()
+        if next_run_time < now:
+            # We took longer than a window.  _run_pending_windows will
+            # catch up on the windows we missed, so just start right away.
+            logging.warning('Fell behind by %.1fs', now - next_run_time)
+            next_run_time = now
+        time.sleep(next_run_time - now)
 
 
 if __name__ == '__main__':
@@ -565,8 +966,30 @@ if __name__ == '__main__':
                               'logging)'))
     parser.add_argument('-n', '--dry-run', action='store_true', default=False,
                         help='do not write metrics to Cloud Monitoring')
+    parser.add_argument('--bq-backend', choices=('cli', 'api'), default=None,
+                        help=('talk to bigquery via the bq command-line tool '
+                              'or in-process via the API '
+                              '[default: api with --daemon, else cli]'))
+    parser.add_argument('--daemon', action='store_true', default=False,
+                        help=('run forever, sending metrics every '
+                              '--window-seconds, rather than running once '
+                              '(from cron)'))
+    parser.add_argument('--single-job', action='store_true', default=False,
+                        help=('query the logs in a single bigquery job, '
+                              'rather than first copying the rows we need '
+                              'to a temporary table.  This saves two jobs '
+                              'per window, but reads the logs once per '
+                              'config entry instead of once, so it '
+                              'processes many more bytes.  Use '
+                              '--bq-backend=api -v to log the bytes each '
+                              'job processes'))
     args = parser.parse_args()
 
+    if args.bq_backend is None:
+        # The daemon runs many queries, so it's worth keeping a client.
+        args.bq_backend = 'api' if args.daemon else 'cli'
+    bq_util.set_backend(args.bq_backend)
+
     # default for WARNING, -v for INFO, -vv for DEBUG.
     logs_format = '[%(asctime)s %(levelname)s] %(message)s'
     if args.verbose >= 2:
@@ -574,4 +997,9 @@ if __name__ == '__main__':
     elif args.verbose == 1 or args.dry_run:
         logging.basicConfig(format=logs_format, level=logging.INFO)
 
-    main(args.config, args.project_id, args.window_seconds, args.dry_run)
+    if args.daemon:
+        run_daemon(args.config, args.project_id, args.window_seconds,
+                   args.dry_run, args.single_job)
+    else:
+        main(args.config, args.project_id, args.window_seconds, args.dry_run,
+             args.single_job)
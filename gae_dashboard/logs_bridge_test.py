@@ -0,0 +1,531 @@
+import collections
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+
+import bq_util
+import logs_bridge
+
+
+_TESTDATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'testdata')
+
+
+class _StopDaemon(Exception):
+    pass
+
+
+class _FakeTime(object):
+    """Stands in for the time module, stopping after some sleeps."""
+    def __init__(self, num_sleeps, on_sleep):
+        self.num_sleeps = num_sleeps
+        self.on_sleep = on_sleep
+        self.sleeps = []
+
+    def time(self):
+        return 1000000000
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        if len(self.sleeps) == self.num_sleeps:
+            raise _StopDaemon()
+        self.on_sleep(len(self.sleeps), seconds)
+
+
+class TestRunDaemon(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.config_file = os.path.join(self.tmpdir, 'config.json')
+        self._write_config([{'metricName': 'a'}], mtime=100)
+
+        self.configs_run = []
+        self.mock(logs_bridge, '_run_pending_windows',
+                  lambda config, *args: self.configs_run.append(config))
+        self.mock(logs_bridge, '_monotonic_time', lambda: 0)
+        self.mock(logs_bridge, '_DAYS_AGO_CACHE_DB',
+                  os.path.join(self.tmpdir, 'days_ago.pickle'))
+
+    def mock(self, container, var_str, new_value):
+        oldval = getattr(container, var_str)
+        self.addCleanup(lambda: setattr(container, var_str, oldval))
+        setattr(container, var_str, new_value)
+
+    def _write_config(self, config, mtime):
+        with open(self.config_file, 'w') as f:
+            f.write('// A comment\n')
+            json.dump(config, f)
+        os.utime(self.config_file, (mtime, mtime))
+
+    def _run_daemon(self, num_windows, on_sleep=lambda num, seconds: None):
+        fake_time = _FakeTime(num_windows, on_sleep)
+        self.mock(logs_bridge, 'time', fake_time)
+        with self.assertRaises(_StopDaemon):
+            logs_bridge.run_daemon(self.config_file, 'proj', 60, False)
+        return fake_time.sleeps
+
+    def test_runs_every_window(self):
+        sleeps = self._run_daemon(3)
+        self.assertEqual([[{'metricName': 'a'}]] * 3, self.configs_run)
+        # Our fake clock never advances, so we always sleep until the
+        # next window.
+        self.assertEqual([60, 120, 180], sleeps)
+
+    def test_reloads_changed_config(self):
+        def on_sleep(num_sleeps, seconds):
+            if num_sleeps == 1:
+                self._write_config([{'metricName': 'b'}], mtime=200)
+            elif num_sleeps == 2:
+                # A bad edit: we keep using the last good config.
+                with open(self.config_file, 'w') as f:
+                    f.write('[{')
+                os.utime(self.config_file, (300, 300))
+
+        self._run_daemon(4, on_sleep)
+        self.assertEqual([[{'metricName': 'a'}], [{'metricName': 'b'}],
+                          [{'metricName': 'b'}], [{'metricName': 'b'}]],
+                         self.configs_run)
+
+    def test_keeps_the_days_ago_cache_in_memory(self):
+        caches = []
+        self.mock(logs_bridge, '_run_pending_windows',
+                  lambda config, *args: caches.append(args[-1]))
+
+        def on_sleep(num_sleeps, seconds):
+            if num_sleeps == 2:
+                self._write_config([{'metricName': 'b'}], mtime=200)
+
+        self._run_daemon(4, on_sleep)
+        self.assertIs(caches[0], caches[1])
+        # A new config gets a new cache.
+        self.assertIsNot(caches[1], caches[2])
+        self.assertIs(caches[2], caches[3])
+        self.assertEqual([{'metricName': 'b'}], caches[2].config)
+
+    def test_errors_do_not_stop_the_daemon(self):
+        def run_pending_windows(config, *args):
+            self.configs_run.append(config)
+            raise RuntimeError('bigquery is down')
+
+        self.mock(logs_bridge, '_run_pending_windows', run_pending_windows)
+        self._run_daemon(3)
+        self.assertEqual(3, len(self.configs_run))
+
+    def test_catches_up_when_behind(self):
+        now = [0]
+        self.mock(logs_bridge, '_monotonic_time', lambda: now[0])
+
+        def run_pending_windows(config, *args):
+            # The first window takes 90 seconds.
+            now[0] += 90 if not self.configs_run else 1
+            self.configs_run.append(config)
+
+        def on_sleep(num_sleeps, seconds):
+            now[0] += seconds
+
+        self.mock(logs_bridge, '_run_pending_windows', run_pending_windows)
+        sleeps = self._run_daemon(3, on_sleep)
+        # We start the second window right away, and then go back to
+        # once a minute.
+        self.assertEqual([0, 59, 59], sleeps)
+
+
+class _FixedTime(object):
+    """Stands in for the time module, with time() always returning now."""
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class _FixedRandom(object):
+    def randint(self, a, b):
+        return 1234
+
+
+class _WindowsBackend(bq_util.FakeBackend):
+    """Returns the given rows for queries that are bucketed by window."""
+    def __init__(self, window_rows):
+        super(_WindowsBackend, self).__init__()
+        self.window_rows = window_rows
+
+    def query(self, sql_query, project, job_name, max_rows):
+        self.calls.append(('query', sql_query.strip()))
+        rows = self.window_rows if 'window_start' in sql_query else []
+        return (None, iter([row.copy() for row in rows[:max_rows]]))
+
+
+class TestRunBigquery(unittest.TestCase):
+    """Compare the queries we run to golden files in testdata/.
+
+    To update the golden files after changing the queries, run this
+    with REGENERATE_GOLDEN_FILES=1, and check the diffs.
+    """
+    def setUp(self):
+        self.start_time_t = 1467830160
+        self.orig_time = logs_bridge.time
+        self.orig_random = logs_bridge.random
+        self.orig_backend = bq_util._BACKEND
+        logs_bridge.time = _FixedTime(self.start_time_t + 120)
+        logs_bridge.random = _FixedRandom()
+        self.backend = bq_util.FakeBackend()
+        bq_util.set_backend(self.backend)
+        self.config = logs_bridge._load_config(
+            os.path.join(_TESTDATA_DIR, 'logs_bridge.config.json'))
+
+    def tearDown(self):
+        logs_bridge.time = self.orig_time
+        logs_bridge.random = self.orig_random
+        bq_util.set_backend(self.orig_backend)
+
+    def _calls_as_text(self):
+        text = []
+        for call in self.backend.calls:
+            if call[0] == 'make_table':
+                text.append('-- make_table %s\n' % call[1])
+            elif call[0] == 'query_to_table':
+                text.append('-- query_to_table %s\n%s\n' % (call[2], call[1]))
+            else:
+                text.append('-- %s\n%s\n' % call)
+        return ''.join(text)
+
+    def _assert_matches_golden_file(self, golden_filename):
+        golden_filename = os.path.join(_TESTDATA_DIR, golden_filename)
+        actual = self._calls_as_text()
+        if os.environ.get('REGENERATE_GOLDEN_FILES'):
+            with open(golden_filename, 'w') as f:
+                f.write(actual)
+        with open(golden_filename) as f:
+            self.assertMultiLineEqual(f.read(), actual)
+
+    def test_temp_table(self):
+        logs_bridge._run_bigquery(self.config, self.start_time_t, 60)
+        self.assertEqual(['make_table', 'query_to_table', 'query'],
+                         [call[0] for call in self.backend.calls])
+        self._assert_matches_golden_file('logs_bridge_temp_table.golden')
+
+    def test_single_job(self):
+        logs_bridge._run_bigquery(self.config, self.start_time_t, 60,
+                                  single_job=True)
+        self.assertEqual(['query'], [call[0] for call in self.backend.calls])
+        self._assert_matches_golden_file('logs_bridge_single_job.golden')
+
+    def test_days_ago_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        cache_file = os.path.join(tmpdir, 'days_ago.pickle')
+        status_metric = 'logs.status.500.week_over_week'
+        latency_metric = 'logs.latency.week_over_week'
+        self.backend = _WindowsBackend([
+            {'window_start': self.start_time_t, 'when': 'some days ago',
+             'metricName': status_metric, 'num_requests_by_field': 10,
+             'num': 1.0, 'module_id': 'default'},
+            {'window_start': self.start_time_t, 'when': 'some days ago',
+             'metricName': latency_metric, 'num_requests_by_field': 30,
+             'num': 0.2, 'route': '/a'},
+            {'window_start': self.start_time_t + 60, 'when': 'some days ago',
+             'metricName': status_metric, 'num_requests_by_field': 5,
+             'num': 0.0, 'module_id': 'default'},
+        ])
+        bq_util.set_backend(self.backend)
+
+        cache = logs_bridge._DaysAgoCache(cache_file, self.config)
+        results = logs_bridge._run_bigquery(self.config, self.start_time_t,
+                                            60, single_job=True,
+                                            days_ago_cache=cache)
+        # One query for the next hour of days-ago windows, and one for now.
+        self.assertEqual(2, len(self.backend.calls))
+        self._assert_matches_golden_file('logs_bridge_days_ago.golden')
+        self.assertNotIn('some days ago', self.backend.calls[1][1])
+        self.assertEqual(
+            [(status_metric, 'some days ago', 40),
+             (latency_metric, 'some days ago', 40)],
+            [(r['metricName'], r['when'], r['num_requests'])
+             for r in results])
+        cache.save()
+
+        # The next window comes from the cache, even in a new process.
+        self.backend.calls = []
+        cache = logs_bridge._DaysAgoCache(cache_file, self.config)
+        results = logs_bridge._run_bigquery(self.config[:1],
+                                            self.start_time_t + 60,
+                                            60, single_job=True,
+                                            days_ago_cache=cache)
+        self.assertEqual(1, len(self.backend.calls))
+        self.assertEqual([(status_metric, 'some days ago', 5)],
+                         [(r['metricName'], r['when'], r['num_requests'])
+                          for r in results])
+        # Windows we've used, or skipped, aren't cached anymore.
+        self.assertEqual(58, len(cache.windows))
+
+        # A new config gets new results.
+        self.backend.calls = []
+        self.backend.window_rows = []
+        cache = logs_bridge._DaysAgoCache(cache_file, self.config[:2])
+        logs_bridge._run_bigquery(self.config[:2], self.start_time_t + 120,
+                                  60, single_job=True, days_ago_cache=cache)
+        self.assertEqual(2, len(self.backend.calls))
+        self.assertEqual(59, len(cache.windows))
+
+    def test_days_ago_prefetch_gets_every_row(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        # More rows than query_bigquery's default limit, per window.
+        self.backend = _WindowsBackend([
+            {'window_start': self.start_time_t + 60 * (i % 2),
+             'when': 'some days ago',
+             'metricName': 'logs.status.500.week_over_week',
+             'num_requests_by_field': 1, 'num': 0.0,
+             'module_id': 'module%d' % i}
+            for i in xrange(30000)])
+        bq_util.set_backend(self.backend)
+
+        cache = logs_bridge._DaysAgoCache(
+            os.path.join(tmpdir, 'days_ago.pickle'), self.config)
+        for window_start in (self.start_time_t, self.start_time_t + 60):
+            results = cache.pop_results(
+                set(['logs.status.500.week_over_week']), window_start, 60)
+            self.assertEqual(15000, len(results))
+            self.assertEqual(15000, results[0]['num_requests'])
+        self.assertEqual(1, len(self.backend.calls))
+
+    def test_days_ago_cache_is_saved_after_prefetching(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        cache_file = os.path.join(tmpdir, 'days_ago.pickle')
+        cache = logs_bridge._DaysAgoCache(cache_file, self.config)
+        cache.save()
+        self.assertFalse(os.path.exists(cache_file))
+
+        metric_names = set(['logs.status.500.week_over_week'])
+        cache.pop_results(metric_names, self.start_time_t, 60)
+        cache.save()
+        with open(cache_file, 'rb') as f:
+            saved = f.read()
+
+        # Using a window doesn't need saving, since the next run will
+        # evict it when it loads the cache.
+        cache.pop_results(metric_names, self.start_time_t + 60, 60)
+        cache.save()
+        with open(cache_file, 'rb') as f:
+            self.assertEqual(saved, f.read())
+        self.assertEqual(1, len(self.backend.calls))
+
+        cache = logs_bridge._DaysAgoCache(cache_file, self.config)
+        cache.pop_results(metric_names, self.start_time_t + 120, 60)
+        self.assertEqual(1, len(self.backend.calls))
+        self.assertEqual(57, len(cache.windows))
+
+    def test_catch_up(self):
+        status_metric = 'logs.status.500.week_over_week'
+        line_count_metric = 'logs.line_count'
+        self.backend = _WindowsBackend([
+            {'window_start': self.start_time_t, 'when': 'now',
+             'metricName': status_metric, 'num_requests_by_field': 10,
+             'num': 1.0, 'module_id': 'default'},
+            {'window_start': self.start_time_t, 'when': 'now',
+             'metricName': line_count_metric, 'num_requests_by_field': 20,
+             'num': 20.0},
+            {'window_start': self.start_time_t, 'when': 'some days ago',
+             'metricName': status_metric, 'num_requests_by_field': 5,
+             'num': 1.0, 'module_id': 'default'},
+            {'window_start': self.start_time_t + 60, 'when': 'now',
+             'metricName': status_metric, 'num_requests_by_field': 7,
+             'num': 0.0, 'module_id': 'default'},
+            {'window_start': self.start_time_t + 60, 'when': 'now',
+             'metricName': line_count_metric, 'num_requests_by_field': 8,
+             'num': 8.0},
+        ])
+        bq_util.set_backend(self.backend)
+
+        # The second window only runs the line-count entry.
+        results = logs_bridge._run_bigquery_for_windows(
+            [(self.start_time_t, self.config),
+             (self.start_time_t + 60, self.config[2:])], 60)
+        self.assertEqual(['make_table', 'query_to_table', 'query'],
+                         [call[0] for call in self.backend.calls])
+        self._assert_matches_golden_file('logs_bridge_catch_up.golden')
+        self.assertEqual(
+            {self.start_time_t: [(status_metric, 'now', 30),
+                                 (line_count_metric, 'now', 30),
+                                 (status_metric, 'some days ago', 5)],
+             self.start_time_t + 60: [(line_count_metric, 'now', 8)]},
+            {start_time: [(r['metricName'], r['when'], r['num_requests'])
+                          for r in window_results]
+             for (start_time, window_results) in results.iteritems()})
+
+    def test_catch_up_gets_every_row(self):
+        status_metric = 'logs.status.500.week_over_week'
+        num_windows = 5
+        # More rows, across the windows, than query_bigquery's default
+        # limit.
+        self.backend = _WindowsBackend([
+            {'window_start': self.start_time_t + 60 * (i % num_windows),
+             'when': 'now', 'metricName': status_metric,
+             'num_requests_by_field': 1, 'num': 0.0,
+             'module_id': 'module%d' % i}
+            for i in xrange(4000 * num_windows)])
+        bq_util.set_backend(self.backend)
+
+        results = logs_bridge._run_bigquery_for_windows(
+            [(self.start_time_t + 60 * i, self.config)
+             for i in xrange(num_windows)], 60)
+        self.assertEqual(
+            dict((self.start_time_t + 60 * i, 4000)
+                 for i in xrange(num_windows)),
+            dict((start_time, len(window_results))
+                 for (start_time, window_results) in results.iteritems()))
+
+    def test_run_windows_catches_up_with_one_query(self):
+        sends = []
+        written_times = []
+        orig_send = logs_bridge._send_to_stackdriver
+        orig_write = logs_bridge._write_time_t_of_latest_successful_run
+        self.addCleanup(setattr, logs_bridge, '_send_to_stackdriver',
+                        orig_send)
+        self.addCleanup(setattr, logs_bridge,
+                        '_write_time_t_of_latest_successful_run', orig_write)
+        logs_bridge._send_to_stackdriver = (
+            lambda project, values, start_time_t, *args: (
+                sends.append(start_time_t) or len(values)))
+        logs_bridge._write_time_t_of_latest_successful_run = (
+            written_times.append)
+
+        logs_bridge._run_windows(self.config, 'proj', 60, False, True, None,
+                                 self.start_time_t - 60,
+                                 self.start_time_t + 120)
+        self.assertEqual(['query'], [call[0] for call in self.backend.calls])
+        self.assertIn('window_start', self.backend.calls[0][1])
+        # We still send, and record, each window in turn.
+        expected_times = [self.start_time_t + i * 60 for i in xrange(3)]
+        self.assertEqual(expected_times, sends)
+        self.assertEqual(expected_times, written_times)
+
+        # With just one window, we run the usual query.
+        self.backend.calls = []
+        logs_bridge._run_windows(self.config, 'proj', 60, False, True, None,
+                                 self.start_time_t + 120,
+                                 self.start_time_t + 180)
+        self.assertEqual(['query'], [call[0] for call in self.backend.calls])
+        self.assertNotIn('window_start', self.backend.calls[0][1])
+
+
+def _route_result(metric_name, when, route, num_requests_by_field, num=None):
+    """Return a bigquery result for a config entry with a route label."""
+    if num is None:
+        num = float(num_requests_by_field)
+    return {'metricName': metric_name, 'when': when, 'elog_url_route': route,
+            'num_requests_by_field': num_requests_by_field, 'num': num,
+            'num_requests': 1000}
+
+
+class TestValuesFromResults(unittest.TestCase):
+    def test_values(self):
+        config = [
+            {'metricName': 'logs.top_routes.week_over_week',
+             'labels': ['route'], 'query': 'COUNT(*)',
+             'num_unique_labels': 3, 'normalizeByDaysAgo': 7},
+            {'metricName': 'logs.routes', 'labels': ['route'],
+             'query': 'COUNT(*)', 'normalizeByRequests': True},
+        ]
+        top_routes = 'logs.top_routes.week_over_week'
+        now_counts = {'/a': 100, '/b': 90, '/c': 80, '/d': 10, '/e': 95}
+        then_counts = {'/a': 50, '/b': 45, '/c': 5, '/d': 200}
+        results = (
+            [_route_result(top_routes, 'now', route, count)
+             for (route, count) in now_counts.iteritems()] +
+            [_route_result(top_routes, 'some days ago', route, count)
+             for (route, count) in then_counts.iteritems()] +
+            # The same routes for another metric, with no label limit,
+            # which mustn't be paired with the first metric's.
+            [_route_result('logs.routes', 'now', '/a', 10),
+             _route_result('logs.routes', 'now', '/c', 20),
+             _route_result('logs.routes', 'some days ago', '/a', 1)])
+
+        # The top 3 routes now are /a, /e and /b, and some days ago
+        # /d, /a and /b.  /e has no days-ago value to normalize by.
+        self.assertEqual(
+            [('logs.routes', {'route': '/a'}, 0.01),
+             ('logs.routes', {'route': '/c'}, 0.02),
+             (top_routes, {'route': '/a'}, 2.0),
+             (top_routes, {'route': '/b'}, 2.0),
+             (top_routes, {'route': '/d'}, 0.05)],
+            sorted(logs_bridge._values_from_results(config, results)))
+
+    def test_sorting_field(self):
+        config = [{'metricName': 'logs.route_latency', 'labels': ['route'],
+                   'query': 'AVG(latency)', 'num_unique_labels': 1,
+                   'unique_labels_sorting_field': 'num'}]
+        results = [
+            _route_result('logs.route_latency', 'now', '/a', 100, num=1.0),
+            _route_result('logs.route_latency', 'now', '/b', 1, num=9.0)]
+        self.assertEqual(
+            [('logs.route_latency', {'route': '/b'}, 9.0)],
+            logs_bridge._values_from_results(config, results))
+
+    def test_ties_keep_the_first_label_value(self):
+        config = [{'metricName': 'logs.routes', 'labels': ['route'],
+                   'num_unique_labels': 2}]
+        for (first, second) in (('/b', '/c'), ('/c', '/b')):
+            results = collections.OrderedDict(
+                (('logs.routes', (route,), 'now'),
+                 _route_result('logs.routes', 'now', route, count))
+                for (route, count) in (('/a', 10), (first, 5),
+                                       (second, 5), ('/d', 1)))
+            self.assertEqual(
+                [('/a',), (first,)],
+                sorted(label_values for (_, label_values, _) in
+                       logs_bridge._maybe_filter_out_infrequent_label_values(
+                           config, results)))
+
+
+@unittest.skipUnless(os.environ.get('BENCHMARK'),
+                     'set BENCHMARK=1 to run benchmarks')
+class BenchmarkValuesFromResults(unittest.TestCase):
+    def test_100k_rows(self):
+        # 100 metrics with 500 routes each, now and a week ago.  Half
+        # the metrics only send their top 20 routes.
+        config = []
+        for i in xrange(100):
+            entry = {'metricName': 'logs.metric_%d' % i,
+                     'labels': ['route'],
+                     'query': 'COUNT(*)',
+                     'normalizeByDaysAgo': 7,
+                     'normalizeByRequests': True}
+            if i % 2:
+                entry['num_unique_labels'] = 20
+            config.append(entry)
+        results = []
+        for when in ('now', 'some days ago'):
+            for entry in config:
+                for j in xrange(500):
+                    num_requests_by_field = random.randint(1, 1000)
+                    results.append({
+                        'metricName': entry['metricName'],
+                        'when': when,
+                        'elog_url_route': '/route/%d' % j,
+                        'num_requests_by_field': num_requests_by_field,
+                        'num': float(num_requests_by_field),
+                        'num_requests': 250000})
+        random.shuffle(results)
+
+        start = time.time()
+        values = logs_bridge._values_from_results(config, results)
+        elapsed = time.time() - start
+
+        print '\n100k rows: %.3fs' % elapsed
+        # 50 metrics send all 500 routes, and the other 50 send 20-40.
+        self.assertLessEqual(50 * 500 + 50 * 20, len(values))
+        self.assertLessEqual(len(values), 50 * 500 + 50 * 40)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -54,7 +54,7 @@ FROM [logs_hourly.requestlogs_%s]
 WHERE app_logs.message CONTAINS 'Exceeded soft private memory limit'
       AND module_id IS NOT NULL
 """ % (yyyymmdd_hh)
-    data = bq_util.query_bigquery(query)
+    data = bq_util.query_bigquery_iter(query)
 
     records = [('webapp.%(module_id)s_module.stats.oom' % row,
                 (row['time_t'], 1))
@@ -88,6 +88,7 @@ def main(graphite_host):
         else:
             last_successful_time_t = time_t
 
+    graphite_util.flush()
     _write_time_t_of_latest_record(last_successful_time_t)
 
 
@@ -0,0 +1,162 @@
+"""Render sparklines -- tiny line graphs -- to PNGs, in pure python.
+
+We used to have gnuplot draw these, but that meant a subprocess for
+every sparkline in every email.  This draws the same picture: a black
+line on a white background, with no borders or axes, where missing
+data (None) shows up as a gap in the line.
+"""
+
+import struct
+import zlib
+
+
+# A content-addressed cache: map from (data, width, height) to the PNG.
+# The same series often shows up in more than one report.
+_CACHE = {}
+_CACHE_SIZE = 1000
+
+_WHITE = 255
+_BLACK = 0
+
+
+def _y_range(existing_data):
+    """Return the (ymin, ymax) that the plot covers."""
+    # The bottom of the plot looks better if it has a bit of buffer around the
+    # top and bottom data points.  We force the min to be near zero so small
+    # increases to something that started out large are viewed in context.
+    ymax = 1.05 * max(existing_data)
+    ymin = -0.05 * max(existing_data)
+    if ymin > ymax:       # all the data is negative
+        (ymin, ymax) = (ymax, ymin)
+    if ymin == ymax:      # all the data is 0
+        (ymin, ymax) = (ymin - 1, ymax + 1)
+    return (ymin, ymax)
+
+
+def _clip_line(width, height, start, end):
+    """Clip a line to the image, using the Liang-Barsky algorithm.
+
+    Returns the (start, end) pixel co-ordinates of the part of the line
+    that's inside the image, or None if none of it is.  A line that's
+    entirely inside the image is returned as is.
+    """
+    (x0, y0) = start
+    (x1, y1) = end
+    dx = x1 - x0
+    dy = y1 - y0
+    # The line is start + t * (end - start), for t from 0 to 1.  For
+    # each edge of the image, p * t <= q inside it.
+    t0 = 0.0
+    t1 = 1.0
+    for (p, q) in ((-dx, x0), (dx, width - 1 - x0),
+                   (-dy, y0), (dy, height - 1 - y0)):
+        if p == 0:
+            if q < 0:     # parallel to this edge, and outside it
+                return None
+        elif p < 0:       # the line comes in across this edge
+            t0 = max(t0, float(q) / p)
+        else:             # the line goes out across this edge
+            t1 = min(t1, float(q) / p)
+        if t0 > t1:
+            return None
+    return ((int(round(x0 + t0 * dx)), int(round(y0 + t0 * dy))),
+            (int(round(x0 + t1 * dx)), int(round(y0 + t1 * dy))))
+
+
+def _draw_line(pixels, width, height, start, end):
+    """Draw a line between two points, using Bresenham's algorithm.
+
+    The points are (x, y) pixel co-ordinates, and may be outside the
+    image: we clip the line to the image first, so a point far outside
+    it doesn't cost us a loop iteration per pixel.
+    """
+    clipped = _clip_line(width, height, start, end)
+    if clipped is None:
+        return
+    ((x0, y0), (x1, y1)) = clipped
+    dx = abs(x1 - x0)
+    dy = -abs(y1 - y0)
+    step_x = 1 if x0 < x1 else -1
+    step_y = 1 if y0 < y1 else -1
+    error = dx + dy
+    while True:
+        if 0 <= x0 < width and 0 <= y0 < height:
+            pixels[y0 * width + x0] = _BLACK
+        if x0 == x1 and y0 == y1:
+            return
+        error2 = 2 * error
+        if error2 >= dy:
+            error += dy
+            x0 += step_x
+        if error2 <= dx:
+            error += dx
+            y0 += step_y
+
+
+def _png_chunk(chunk_type, data):
+    return (struct.pack('!L', len(data)) + chunk_type + data +
+            struct.pack('!L', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+
+def _encode_png(pixels, width, height):
+    """Return the contents of a PNG for the given 8-bit grayscale pixels."""
+    rows = []
+    for y in xrange(height):
+        rows.append('\0')     # filter-type 'none'
+        rows.append(str(pixels[y * width:(y + 1) * width]))
+    return ''.join([
+        '\x89PNG\r\n\x1a\n',
+        # width, height, bit depth, color type (grayscale), compression,
+        # filter method, interlacing.
+        _png_chunk('IHDR', struct.pack('!LLBBBBB', width, height,
+                                       8, 0, 0, 0, 0)),
+        _png_chunk('IDAT', zlib.compress(''.join(rows), 9)),
+        _png_chunk('IEND', ''),
+    ])
+
+
+def _render(data, width, height):
+    existing_data = [datum for datum in data if datum is not None]
+    (ymin, ymax) = _y_range(existing_data)
+    # To make the width per time fixed, the plot's x range is from 1
+    # to len(data), so it includes space for any missing data.
+    # Datapoint i is at x == i, so the first datapoint is just off the
+    # left edge; like gnuplot, we draw the part of its line that's
+    # inside the plot.
+    xmin = 1
+    xmax = len(data)
+    x_scale = (width - 1) / float(xmax - xmin)
+    y_scale = (height - 1) / float(ymax - ymin)
+
+    points = [None if datum is None else
+              (int(round((i - xmin) * x_scale)),
+               int(round((ymax - datum) * y_scale)))
+              for (i, datum) in enumerate(data)]
+
+    pixels = bytearray([_WHITE]) * (width * height)
+    for (start, end) in zip(points, points[1:]):
+        # A None is a gap in the line.
+        if start is not None and end is not None:
+            _draw_line(pixels, width, height, start, end)
+    return _encode_png(pixels, width, height)
+
+
+def render_sparkline(data, width=100, height=20):
+    """Given a list of values, render a sparkline to a PNG.
+
+    This takes in a list of numbers, and returns the contents of a PNG as a
+    string.  A datapoint may be None if it should be omitted.  It will return
+    None if there are not enough datapoints to make a plot.
+    """
+    existing_data = [datum for datum in data if datum is not None]
+    if len(existing_data) < 3:
+        return None
+
+    key = (tuple(data), width, height)
+    png = _CACHE.get(key)
+    if png is None:
+        png = _render(data, width, height)
+        if len(_CACHE) >= _CACHE_SIZE:
+            _CACHE.clear()
+        _CACHE[key] = png
+    return png
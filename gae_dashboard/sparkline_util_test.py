@@ -0,0 +1,158 @@
+import distutils.spawn
+import os
+import struct
+import subprocess
+import time
+import unittest
+import zlib
+
+import sparkline_util
+
+
+def _decode_png(png):
+    """Return (width, height, rows) for an 8-bit grayscale, unfiltered PNG.
+
+    Each row is a string with one character per pixel, '#' for dark
+    and '.' for light.
+    """
+    assert png.startswith('\x89PNG\r\n\x1a\n')
+    pos = 8
+    chunks = {}
+    while pos < len(png):
+        (length,) = struct.unpack('!L', png[pos:pos + 4])
+        chunk_type = png[pos + 4:pos + 8]
+        data = png[pos + 8:pos + 8 + length]
+        (crc,) = struct.unpack('!L', png[pos + 8 + length:pos + 12 + length])
+        assert zlib.crc32(chunk_type + data) & 0xffffffff == crc, chunk_type
+        chunks[chunk_type] = data
+        pos += 12 + length
+
+    (width, height, depth, color_type) = struct.unpack(
+        '!LLBB', chunks['IHDR'][:10])
+    assert (depth, color_type) == (8, 0)
+    pixels = zlib.decompress(chunks['IDAT'])
+    rows = []
+    for y in xrange(height):
+        row = pixels[y * (width + 1):(y + 1) * (width + 1)]
+        assert row[0] == '\0'
+        rows.append(''.join('#' if ord(p) < 128 else '.' for p in row[1:]))
+    return (width, height, rows)
+
+
+class TestRenderSparkline(unittest.TestCase):
+    def setUp(self):
+        sparkline_util._CACHE.clear()
+
+    def test_not_enough_data(self):
+        self.assertIsNone(sparkline_util.render_sparkline([1, None, 2]))
+
+    def test_geometry(self):
+        (width, height, rows) = _decode_png(
+            sparkline_util.render_sparkline([5, 5, 5, 5, 5]))
+        self.assertEqual((100, 20), (width, height))
+        # A flat line, 1/21st of the way down the plot.  Like gnuplot, the
+        # x range is [1, len(data)], so point 0 is off the left edge and
+        # point 4 is at x=74.
+        dark_rows = [y for (y, row) in enumerate(rows) if '#' in row]
+        self.assertEqual([1], dark_rows)
+        self.assertEqual('#' * 75 + '.' * 25, rows[1])
+
+    def test_y_range_starts_near_zero(self):
+        (_, height, rows) = _decode_png(
+            sparkline_util.render_sparkline([0, 0, 0, 10, 10]))
+        # 0 is near the bottom, and 10 near the top.
+        self.assertEqual('#', rows[height - 2][0])
+        self.assertEqual('#', rows[1][74])
+
+    def test_gaps(self):
+        (width, _, rows) = _decode_png(sparkline_util.render_sparkline(
+            [1, 1, 1, None, None, 1, 1]))
+        dark_columns = [x for x in xrange(width)
+                        if any(row[x] == '#' for row in rows)]
+        # Points 1-2 are at x=0-17, and points 5-6 at x=66-83.
+        self.assertEqual(range(0, 18) + range(66, 84), dark_columns)
+
+    def test_outliers_are_clipped(self):
+        # Without clipping, this would take a loop iteration for each
+        # of the trillions of pixels between the outlier and the plot.
+        (_, _, rows) = _decode_png(
+            sparkline_util.render_sparkline([1, -1e12, 2, 3]))
+        # Points 1-3 are at x=0, 33 and 66.  The line from point 1 to
+        # point 2 goes (all but) straight up at x=33, from below the
+        # plot to point 2; then there's the line from point 2 to 3.
+        self.assertEqual('.' * 7 + '#' * 13, ''.join(row[33] for row in rows))
+        self.assertEqual('#', rows[1][66])
+        self.assertEqual(67, max(row.rfind('#') for row in rows) + 1)
+
+    def test_clip_line(self):
+        self.assertEqual(((2, 3), (5, 9)),
+                         sparkline_util._clip_line(10, 10, (2, 3), (5, 9)))
+        self.assertEqual(((0, 5), (9, 5)),
+                         sparkline_util._clip_line(10, 10, (-100, 5),
+                                                   (100, 5)))
+        self.assertEqual(((4, 9), (4, 0)),
+                         sparkline_util._clip_line(10, 10, (4, 10 ** 12),
+                                                   (4, -10 ** 12)))
+        self.assertEqual(((0, 0), (9, 9)),
+                         sparkline_util._clip_line(10, 10, (-5, -5),
+                                                   (20, 20)))
+        self.assertIsNone(sparkline_util._clip_line(10, 10, (-5, 3),
+                                                    (-1, 8)))
+        self.assertIsNone(sparkline_util._clip_line(10, 10, (-5, 8),
+                                                    (8, 25)))
+
+    def test_cache(self):
+        png = sparkline_util.render_sparkline([1, 2, 3])
+        self.assertIs(png, sparkline_util.render_sparkline([1, 2, 3]))
+        self.assertIsNot(png, sparkline_util.render_sparkline([1, 2, 4]))
+
+
+@unittest.skipUnless(os.environ.get('BENCHMARK'),
+                     'set BENCHMARK=1 to run benchmarks')
+class BenchmarkRenderSparkline(unittest.TestCase):
+    def _gnuplot_sparkline(self, data):
+        """Render a sparkline the way email_bq_data used to."""
+        script = ['unset border', 'unset xtics', 'unset ytics', 'unset key',
+                  'set lmargin 0', 'set rmargin 0', 'set tmargin 0',
+                  'set bmargin 0',
+                  'set yrange [%s:%s]' % (-0.05 * max(data), 1.05 * max(data)),
+                  'set xrange [1:%s]' % len(data),
+                  'set terminal pngcairo size 100,20',
+                  'plot "-" using 1:2 notitle with lines linetype rgb "black"']
+        script.extend('%s %s' % (i, datum) for (i, datum) in enumerate(data))
+        script.append('e')
+        proc = subprocess.Popen(['gnuplot'], stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        return proc.communicate('\n'.join(script) + '\n')[0]
+
+    def test_per_sparkline_cost(self):
+        # A report's worth of distinct two-week sparklines.
+        all_data = [[i] + [(i * j) % 17 + 1 for j in xrange(14)]
+                    for i in xrange(1000)]
+
+        sparkline_util._CACHE.clear()
+        start = time.time()
+        for data in all_data:
+            sparkline_util.render_sparkline(data)
+        python_time = (time.time() - start) / len(all_data)
+
+        start = time.time()
+        for data in all_data:
+            sparkline_util.render_sparkline(data)
+        cached_time = (time.time() - start) / len(all_data)
+
+        print ('\nper sparkline: python %.3fms, cached %.3fms'
+               % (python_time * 1000, cached_time * 1000))
+        self.assertLess(cached_time, python_time)
+
+        if distutils.spawn.find_executable('gnuplot'):
+            start = time.time()
+            for data in all_data[:50]:
+                self._gnuplot_sparkline(data)
+            gnuplot_time = (time.time() - start) / 50
+            print 'per sparkline: gnuplot %.3fms' % (gnuplot_time * 1000)
+            self.assertLess(python_time, gnuplot_time)
+
+
+if __name__ == '__main__':
+    unittest.main()